@@ -0,0 +1,84 @@
+# Compares the bucketed duplicate index used by SynchronizationTask._accumulateActivities against the exhaustive pairwise comparison it replaced.
+# The exhaustive comparison is quadratic, so it's timed over a sample of lookups and extrapolated to the full list.
+from tapiriik.sync.activity_index import ActivityDeduplicationIndex
+from tapiriik.services.interchange import Activity, ActivityType
+from datetime import datetime, timedelta
+import random
+import time
+import pytz
+import sys
+
+SIZES = [1000, 10000, 50000]
+LINEAR_SAMPLE = 200
+
+def generate_listing(count, seed=42):
+    rng = random.Random(seed)
+    zones = [pytz.timezone(x) for x in ["America/Toronto", "Europe/London", "Asia/Kolkata", "Australia/Adelaide", "America/Denver"]]
+    types = [ActivityType.Running, ActivityType.Cycling, ActivityType.MountainBiking, ActivityType.Walking, ActivityType.Other]
+    activities = []
+    start = datetime(2008, 1, 1)
+    while len(activities) < count:
+        start += timedelta(seconds=rng.randint(60 * 30, 60 * 60 * 30))
+        tz = rng.choice(zones)
+        actType = rng.choice(types)
+        # Each workout shows up on 1-3 services, with the usual assortment of TZ and rounding discrepancies
+        for copy_idx in range(rng.randint(1, 3)):
+            act = Activity(actType=actType)
+            variant = rng.random()
+            if variant < 0.4:
+                act.StartTime = tz.localize(start)
+            elif variant < 0.7:
+                act.StartTime = start + timedelta(seconds=rng.randint(-90, 90))
+            elif variant < 0.9:
+                act.StartTime = tz.localize(start).astimezone(pytz.utc)
+            else:
+                act.StartTime = start + timedelta(hours=rng.randint(-12, 12), minutes=rng.choice([0, 30]))
+            act.CalculateUID()
+            activities.append(act)
+    return activities[:count]
+
+def accumulate_indexed(listing):
+    index = ActivityDeduplicationIndex()
+    kept = []
+    for act in listing:
+        if not index.FindDuplicates(act):
+            kept.append(act)
+            index.Add(act)
+    return kept
+
+def linear_lookup(kept, act):
+    return [x for x in kept if ActivityDeduplicationIndex.IsDuplicate(x, act)]
+
+def run(size):
+    listing = generate_listing(size)
+
+    begin = time.perf_counter()
+    kept = accumulate_indexed(listing)
+    indexed_time = time.perf_counter() - begin
+
+    # Reconstruct the accumulated list as it stood before each sampled lookup, and check both approaches agree on the outcome.
+    rng = random.Random(size)
+    sample = sorted(rng.sample(range(len(listing)), min(LINEAR_SAMPLE, len(listing))))
+    kept_ids = set(id(x) for x in kept)
+    linear_time = 0
+    kept_so_far = []
+    cursor = 0
+    for position in sample:
+        while cursor < position:
+            if id(listing[cursor]) in kept_ids:
+                kept_so_far.append(listing[cursor])
+            cursor += 1
+        begin = time.perf_counter()
+        matches = linear_lookup(kept_so_far, listing[position])
+        linear_time += time.perf_counter() - begin
+        if bool(matches) == (id(listing[position]) in kept_ids):
+            raise AssertionError("Index and exhaustive comparison disagree on activity %d" % position)
+    linear_time = linear_time / len(sample) * len(listing)
+
+    print("%6d activities (%6d unique): indexed %8.3fs, exhaustive ~%9.1fs (extrapolated), speedup ~%.0fx" % (size, len(kept), indexed_time, linear_time, linear_time / indexed_time))
+    sys.stdout.flush()
+
+if __name__ == "__main__":
+    sizes = [int(x) for x in sys.argv[1:]] or SIZES
+    for size in sizes:
+        run(size)
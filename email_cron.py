@@ -40,10 +40,14 @@ for expired_payment in expired_payments:
 	}
 	subscription_fuzzy_time = [v for k,v in subscription_fuzzy_time_map.items() if k[0] <= subscription_days and k[1] > subscription_days][0]
 
-	activity_records = db.activity_records.find_one({"UserID": connected_user["_id"]})
+	activity_records = list(db.activity_records.find({"UserID": connected_user["_id"], "Activities": {"$exists": False}}, {"Distance": 1}))
+	# Along with any that haven't been split out of the old single document yet (see ActivityRecord.MigrateEmbedded)
+	embedded = db.activity_records.find_one({"UserID": connected_user["_id"], "Activities": {"$exists": True}}, {"Activities.Distance": 1})
+	if embedded:
+		activity_records += embedded["Activities"]
 	total_distance_synced = None
 	if activity_records:
-		total_distance_synced = sum([x["Distance"] for x in activity_records["Activities"] if x["Distance"]])
+		total_distance_synced = sum([x["Distance"] for x in activity_records if x.get("Distance")])
 		total_distance_synced = math.floor(total_distance_synced/1000 / 100) * 100
 
 	context = {
@@ -0,0 +1,15 @@
+# Splits each user's activity records out of the single document they used to share, into a document apiece.
+# Syncs migrate the users they touch as they go, so this can be run (and re-run) whenever's convenient.
+from tapiriik.database import db
+from tapiriik.sync.activity_record import ActivityRecord
+import sys
+
+ActivityRecord.EnsureIndexes()
+
+pending = [x["UserID"] for x in db.activity_records.find({"Activities": {"$exists": True}}, {"UserID": 1})]
+print("Migrating %d users" % len(pending))
+for idx, userId in enumerate(pending):
+    ActivityRecord.MigrateEmbedded(userId)
+    if idx % 100 == 0:
+        print(" -> %d/%d" % (idx, len(pending)))
+        sys.stdout.flush()
@@ -0,0 +1,14 @@
+# Moves the SynchronizedActivities arrays embedded in each connection out into db.synchronized_activities.
+# Syncs migrate the connections they touch as they go, so this can be run (and re-run) whenever's convenient.
+from tapiriik.database import db
+from tapiriik.sync.synchronized_activities import SynchronizedActivities
+import sys
+
+SynchronizedActivities.EnsureIndexes()
+
+pending = [x["_id"] for x in db.connections.find({"SynchronizedActivities": {"$exists": True}}, {"_id": 1})]
+print("Migrating %d connections" % len(pending))
+for idx in range(0, len(pending), 100):
+    SynchronizedActivities.MigrateEmbedded(pending[idx:idx + 100])
+    print(" -> %d/%d" % (min(idx + 100, len(pending)), len(pending)))
+    sys.stdout.flush()
@@ -1,4 +1,5 @@
 from tapiriik.database import db
+from tapiriik.sync.lanes import SyncLane
 from datetime import datetime, timedelta
 
 # total distance synced
@@ -29,6 +30,17 @@ if len(queueHead):
         queueHeadTime += datetime.utcnow() - queuedUser["NextSynchronization"]
     queueHeadTime /= len(queueHead)
 
+# ...and the same for each lane, since the interactive ones shouldn't be stuck behind everyone else
+queueHeadTimeByLane = {}
+for lane in SyncLane.All:
+    laneQuery = {"NextSynchronization": {"$lte": datetime.utcnow()}, "SynchronizationWorker": None, "SynchronizationHostRestriction": {"$exists": False}}
+    laneQuery.update(SyncLane.Query(lane))
+    laneQueueHead = list(db.users.find(laneQuery, {"NextSynchronization": 1}).sort("NextSynchronization").limit(10))
+    laneQueueHeadTime = timedelta(0)
+    for queuedUser in laneQueueHead:
+        laneQueueHeadTime += datetime.utcnow() - queuedUser["NextSynchronization"]
+    queueHeadTimeByLane[lane] = (laneQueueHeadTime / len(laneQueueHead)).total_seconds() if len(laneQueueHead) else 0
+
 # sync time utilization
 db.sync_worker_stats.remove({"Timestamp": {"$lt": datetime.utcnow() - timedelta(hours=1)}})  # clean up old records
 timeUsedAgg = db.sync_worker_stats.aggregate([{"$group": {"_id": None, "total": {"$sum": "$TimeTaken"}}}])["result"]
@@ -40,6 +52,13 @@ else:
     timeUsed = 0
     avgSyncTime = 0
 
+# how long the users that did get synchronized had been waiting, by lane
+queueWaitAgg = db.sync_worker_stats.aggregate([{"$match": {"QueueWait": {"$ne": None}}}, {"$group": {"_id": "$Lane", "wait": {"$avg": "$QueueWait"}}}])["result"]
+queueWaitByLane = dict((lane, 0) for lane in SyncLane.All)
+for laneWait in queueWaitAgg:
+    if laneWait["_id"] in queueWaitByLane:
+        queueWaitByLane[laneWait["_id"]] = laneWait["wait"]
+
 # error/pending/locked stats
 lockedSyncRecords = db.users.aggregate([
                                        {"$match": {"SynchronizationWorker": {"$ne": None}}},
@@ -86,10 +105,12 @@ db.sync_status_stats.insert({
         "ErrorUsers": usersWithErrors,
         "TotalErrors": totalErrors,
         "SyncTimeUsed": timeUsed,
-        "SyncQueueHeadTime": queueHeadTime.total_seconds()
+        "SyncQueueHeadTime": queueHeadTime.total_seconds(),
+        "SyncQueueHeadTimeByLane": queueHeadTimeByLane,
+        "SyncQueueWaitByLane": queueWaitByLane
 })
 
-db.stats.update({}, {"$set": {"TotalDistanceSynced": distanceSynced, "LastDayDistanceSynced": lastDayDistanceSynced, "LastHourDistanceSynced": lastHourDistanceSynced, "TotalSyncTimeUsed": timeUsed, "AverageSyncDuration": avgSyncTime, "LastHourSynchronizationCount": totalSyncOps, "QueueHeadTime": queueHeadTime.total_seconds(), "Updated": datetime.utcnow()}}, upsert=True)
+db.stats.update({}, {"$set": {"TotalDistanceSynced": distanceSynced, "LastDayDistanceSynced": lastDayDistanceSynced, "LastHourDistanceSynced": lastHourDistanceSynced, "TotalSyncTimeUsed": timeUsed, "AverageSyncDuration": avgSyncTime, "LastHourSynchronizationCount": totalSyncOps, "QueueHeadTime": queueHeadTime.total_seconds(), "QueueHeadTimeByLane": queueHeadTimeByLane, "QueueWaitByLane": queueWaitByLane, "Updated": datetime.utcnow()}}, upsert=True)
 
 
 def aggregateCommonErrors():
@@ -0,0 +1,7 @@
+# Hands due users out to the sync workers through the broker, when SYNC_DISPATCH_QUEUE = "amqp".
+# It's fine to run more than one of these - at worst a user is delivered twice, and the second delivery finds them already locked or synchronized.
+from tapiriik.sync.dispatch import SyncDispatcher
+from datetime import datetime
+
+print("Sync dispatcher starting at %s" % datetime.now())
+SyncDispatcher.Run(SyncDispatcher.OpenQueue())
@@ -19,20 +19,25 @@ for worker in db.sync_workers.find({"Host": host}):
         alive = False
 
     # Has it been stalled for too long?
-    if worker["State"] == SyncStep.List:
-        timeout = timedelta(minutes=45)  # This can take a loooooooong time
-    else:
-        timeout = timedelta(minutes=10)  # But everything else shouldn't
+    def stalled(heartbeat):
+        if heartbeat["State"] == SyncStep.List:
+            timeout = timedelta(minutes=45)  # This can take a loooooooong time
+        else:
+            timeout = timedelta(minutes=10)  # But everything else shouldn't
+        return heartbeat["Heartbeat"] < datetime.utcnow() - timeout
 
-    if alive and worker["Heartbeat"] < datetime.utcnow() - timeout:
+    # Workers synchronizing several users at once have a heartbeat for each - any one of them being stuck is enough
+    if alive and (stalled(worker) or any(stalled(task) for task in worker.get("Tasks", {}).values())):
         print("%s timed out" % worker)
         os.kill(worker["Process"], signal.SIGKILL)
         alive = False
 
     # Clear it from the database if it's not alive.
+    # The users it had locked take care of themselves - their leases run out without it around to renew them, and they're picked up again from there.
     if not alive:
         db.sync_workers.remove({"_id": worker["_id"]})
-        # Unlock users attached to it.
-        for user in db.users.find({"SynchronizationWorker": worker["Process"], "SynchronizationHost": host}):
+        # ...except those locked by workers from before there were leases, which would otherwise stay locked for good.
+        legacyLockQuery = {"SynchronizationWorker": worker["Process"], "SynchronizationHost": host, "SynchronizationLeaseExpiry": {"$exists": False}}
+        for user in db.users.find(legacyLockQuery, {"_id": 1}):
             print("\t Unlocking %s" % user["_id"])
-        db.users.update({"SynchronizationWorker": worker["Process"], "SynchronizationHost": host}, {"$unset":{"SynchronizationWorker": True}}, multi=True)
+        db.users.update(legacyLockQuery, {"$unset": {"SynchronizationWorker": True}}, multi=True)
@@ -1,33 +1,50 @@
 from tapiriik.requests_lib import patch_requests_with_default_timeout, patch_requests_source_address
 from tapiriik import settings
 from tapiriik.database import db
+import tapiriik.database
 import time
 import datetime
 import os
+import random
 import signal
 import sys
 import subprocess
 import socket
+import threading
+import multiprocessing
+import traceback
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
 
 Run = True
-RecycleInterval = 1 # Time spent rebooting workers < time spent wrangling Python memory management.
+# Time spent rebooting workers < time spent wrangling Python memory management.
+# ...but rebooting doesn't mean starting from scratch: this process does all the importing & initializing once, then forks a child to do the syncing.
+# The child keeps at it until its resident memory grows past SYNC_WORKER_MEMORY_BUDGET, then exits, taking whatever it accumulated with it - and the next one is forked (copy-on-write) in a matter of milliseconds.
+ChildPID = None
 
 oldCwd = os.getcwd()
 WorkerVersion = subprocess.Popen(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE, cwd=os.path.dirname(__file__)).communicate()[0].strip()
 os.chdir(oldCwd)
 
-def sync_interrupt(signal, frame):
+def sync_interrupt(signum, frame):
     global Run
     Run = False
+    if ChildPID:
+        os.kill(ChildPID, signal.SIGUSR2) # It'll finish up what it's doing, then exit
 
 signal.signal(signal.SIGINT, sync_interrupt)
 signal.signal(signal.SIGUSR2, sync_interrupt)
 
 def sync_heartbeat(state):
-    db.sync_workers.update({"Process": os.getpid(), "Host": socket.gethostname()}, {"$set": {"Heartbeat": datetime.datetime.utcnow(), "State": state}})
+    # Each thread synchronizing a user keeps a heartbeat of its own too, so one stuck sync can't hide behind the others in the same process
+    # These are written out every so often by the reporter, rather than for every activity
+    heartbeat = datetime.datetime.utcnow()
+    SyncStatusReporter.Set(db.sync_workers, {"Process": os.getpid(), "Host": socket.gethostname()}, {"Heartbeat": heartbeat, "State": state, "Tasks.%s" % threading.current_thread().name: {"Heartbeat": heartbeat, "State": state}})
 
-print("Sync worker starting at " + datetime.datetime.now().ctime() + " \n -> PID " + str(os.getpid()))
-db.sync_workers.update({"Process": os.getpid(), "Host": socket.gethostname()}, {"Process": os.getpid(), "Heartbeat": datetime.datetime.utcnow(), "Startup":  datetime.datetime.utcnow(),  "Version": WorkerVersion, "Host": socket.gethostname(), "State": "startup"}, upsert=True)
+def sync_task_finished():
+    SyncStatusReporter.Unset(db.sync_workers, {"Process": os.getpid(), "Host": socket.gethostname()}, ["Tasks.%s" % threading.current_thread().name])
+
+print("Sync worker supervisor starting at " + datetime.datetime.now().ctime() + " \n -> PID " + str(os.getpid()))
 sys.stdout.flush()
 
 patch_requests_with_default_timeout(timeout=60)
@@ -41,16 +58,119 @@ print(" -> Index %s\n -> Interface %s" % (settings.WORKER_INDEX, settings.HTTP_S
 # We defer including the main body of the application till here so the settings aren't captured before we've set them up.
 # The better way would be to defer initializing services until they're requested, but it's 10:30 and this will work just as well.
 from tapiriik.sync import Sync
+from tapiriik.sync.memory import MemoryUsage
+from tapiriik.sync.status_reporter import SyncStatusReporter
+from tapiriik.sync.dispatch import SyncDispatcher, LocalSyncQueue
+from tapiriik.sync.synchronized_activities import SynchronizedActivities
+
+SynchronizedActivities.EnsureIndexes() # Before anything's upserted into it
+
+def sync_child():
+    tapiriik.database.reconnect()
+    random.seed() # Otherwise every child would draw the same sync interval jitter
+    if settings.SYNC_TRACE_ALLOCATIONS:
+        tracemalloc.start(settings.SYNC_TRACE_ALLOCATIONS)
+    db.sync_workers.update({"Process": os.getpid(), "Host": socket.gethostname()}, {"Process": os.getpid(), "Index": settings.WORKER_INDEX, "Heartbeat": datetime.datetime.utcnow(), "Startup":  datetime.datetime.utcnow(),  "Version": WorkerVersion, "Host": socket.gethostname(), "State": "startup"}, upsert=True)
+    if settings.SYNC_USER_CONCURRENCY <= 1:
+        sync_loop()
+    else:
+        # Each thread runs its own loop, until the budget's used up and they all wind down
+        with ThreadPoolExecutor(max_workers=settings.SYNC_USER_CONCURRENCY, thread_name_prefix="sync") as executor:
+            for pending in [executor.submit(sync_loop) for x in range(settings.SYNC_USER_CONCURRENCY)]:
+                pending.result()
+    print("Sync worker %d recycling with %d MB resident" % (os.getpid(), MemoryUsage.RSS() // (1024 * 1024)))
+    db.sync_workers.remove({"Process": os.getpid(), "Host": socket.gethostname()})
+
+def sync_loop():
+    dispatchQueue = SyncDispatcher.OpenQueue() if settings.SYNC_DISPATCH_QUEUE else None
+    while Run:
+        cycleStart = datetime.datetime.utcnow()
+        try:
+            if dispatchQueue:
+                Sync.PerformQueuedSync(dispatchQueue, heartbeat_callback=sync_heartbeat, version=WorkerVersion)
+            else:
+                Sync.PerformGlobalSync(heartbeat_callback=sync_heartbeat, version=WorkerVersion)
+        finally:
+            sync_task_finished()
+        # Checked after the fact, so a budget set too low still gets some work done
+        if MemoryUsage.RSS() > settings.SYNC_WORKER_MEMORY_BUDGET:
+            break
+        if not dispatchQueue and (datetime.datetime.utcnow() - cycleStart).total_seconds() < 1:
+            time.sleep(1) # Waiting on the queue takes care of this otherwise
+        sync_heartbeat("idle")
+
+def sync_dispatcher(dispatchQueue, stop):
+    # The supervisor stops it once the child it's feeding is done - it doesn't need telling twice
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+    tapiriik.database.reconnect()
+    SyncDispatcher.RunLocal(dispatchQueue, socket.gethostname(), stop)
+
+def start_dispatcher():
+    # Another process rather than a thread, so there's nothing running alongside the supervisor when it forks the child - and nothing holding locks the child would inherit
+    context = multiprocessing.get_context("fork")
+    dispatchQueue = LocalSyncQueue()
+    stop = context.Event()
+    process = context.Process(target=sync_dispatcher, args=(dispatchQueue, stop), name="sync-dispatcher", daemon=True)
+    process.start()
+    return dispatchQueue, stop, process
+
+def stop_dispatcher(dispatchQueue, stop, process):
+    stop.set()
+    process.join(10)
+    if process.is_alive():
+        process.terminate() # Stuck on the queue's lock, if the child was killed holding it
+        process.join()
+    dispatchQueue.Release()
+
+def release_child(pid):
+    # Their leases would run out soon enough - but we know for sure it's dead, so there's no sense waiting
+    db.sync_workers.remove({"Process": pid, "Host": socket.gethostname()})
+    db.users.update({"SynchronizationWorker": pid, "SynchronizationHost": socket.gethostname()}, {"$unset":{"SynchronizationWorker": True, "SynchronizationClaim": True, "SynchronizationLeaseExpiry": True}}, multi=True)
+
+if settings.SYNC_DISPATCH_QUEUE == "local":
+    # The host's one dispatcher runs alongside each child in turn - which is only any good if this is the only sync_worker on the host
+    import fcntl
+    dispatchLock = open("/tmp/tapiriik-sync-dispatch.lock", "w")
+    try:
+        fcntl.flock(dispatchLock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        print("Another sync_worker on this host already has the local dispatch queue - use the amqp one to run several")
+        sys.exit(1)
 
 while Run:
     cycleStart = datetime.datetime.utcnow()
-    RecycleInterval -= Sync.PerformGlobalSync(heartbeat_callback=sync_heartbeat, version=WorkerVersion)
-    if RecycleInterval <= 0:
-    	break
+    sys.stdout.flush()
+    dispatcher = None
+    if settings.SYNC_DISPATCH_QUEUE == "local":
+        dispatcher = start_dispatcher()
+        LocalSyncQueue.Current = dispatcher[0]
+    pid = os.fork()
+    if pid == 0:
+        exitCode = 1
+        try:
+            sync_child()
+            exitCode = 0
+        except:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exitCode)
+
+    ChildPID = pid
+    if not Run:
+        os.kill(pid, signal.SIGUSR2) # We were interrupted before it could be passed on
+    _, status = os.waitpid(pid, 0)
+    ChildPID = None
+    if dispatcher:
+        stop_dispatcher(*dispatcher)
+        LocalSyncQueue.Current = None
+    if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+        print("Sync worker %d died (status %d)" % (pid, status))
+        release_child(pid)
     if (datetime.datetime.utcnow() - cycleStart).total_seconds() < 1:
         time.sleep(1)
-    sync_heartbeat("idle")
 
-print("Sync worker shutting down cleanly")
-db.sync_workers.remove({"Process": os.getpid(), "Host": socket.gethostname()})
+print("Sync worker supervisor shutting down cleanly")
 sys.stdout.flush()
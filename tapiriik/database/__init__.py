@@ -1,6 +1,27 @@
 from pymongo import MongoClient
 from tapiriik.settings import MONGO_HOST
-_connection = MongoClient(host=MONGO_HOST)
-db = _connection["tapiriik"]
-cachedb = _connection["tapiriik_cache"]
-tzdb = _connection["tapiriik_tz"]
+
+class _DatabaseProxy:
+    # MongoClient isn't fork-safe, so a forked process needs a connection of its own.
+    # Everything imports db & co. directly, so these stand in for the real Database objects and let reconnect() swap the connection out from underneath them.
+    def __init__(self, name):
+        self._name = name
+        self._database = None
+
+    def __getattr__(self, name):
+        return getattr(self._database, name)
+
+    def __getitem__(self, name):
+        return self._database[name]
+
+def reconnect():
+    # The old client is just abandoned - closing it from a forked child would tear down sockets the parent is still using.
+    global _connection
+    _connection = MongoClient(host=MONGO_HOST)
+    for proxy in (db, cachedb, tzdb):
+        proxy._database = _connection[proxy._name]
+
+db = _DatabaseProxy("tapiriik")
+cachedb = _DatabaseProxy("tapiriik_cache")
+tzdb = _DatabaseProxy("tapiriik_tz")
+reconnect()
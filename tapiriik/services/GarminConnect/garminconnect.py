@@ -21,6 +21,7 @@ import time
 import json
 import re
 import random
+import threading
 from urllib.parse import urlencode
 logger = logging.getLogger(__name__)
 
@@ -112,31 +113,34 @@ class GarminConnectService(ServiceBase):
         # Ensure the rate lock file exists (...the easy way)
         open(rate_lock_path, "a").close()
         self._rate_lock = open(rate_lock_path, "r+")
+        # flock() doesn't exclude other threads using the same file, so they queue up on this first.
+        self._rate_thread_lock = threading.Lock()
 
     def _rate_limit(self):
         import fcntl, struct, time
         min_period = 1  # I appear to been banned from Garmin Connect while determining this.
         print("Waiting for lock")
-        fcntl.flock(self._rate_lock,fcntl.LOCK_EX)
-        try:
-            print("Have lock")
-            self._rate_lock.seek(0)
-            last_req_start = self._rate_lock.read()
-            if not last_req_start:
-                last_req_start = 0
-            else:
-                last_req_start = float(last_req_start)
+        with self._rate_thread_lock:
+            fcntl.flock(self._rate_lock,fcntl.LOCK_EX)
+            try:
+                print("Have lock")
+                self._rate_lock.seek(0)
+                last_req_start = self._rate_lock.read()
+                if not last_req_start:
+                    last_req_start = 0
+                else:
+                    last_req_start = float(last_req_start)
 
-            wait_time = max(0, min_period - (time.time() - last_req_start))
-            time.sleep(wait_time)
+                wait_time = max(0, min_period - (time.time() - last_req_start))
+                time.sleep(wait_time)
 
-            self._rate_lock.seek(0)
-            self._rate_lock.write(str(time.time()))
-            self._rate_lock.flush()
+                self._rate_lock.seek(0)
+                self._rate_lock.write(str(time.time()))
+                self._rate_lock.flush()
 
-            print("Rate limited for %f" % wait_time)
-        finally:
-            fcntl.flock(self._rate_lock,fcntl.LOCK_UN)
+                print("Rate limited for %f" % wait_time)
+            finally:
+                fcntl.flock(self._rate_lock,fcntl.LOCK_UN)
 
     def _get_session(self, record=None, email=None, password=None, skip_cache=False):
         from tapiriik.auth.credential_storage import CredentialStore
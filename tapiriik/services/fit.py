@@ -1,6 +1,7 @@
 from datetime import datetime, timedelta
-from .interchange import WaypointType, ActivityStatisticUnit, ActivityType, LapIntensity, LapTriggerMethod
-from .devices import DeviceIdentifier, DeviceIdentifierType
+from .interchange import Activity, Lap, Waypoint, Location, WaypointType, ActivityStatistic, ActivityStatisticUnit, ActivityType, LapIntensity, LapTriggerMethod
+from .devices import Device, DeviceIdentifier, DeviceIdentifierType
+import operator
 import struct
 import sys
 import pytz
@@ -50,12 +51,13 @@ class FITActivityType:
 	ALL = 254
 
 class FITMessageDataType:
-	def __init__(self, name, typeField, size, packFormat, invalid, formatter=None):
+	def __init__(self, name, typeField, size, packFormat, invalid, formatter=None, parser=None):
 		self.Name = name
 		self.TypeField = typeField
 		self.Size = size
 		self.PackFormat = packFormat
 		self.Formatter = formatter
+		self.Parser = parser
 		self.InvalidValue = invalid
 
 class FITMessageTemplate:
@@ -80,52 +82,114 @@ class FITMessageTemplate:
 		self.FieldNameList = [x["Name"] for x in sortedFields] # *ordered*
 
 
+class FITCRC:
+	# CRC-16 (the 0xA001 polynomial) as the FIT SDK does it, a byte at a time rather than the SDK's nibble at a time
+	def _tableEntry(byte):
+		crc = byte
+		for x in range(8):
+			crc = (crc >> 1) ^ (0xA001 if crc & 1 else 0)
+		return crc
+	Table = None
+
+	def Update(crc, bytestring):
+		table = FITCRC.Table
+		for byte in bytestring:
+			crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+		return crc
+
+	def Combine(crc1, crc2, length2):
+		# The CRC of A+B, given that of A, that of B (starting from 0), and B's length - like zlib's crc32_combine
+		# Running crc1 through length2 zero bytes is linear, so it's a 16x16 bit matrix raised to length2, by squaring
+		def apply(matrix, crc):
+			result = 0
+			bit = 0
+			while crc:
+				if crc & 1:
+					result ^= matrix[bit]
+				crc >>= 1
+				bit += 1
+			return result
+		def compose(a, b):
+			return [apply(a, column) for column in b]
+
+		zeroByte = [FITCRC.Update(1 << bit, b"\0") for bit in range(16)]
+		while length2:
+			if length2 & 1:
+				crc1 = apply(zeroByte, crc1)
+			zeroByte = compose(zeroByte, zeroByte)
+			length2 >>= 1
+		return crc1 ^ crc2
+
+FITCRC.Table = [FITCRC._tableEntry(x) for x in range(256)]
+
 class FITMessageGenerator:
 	def __init__(self):
 		self._types = {}
 		self._messageTemplates = {}
 		self._definitions = {}
+		self._definitionsByFields = {} # (message name, frozenset of field names, compressed timestamp) -> local message type
+		self._localMessageTypeUses = {} # local message type -> self._messageCount when it was last used
+		self._messageCount = 0
+		self._lastTimestamp = None # As the reader will see it, for compressed timestamps
 		self._result = []
+		self._crc = 0 # Kept up as messages are written, so there's no going back over them all at the end
 		# All our convience functions for preparing the field types to be packed.
 		def stringFormatter(input):
 			raise Exception("Not implemented")
+		# These return the value to be packed (per the type's PackFormat) - the packing itself happens all at once, per message
+		fitEpoch = datetime(hour=0, minute=0, month=12, day=31, year=1989)
 		def dateTimeFormatter(input):
 			# UINT32
 			# Seconds since UTC 00:00 Dec 31 1989. If <0x10000000 = system time
 			if input is None:
-				return struct.pack("<I", 0xFFFFFFFF)
-			delta = round((input - datetime(hour=0, minute=0, month=12, day=31, year=1989)).total_seconds())
-			return struct.pack("<I", delta)
+				return 0xFFFFFFFF
+			return round((input - fitEpoch).total_seconds())
 		def msecFormatter(input):
 			# UINT32
 			if input is None:
-				return struct.pack("<I", 0xFFFFFFFF)
-			return struct.pack("<I", round((input if type(input) is not timedelta else input.total_seconds()) * 1000))
+				return 0xFFFFFFFF
+			return round((input if type(input) is not timedelta else input.total_seconds()) * 1000)
 		def mmPerSecFormatter(input):
 			# UINT16
 			if input is None:
-				return struct.pack("<H", 0xFFFF)
-			return struct.pack("<H", round(input * 1000))
+				return 0xFFFF
+			return round(input * 1000)
 		def cmFormatter(input):
 			# UINT32
 			if input is None:
-				return struct.pack("<I", 0xFFFFFFFF)
-			return struct.pack("<I", round(input * 100))
+				return 0xFFFFFFFF
+			return round(input * 100)
 		def altitudeFormatter(input):
 			# UINT16
 			if input is None:
-				return struct.pack("<H", 0xFFFF)
-			return struct.pack("<H", round((input + 500) * 5)) # Increments of 1/5, offset from -500m :S
+				return 0xFFFF
+			return round((input + 500) * 5) # Increments of 1/5, offset from -500m :S
 		def semicirclesFormatter(input):
 			# SINT32
 			if input is None:
-				return struct.pack("<i", 0x7FFFFFFF) # FIT-defined invalid value
-			return struct.pack("<i", round(input * (2 ** 31 / 180)))
+				return 0x7FFFFFFF # FIT-defined invalid value
+			return round(input * (2 ** 31 / 180))
 		def versionFormatter(input):
 			# UINT16
 			if input is None:
-				return struct.pack("<H", 0xFFFF)
-			return struct.pack("<H", round(input * 100))
+				return 0xFFFF
+			return round(input * 100)
+
+		# And back again, for FITMessageParser (invalid values never make it this far)
+		def dateTimeParser(input):
+			return pytz.utc.localize(datetime(hour=0, minute=0, month=12, day=31, year=1989) + timedelta(seconds=input))
+		def msecParser(input):
+			return input / 1000
+		def mmPerSecParser(input):
+			return input / 1000
+		def cmParser(input):
+			return input / 100
+		def altitudeParser(input):
+			return input / 5 - 500
+		def semicirclesParser(input):
+			return input * (180 / 2 ** 31)
+		def versionParser(input):
+			return input / 100
 
 
 		def defType(name, *args, **kwargs):
@@ -151,13 +215,13 @@ class FITMessageGenerator:
 		defType("byte", 0x0D, 1, "B", 0xFF) # This isn't totally correct, docs say "an array of bytes"
 
 		# Not strictly FIT fields, but convenient.
-		defType("date_time", 0x86, 4, None, 0xFFFFFFFF, formatter=dateTimeFormatter)
-		defType("duration_msec", 0x86, 4, None, 0xFFFFFFFF, formatter=msecFormatter)
-		defType("distance_cm", 0x86, 4, None, 0xFFFFFFFF, formatter=cmFormatter)
-		defType("mmPerSec", 0x84, 2, None, 0xFFFF, formatter=mmPerSecFormatter)
-		defType("semicircles", 0x85, 4, None, 0x7FFFFFFF, formatter=semicirclesFormatter)
-		defType("altitude", 0x84, 2, None, 0xFFFF, formatter=altitudeFormatter)
-		defType("version", 0x84, 2, None, 0xFFFF, formatter=versionFormatter)
+		defType("date_time", 0x86, 4, "I", 0xFFFFFFFF, formatter=dateTimeFormatter, parser=dateTimeParser)
+		defType("duration_msec", 0x86, 4, "I", 0xFFFFFFFF, formatter=msecFormatter, parser=msecParser)
+		defType("distance_cm", 0x86, 4, "I", 0xFFFFFFFF, formatter=cmFormatter, parser=cmParser)
+		defType("mmPerSec", 0x84, 2, "H", 0xFFFF, formatter=mmPerSecFormatter, parser=mmPerSecParser)
+		defType("semicircles", 0x85, 4, "i", 0x7FFFFFFF, formatter=semicirclesFormatter, parser=semicirclesParser)
+		defType("altitude", 0x84, 2, "H", 0xFFFF, formatter=altitudeFormatter, parser=altitudeParser)
+		defType("version", 0x84, 2, "H", 0xFFFF, formatter=versionFormatter, parser=versionParser)
 
 		def defMsg(name, *args):
 			self._messageTemplates[name] = FITMessageTemplate(name, *args)
@@ -271,11 +335,17 @@ class FITMessageGenerator:
 
 	def _write(self, contents):
 		self._result.append(contents)
+		self._crc = FITCRC.Update(self._crc, contents)
 
 	def GetResult(self):
 		return b''.join(self._result)
 
+	def GetCRC(self):
+		# Of everything written so far - the header goes in front later, so it's combined in then
+		return self._crc
+
 	def _defineMessage(self, local_no, global_message, field_names):
+		# Returns the new local message type, and the definition message that needs writing before it's used
 		assert local_no < 16 and local_no >= 0
 		if set(field_names) - set(global_message.FieldNameList):
 			raise ValueError("Attempting to use undefined fields %s" % (set(field_names) - set(global_message.FieldNameList)))
@@ -294,71 +364,254 @@ class FITMessageGenerator:
 				field_type = self._types[field["Type"]]
 				pack_tuple += (field["Number"], field_type.Size, field_type.TypeField)
 				local_fields[field_name] = field
-		self._definitions[local_no] = FITMessageTemplate(global_message.Name, local_no, local_fields)
-		self._write(struct.pack("<BBBHB" + ("BBB" * field_count), *pack_tuple))
-		return self._definitions[local_no]
-
-
-	def GenerateMessage(self, name, **kwargs):
-		globalDefn = self._messageTemplates[name]
-
-		# Create a subset of the global message's fields
-		localFieldNamesSet = set()
-		for fieldName in kwargs:
-			localFieldNamesSet.add(fieldName)
-
-		# I'll look at this later
-		compressTS = False
-
-		# Are these fields covered by an existing local message type?
-		active_definition = None
-		for defn_n in self._definitions:
-			defn = self._definitions[defn_n]
-			if defn.Name == name:
-				if defn.FieldNameSet == localFieldNamesSet:
-					active_definition = defn
-
-		# If not, create a new local message type with these fields
-		if not active_definition:
-			active_definition_no = len(self._definitions)
-			active_definition = self._defineMessage(active_definition_no, globalDefn, localFieldNamesSet)
-
-		if compressTS and active_definition.Number > 3:
-			raise Exception("Can't use compressed timestamp when local message number > 3")
-
-		messageHeader = 0
-		if compressTS:
-			messageHeader = messageHeader | (1 << 7)
-			tsOffsetVal = -1 # TODO
-			messageHeader = messageHeader | (active_definition.Number << 4)
+		definition = FITMessageTemplate(global_message.Name, local_no, local_fields)
+		# Compiled once here, rather than packing field-by-field for every message
+		definition.FieldTypes = [(field_name, self._types[definition.Fields[field_name]["Type"]]) for field_name in definition.FieldNameList]
+		definition.Struct = struct.Struct("<B" + "".join(field_type.PackFormat for field_name, field_type in definition.FieldTypes))
+		definition.Values = self._compileValues(definition)
+		self._definitions[local_no] = definition
+		return definition, struct.pack("<BBBHB" + ("BBB" * field_count), *pack_tuple)
+
+	def _resolveDefinition(self, name, field_names, compressed=False):
+		# Are these fields covered by an existing local message type? If not, create a new one with these fields
+		# Compressed timestamp messages leave the timestamp out of the definition, and are limited to local message types 0-3
+		key = (name, frozenset(field_names), compressed)
+		active_definition = self._definitionsByFields.get(key)
+		if active_definition:
+			definitionMessage = b''
 		else:
-			messageHeader = messageHeader | active_definition.Number
-
-		packResult = [struct.pack("<B", messageHeader)]
-		for field_name in active_definition.FieldNameList:
-			field = active_definition.Fields[field_name]
-			field_type = self._types[field["Type"]]
+			local_no = self._allocateLocalMessageType(range(4) if compressed else range(16))
+			active_definition, definitionMessage = self._defineMessage(local_no, self._messageTemplates[name], field_names)
+			active_definition.Key = key
+			self._definitionsByFields[key] = active_definition
+		self._messageCount += 1
+		self._localMessageTypeUses[active_definition.Number] = self._messageCount
+		return active_definition, definitionMessage
+
+	def _allocateLocalMessageType(self, candidates):
+		# Lowest unused, otherwise whichever was least recently used gets redefined
+		for local_no in candidates:
+			if local_no not in self._definitions:
+				return local_no
+		local_no = min(candidates, key=lambda x: self._localMessageTypeUses[x])
+		del self._definitionsByFields[self._definitions[local_no].Key]
+		del self._definitions[local_no]
+		return local_no
+
+	def _messageTimestamp(self, name, fields):
+		if fields.get("timestamp") is None or "timestamp" not in self._messageTemplates[name].Fields:
+			return None
+		return self._types["date_time"].Formatter(fields["timestamp"])
+
+	def _valueConverter(self, field_type):
+		# Whatever turns a field's value into what its PackFormat takes - worked out once per type, not per value
+		if field_type.Formatter:
+			return field_type.Formatter
+		invalid = field_type.InvalidValue
+		if field_type.PackFormat in ["B","b", "H", "h", "I", "i"]:
+			return lambda value: invalid if value is None else round(value)
+		return lambda value: invalid if value is None else value
+
+	def _compileValues(self, definition):
+		# Returns a function taking a message's fields to the values for definition.Struct, in order
+		# Same result as _messageValues, minus all the per-field decisions
+		field_names = [field_name for field_name, field_type in definition.FieldTypes]
+		converters = [self._valueConverter(field_type) for field_name, field_type in definition.FieldTypes]
+		if not field_names:
+			return lambda fields: ()
+		if len(field_names) == 1:
+			field_name, converter = field_names[0], converters[0]
+			return lambda fields: (converter(fields[field_name]),)
+		getter = operator.itemgetter(*field_names)
+		return lambda fields: [convert(value) for convert, value in zip(converters, getter(fields))]
+
+	def _messageValues(self, definition, fields):
+		# The slow way - only used to find which field it was, when definition.Values fails
+		values = []
+		for field_name, field_type in definition.FieldTypes:
+			value = fields[field_name]
 			try:
 				if field_type.Formatter:
-					result = field_type.Formatter(kwargs[field_name])
-				else:
-					sanitized_value = kwargs[field_name]
-					if sanitized_value is None:
-						result = struct.pack("<" + field_type.PackFormat, field_type.InvalidValue)
-					else:
-						if field_type.PackFormat in ["B","b", "H", "h", "I", "i"]:
-							sanitized_value = round(sanitized_value)
-						try:
-							result = struct.pack("<" + field_type.PackFormat, sanitized_value)
-						except struct.error as e: # I guess more specific exception types were too much to ask for.
-							if "<=" in str(e) or "out of range" in str(e):
-								result = struct.pack("<" + field_type.PackFormat, field_type.InvalidValue)
-							else:
-								raise
+					value = field_type.Formatter(value)
+				elif value is None:
+					value = field_type.InvalidValue
+				elif field_type.PackFormat in ["B","b", "H", "h", "I", "i"]:
+					value = round(value)
 			except Exception as e:
-				raise Exception("Failed packing %s=%s - %s" % (field_name, kwargs[field_name], e))
+				raise Exception("Failed packing %s=%s - %s" % (field_name, fields[field_name], e))
+			values.append(value)
+		return values
+
+	def _packFields(self, definition, fields, values):
+		# The slow way, for when something didn't fit - out of range values are dropped, unless they came from a formatter
+		packResult = []
+		for (field_name, field_type), value in zip(definition.FieldTypes, values):
+			try:
+				result = struct.pack("<" + field_type.PackFormat, value)
+			except struct.error as e: # I guess more specific exception types were too much to ask for.
+				if not field_type.Formatter and ("<=" in str(e) or "out of range" in str(e)):
+					result = struct.pack("<" + field_type.PackFormat, field_type.InvalidValue)
+				else:
+					raise Exception("Failed packing %s=%s - %s" % (field_name, fields[field_name], e))
 			packResult.append(result)
-		self._write(b''.join(packResult))
+		return b''.join(packResult)
+
+	def _packMessageInto(self, buffer, offset, messageHeader, definition, fields):
+		try:
+			values = definition.Values(fields)
+		except Exception:
+			values = self._messageValues(definition, fields) # To say which field it was
+		try:
+			definition.Struct.pack_into(buffer, offset, messageHeader, *values)
+		except struct.error:
+			buffer[offset:offset + definition.Struct.size] = struct.pack("<B", messageHeader) + self._packFields(definition, fields, values)
+
+	def GenerateMessage(self, name, compress_timestamp=False, **kwargs):
+		self.GenerateMessages(name, [kwargs], compress_timestamp=compress_timestamp)
+
+	def GenerateMessages(self, name, messages, compress_timestamp=False):
+		""" The same as GenerateMessage for each of messages (dicts of fields) in turn, but packed into one buffer - for records, mostly
+			With compress_timestamp, messages that come within 31 seconds of the one before get the timestamp squeezed into their header, rather than a field of its own
+		"""
+		# Any new local message types are defined up front, so the buffer can be allocated in one go
+		resolved = []
+		size = 0
+		for fields in messages:
+			timestamp = self._messageTimestamp(name, fields)
+			if compress_timestamp and timestamp is not None and self._lastTimestamp is not None and 0 <= timestamp - self._lastTimestamp <= 31:
+				# The low 5 bits go in the header, and the reader works the rest out from the last timestamp
+				definition, definitionMessage = self._resolveDefinition(name, [x for x in fields.keys() if x != "timestamp"], compressed=True)
+				messageHeader = 0x80 | (definition.Number << 5) | (timestamp & 0x1F)
+			else:
+				definition, definitionMessage = self._resolveDefinition(name, fields.keys())
+				messageHeader = definition.Number
+			if timestamp is not None:
+				self._lastTimestamp = timestamp
+			resolved.append((definition, definitionMessage, messageHeader, fields))
+			size += len(definitionMessage) + definition.Struct.size
+
+		buffer = bytearray(size)
+		offset = 0
+		for definition, definitionMessage, messageHeader, fields in resolved:
+			if definitionMessage:
+				buffer[offset:offset + len(definitionMessage)] = definitionMessage
+				offset += len(definitionMessage)
+			try:
+				definition.Struct.pack_into(buffer, offset, messageHeader, *definition.Values(fields))
+			except Exception:
+				self._packMessageInto(buffer, offset, messageHeader, definition, fields) # Sorts out out-of-range values, or says what went wrong
+			offset += definition.Struct.size
+		self._write(buffer)
+
+
+class FITLocalDefinition:
+	def __init__(self, template, packer, fields, timestampIndex):
+		self.Template = template # None for messages we don't know about - they're only read for their timestamps
+		self.Struct = packer
+		self.Fields = fields # (name, FITMessageDataType from the profile, FITMessageDataType of the base type in the file) for each value the Struct unpacks
+		self.TimestampIndex = timestampIndex
+
+
+class FITMessageParser:
+	""" The other direction - reads messages out of a FIT file one at a time, straight from the buffer it's handed (bytes, bytearray, mmap...) via a memoryview, so nothing gets copied along the way.
+		Only the messages & fields in FITMessageGenerator's profile are returned - everything else is skipped over.
+	"""
+	def __init__(self):
+		profile = FITMessageGenerator()
+		self._baseTypes = dict((x.TypeField & 0x1F, x) for x in profile._types.values() if x.PackFormat and not x.Formatter)
+		self._types = profile._types
+		self._messageTemplates = dict((x.Number, x) for x in profile._messageTemplates.values())
+		self._messageFields = dict((x.Number, dict((field["Number"], field) for field in x.Fields.values())) for x in profile._messageTemplates.values())
+		self._definitions = {}
+
+	def Messages(self, raw_file):
+		""" Yields (message name, {field name: value}) for each message, in order """
+		view = memoryview(raw_file)
+		if len(view) < 12:
+			raise ValueError("FIT file too short")
+		header_len, protocolVer, profileVer, dataLength, tag = struct.unpack_from("<BBHI4s", view, 0)
+		if tag != b".FIT":
+			raise ValueError("Not a FIT file")
+		offset = header_len
+		end = min(header_len + dataLength, len(view))
+		lastTimestamp = None
+		while offset < end:
+			messageHeader = view[offset]
+			offset += 1
+			timestamp = None
+			if messageHeader & 0x80:
+				# Compressed timestamp header - the low 5 bits of the time, relative to the last full timestamp
+				definition = self._definitions[(messageHeader >> 5) & 0x3]
+				if lastTimestamp is None:
+					raise ValueError("Compressed timestamp with no timestamp to go on")
+				timeOffset = messageHeader & 0x1F
+				timestamp = (lastTimestamp & ~0x1F) + timeOffset
+				if timeOffset < (lastTimestamp & 0x1F):
+					timestamp += 0x20 # Rolled over
+				lastTimestamp = timestamp
+			elif messageHeader & 0x40:
+				offset = self._readDefinition(view, offset, messageHeader & 0xF, messageHeader & 0x20)
+				continue
+			else:
+				definition = self._definitions[messageHeader & 0xF]
+
+			values = definition.Struct.unpack_from(view, offset)
+			offset += definition.Struct.size
+			if definition.TimestampIndex is not None and values[definition.TimestampIndex] != 0xFFFFFFFF:
+				lastTimestamp = values[definition.TimestampIndex]
+			if not definition.Template:
+				continue
+
+			fields = {}
+			for (name, fieldType, baseType), value in zip(definition.Fields, values):
+				if value == baseType.InvalidValue or value != value: # NaN is the invalid value for floats
+					value = None
+				elif fieldType.Parser:
+					value = fieldType.Parser(value)
+				fields[name] = value
+			if timestamp is not None:
+				fields["timestamp"] = self._types["date_time"].Parser(timestamp)
+			yield definition.Template.Name, fields
+
+	def _readDefinition(self, view, offset, local_no, hasDeveloperFields):
+		reserved, arch = struct.unpack_from("<BB", view, offset)
+		endian = ">" if arch == 1 else "<"
+		global_no, field_count = struct.unpack_from(endian + "HB", view, offset + 2)
+		offset += 5
+		template = self._messageTemplates.get(global_no)
+		templateFields = self._messageFields.get(global_no, {})
+
+		packFormat = endian
+		fields = []
+		timestampIndex = None
+		for x in range(field_count):
+			field_no, size, base_type = struct.unpack_from("<BBB", view, offset)
+			offset += 3
+			baseType = self._baseTypes.get(base_type & 0x1F)
+			if not baseType or baseType.Size != size: # Strings, arrays, and the like
+				packFormat += "%dx" % size
+				continue
+			if template and field_no in templateFields:
+				field = (templateFields[field_no]["Name"], self._types[templateFields[field_no]["Type"]], baseType)
+			elif field_no == 253 and size == 4:
+				field = ("timestamp", self._types["date_time"], baseType) # Needed to keep track of time for compressed timestamps, if nothing else
+			else:
+				packFormat += "%dx" % size
+				continue
+			if field_no == 253 and size == 4:
+				timestampIndex = len(fields)
+			fields.append(field)
+			packFormat += baseType.PackFormat
+
+		if hasDeveloperFields:
+			developer_field_count = view[offset]
+			offset += 1
+			for x in range(developer_field_count):
+				packFormat += "%dx" % view[offset + 1]
+				offset += 3
+
+		self._definitions[local_no] = FITLocalDefinition(template, struct.Struct(packFormat), fields, timestampIndex)
+		return offset
 
 
 class FITIO:
@@ -374,17 +627,33 @@ class FITIO:
 	_subSportMap = {
 		# ActivityType.MountainBiking: 8 there's an issue with cadence upload and this type with GC, so...
 	}
+	_reverseSportMap = {
+		0: ActivityType.Other,
+		1: ActivityType.Running,
+		2: ActivityType.Cycling,
+		4: ActivityType.Elliptical,
+		5: ActivityType.Swimming,
+	}
+	_lapIntensityMap = {
+		LapIntensity.Active: FITLapIntensity.Active,
+		LapIntensity.Rest: FITLapIntensity.Rest,
+		LapIntensity.Warmup: FITLapIntensity.Warmup,
+		LapIntensity.Cooldown: FITLapIntensity.Cooldown,
+	}
+	_lapTriggerMap = {
+		LapTriggerMethod.Manual: FITLapTriggerMethod.Manual,
+		LapTriggerMethod.Time: FITLapTriggerMethod.Time,
+		LapTriggerMethod.Distance: FITLapTriggerMethod.Distance,
+		LapTriggerMethod.PositionStart: FITLapTriggerMethod.PositionStart,
+		LapTriggerMethod.PositionLap: FITLapTriggerMethod.PositionLap,
+		LapTriggerMethod.PositionWaypoint: FITLapTriggerMethod.PositionWaypoint,
+		LapTriggerMethod.PositionMarked: FITLapTriggerMethod.PositionMarked,
+		LapTriggerMethod.SessionEnd: FITLapTriggerMethod.SessionEnd,
+		LapTriggerMethod.FitnessEquipment: FITLapTriggerMethod.FitnessEquipment,
+	}
+	_runCadenceTypes = [ActivityType.Running, ActivityType.Walking, ActivityType.Hiking]
 	def _calculateCRC(bytestring, crc=0):
-		crc_table = [0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401, 0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400]
-		for byte in bytestring:
-			tmp = crc_table[crc & 0xF]
-			crc = (crc >> 4) & 0x0FFF
-			crc = crc ^ tmp ^ crc_table[byte & 0xF]
-
-			tmp = crc_table[crc & 0xF]
-			crc = (crc >> 4) & 0x0FFF
-			crc = crc ^ tmp ^ crc_table[(byte >> 4) & 0xF]
-		return crc
+		return FITCRC.Update(crc, bytestring)
 
 	def _generateHeader(dataLength):
 		# We need to call this once the final records are assembled and their length is known, to avoid having to seek back
@@ -394,13 +663,116 @@ class FITIO:
 		tag = ".FIT"
 		return struct.pack("<BBHI4s", header_len, protocolVer, profileVer, dataLength, tag.encode("ASCII"))
 
-	def Parse(raw_file):
-		raise Exception("Not implemented")
+	def _parseStats(fields, stats):
+		# Cadence goes in Cadence for now - it's moved to RunCadence at the end, once we know what sort of activity this is
+		def _stat(key):
+			return fields.get(key)
+		stats.MovingTime = ActivityStatistic(ActivityStatisticUnit.Seconds, value=_stat("total_moving_time"))
+		stats.TimerTime = ActivityStatistic(ActivityStatisticUnit.Seconds, value=_stat("total_timer_time"))
+		stats.Distance = ActivityStatistic(ActivityStatisticUnit.Meters, value=_stat("total_distance"))
+		stats.Energy = ActivityStatistic(ActivityStatisticUnit.Kilocalories, value=_stat("total_calories"))
+		stats.Speed = ActivityStatistic(ActivityStatisticUnit.MetersPerSecond, avg=_stat("avg_speed"), max=_stat("max_speed"))
+		stats.HR = ActivityStatistic(ActivityStatisticUnit.BeatsPerMinute, avg=_stat("avg_heart_rate"), max=_stat("max_heart_rate"))
+		stats.Cadence = ActivityStatistic(ActivityStatisticUnit.RevolutionsPerMinute, avg=_stat("avg_cadence"), max=_stat("max_cadence"))
+		stats.Power = ActivityStatistic(ActivityStatisticUnit.Watts, avg=_stat("avg_power"), max=_stat("max_power"))
+		stats.Elevation = ActivityStatistic(ActivityStatisticUnit.Meters, avg=_stat("avg_altitude"), max=_stat("max_altitude"), min=_stat("min_altitude"), gain=_stat("total_ascent"), loss=_stat("total_descent"))
+		stats.Temperature = ActivityStatistic(ActivityStatisticUnit.DegreesCelcius, avg=_stat("avg_temperature"), max=_stat("max_temperature"))
+
+	def Parse(raw_file, act=None):
+		""" raw_file can be anything supporting the buffer protocol - bytes, bytearray, mmap... - it's decoded in place, a message at a time """
+		act = act if act else Activity()
+
+		waypoints = [] # Since the last lap message - which comes after its records
+		inPause = False
+		resuming = False
+		utcOffset = None
+		deviceInfo = {}
+		for name, fields in FITMessageParser().Messages(raw_file):
+			if name == "record":
+				wp = Waypoint(timestamp=fields.get("timestamp"))
+				if inPause:
+					wp.Type = WaypointType.Pause
+				elif resuming:
+					wp.Type = WaypointType.Resume
+					resuming = False
+				if fields.get("position_lat") is not None and fields.get("position_long") is not None:
+					wp.Location = Location(fields["position_lat"], fields["position_long"], fields.get("altitude"))
+				wp.HR = fields.get("heart_rate")
+				wp.Cadence = fields.get("cadence")
+				wp.Power = fields.get("power")
+				wp.Temp = fields.get("temperature")
+				wp.Calories = fields.get("calories")
+				wp.Distance = fields.get("distance")
+				wp.Speed = fields.get("speed")
+				waypoints.append(wp)
+			elif name == "event":
+				if fields.get("event") == FITEvent.Timer:
+					if fields.get("event_type") == FITEventType.Stop:
+						inPause = True
+					elif fields.get("event_type") == FITEventType.Start and inPause:
+						inPause = False
+						resuming = True
+			elif name == "lap":
+				lap = Lap(startTime=fields.get("start_time"), endTime=fields.get("timestamp"))
+				lap.Intensity = dict((v, k) for k, v in FITIO._lapIntensityMap.items()).get(fields.get("intensity"), LapIntensity.Active)
+				lap.Trigger = dict((v, k) for k, v in FITIO._lapTriggerMap.items()).get(fields.get("lap_trigger"), LapTriggerMethod.Manual)
+				FITIO._parseStats(fields, lap.Stats)
+				lap.Waypoints = waypoints
+				waypoints = []
+				if lap.StartTime is None and lap.Waypoints:
+					lap.StartTime = lap.Waypoints[0].Timestamp
+				if lap.EndTime is None and lap.Waypoints:
+					lap.EndTime = lap.Waypoints[-1].Timestamp
+				act.Laps.append(lap)
+			elif name == "session":
+				act.StartTime = fields.get("start_time")
+				act.EndTime = fields.get("timestamp")
+				if not act.Type or act.Type == ActivityType.Other:
+					act.Type = FITIO._reverseSportMap.get(fields.get("sport"), ActivityType.Other)
+				FITIO._parseStats(fields, act.Stats)
+			elif name == "activity":
+				if fields.get("local_timestamp") and fields.get("timestamp"):
+					# The local timestamp's written as if it were UTC
+					utcOffset = fields["local_timestamp"] - fields["timestamp"]
+			elif name in ("file_id", "device_info"):
+				if name == "device_info" and fields.get("device_index"):
+					continue # Some sensor or other
+				deviceInfo.update((k, v) for k, v in fields.items() if v is not None)
+
+		if waypoints:
+			# Records after the last lap (or with no laps at all)
+			if act.Laps:
+				act.Laps[-1].Waypoints += waypoints
+			else:
+				act.Laps.append(Lap(startTime=waypoints[0].Timestamp, endTime=waypoints[-1].Timestamp, waypointList=waypoints))
+		if act.Laps:
+			act.StartTime = act.StartTime if act.StartTime else act.Laps[0].StartTime
+			act.EndTime = act.EndTime if act.EndTime else act.Laps[-1].EndTime
+
+		if act.Type in FITIO._runCadenceTypes:
+			for stats in [act.Stats] + [lap.Stats for lap in act.Laps]:
+				stats.RunCadence = ActivityStatistic(ActivityStatisticUnit.StepsPerMinute, avg=stats.Cadence.Average, max=stats.Cadence.Max)
+				stats.Cadence = ActivityStatistic(ActivityStatisticUnit.RevolutionsPerMinute)
+			for lap in act.Laps:
+				for wp in lap.Waypoints:
+					wp.RunCadence = wp.Cadence
+					wp.Cadence = None
+
+		if "manufacturer" in deviceInfo and "product" in deviceInfo:
+			devId = DeviceIdentifier.FindMatchingIdentifierOfType(DeviceIdentifierType.FIT, {"Manufacturer": deviceInfo["manufacturer"], "Product": deviceInfo["product"]})
+			if devId:
+				version = deviceInfo.get("software_version")
+				act.Device = Device(devId, deviceInfo.get("serial_number"), verMaj=int(version) if version is not None else None, verMin=round(version * 100) % 100 if version is not None else None)
+
+		if utcOffset is not None and act.StartTime:
+			act.TZ = pytz.FixedOffset(round(utcOffset.total_seconds() / 60))
+			act.AdjustTZ()
+		return act
 
 	def Dump(act):
 		def toUtc(ts):
 			if ts.tzinfo:
-				return ts.astimezone(pytz.utc).replace(tzinfo=None)
+				return ts.replace(tzinfo=None) - ts.utcoffset() # Same as astimezone(pytz.utc), but there's one of these per waypoint
 			else:
 				raise ValueError("Need TZ data to produce FIT file")
 		fmg = FITMessageGenerator()
@@ -447,7 +819,7 @@ class FITIO:
 
 		# FIT doesn't have different fields for this, but it does have a different interpretation - we eventually need to divide by two in the running case.
 		# Further complicating the issue is that most sites don't differentiate the two, so they'll end up putting the run cadence back into the bike field.
-		use_run_cadence = act.Type in [ActivityType.Running, ActivityType.Walking, ActivityType.Hiking]
+		use_run_cadence = act.Type in FITIO._runCadenceTypes
 		def _resolveRunCadence(bikeCad, runCad):
 			nonlocal use_run_cadence
 			if use_run_cadence:
@@ -481,7 +853,12 @@ class FITIO:
 
 		inPause = False
 		for lap in act.Laps:
+			# Records are packed in batches, between the events that need to go in amongst them
+			pendingRecords = []
 			for wp in lap.Waypoints:
+				if (wp.Type == WaypointType.Resume and inPause) or (wp.Type == WaypointType.Pause and not inPause):
+					fmg.GenerateMessages("record", pendingRecords, compress_timestamp=True)
+					pendingRecords = []
 				if wp.Type == WaypointType.Resume and inPause:
 					fmg.GenerateMessage("event", timestamp=toUtc(wp.Timestamp), event=FITEvent.Timer, event_type=FITEventType.Start)
 					inPause = False
@@ -491,26 +868,28 @@ class FITIO:
 
 				rec_contents = {"timestamp": toUtc(wp.Timestamp)}
 				if wp.Location:
-					rec_contents.update({"position_lat": wp.Location.Latitude, "position_long": wp.Location.Longitude})
+					rec_contents["position_lat"] = wp.Location.Latitude
+					rec_contents["position_long"] = wp.Location.Longitude
 					if wp.Location.Altitude is not None:
-						rec_contents.update({"altitude": wp.Location.Altitude})
+						rec_contents["altitude"] = wp.Location.Altitude
 				if wp.HR is not None:
-					rec_contents.update({"heart_rate": wp.HR})
+					rec_contents["heart_rate"] = wp.HR
 				if wp.RunCadence is not None:
-					rec_contents.update({"cadence": wp.RunCadence})
+					rec_contents["cadence"] = wp.RunCadence
 				if wp.Cadence is not None:
-					rec_contents.update({"cadence": wp.Cadence})
+					rec_contents["cadence"] = wp.Cadence
 				if wp.Power is not None:
-					rec_contents.update({"power": wp.Power})
+					rec_contents["power"] = wp.Power
 				if wp.Temp is not None:
-					rec_contents.update({"temperature": wp.Temp})
+					rec_contents["temperature"] = wp.Temp
 				if wp.Calories is not None:
-					rec_contents.update({"calories": wp.Calories})
+					rec_contents["calories"] = wp.Calories
 				if wp.Distance is not None:
-					rec_contents.update({"distance": wp.Distance})
+					rec_contents["distance"] = wp.Distance
 				if wp.Speed is not None:
-					rec_contents.update({"speed": wp.Speed})
-				fmg.GenerateMessage("record", **rec_contents)
+					rec_contents["speed"] = wp.Speed
+				pendingRecords.append(rec_contents)
+			fmg.GenerateMessages("record", pendingRecords, compress_timestamp=True)
 			# Man, I love copy + paste and multi-cursor editing
 			# But seriously, I'm betting that, some time down the road, a stat will pop up in X but not in Y, so I won't feel so bad about the C&P abuse
 			lap_stats = {}
@@ -537,23 +916,8 @@ class FITIO:
 
 			# These are some really... stupid lookups.
 			# Oh well, futureproofing.
-			lap_stats["intensity"] = ({
-					LapIntensity.Active: FITLapIntensity.Active,
-					LapIntensity.Rest: FITLapIntensity.Rest,
-					LapIntensity.Warmup: FITLapIntensity.Warmup,
-					LapIntensity.Cooldown: FITLapIntensity.Cooldown,
-				})[lap.Intensity]
-			lap_stats["lap_trigger"] = ({
-					LapTriggerMethod.Manual: FITLapTriggerMethod.Manual,
-					LapTriggerMethod.Time: FITLapTriggerMethod.Time,
-					LapTriggerMethod.Distance: FITLapTriggerMethod.Distance,
-					LapTriggerMethod.PositionStart: FITLapTriggerMethod.PositionStart,
-					LapTriggerMethod.PositionLap: FITLapTriggerMethod.PositionLap,
-					LapTriggerMethod.PositionWaypoint: FITLapTriggerMethod.PositionWaypoint,
-					LapTriggerMethod.PositionMarked: FITLapTriggerMethod.PositionMarked,
-					LapTriggerMethod.SessionEnd: FITLapTriggerMethod.SessionEnd,
-					LapTriggerMethod.FitnessEquipment: FITLapTriggerMethod.FitnessEquipment,
-				})[lap.Trigger]
+			lap_stats["intensity"] = FITIO._lapIntensityMap[lap.Intensity]
+			lap_stats["lap_trigger"] = FITIO._lapTriggerMap[lap.Trigger]
 			fmg.GenerateMessage("lap", timestamp=toUtc(lap.EndTime), start_time=toUtc(lap.StartTime), event=FITEvent.Lap, event_type=FITEventType.Start, sport=sport, **lap_stats)
 
 
@@ -563,5 +927,5 @@ class FITIO:
 
 		records = fmg.GetResult()
 		header = FITIO._generateHeader(len(records))
-		crc = FITIO._calculateCRC(records, FITIO._calculateCRC(header))
+		crc = FITCRC.Combine(FITIO._calculateCRC(header), fmg.GetCRC(), len(records))
 		return header + records + struct.pack("<H", crc)
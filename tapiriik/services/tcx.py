@@ -1,6 +1,8 @@
 from lxml import etree
 from pytz import UTC
+from contextlib import ExitStack
 import copy
+import io
 import dateutil.parser
 from datetime import timedelta
 from .interchange import WaypointType, Activity, ActivityStatistic, ActivityStatistics, ActivityStatisticUnit, ActivityType, Waypoint, Location, Lap, LapIntensity, LapTriggerMethod
@@ -224,152 +226,170 @@ class TCXIO:
         act.CalculateUID()
         return act
 
-    def Dump(activity):
-
-        root = etree.Element("TrainingCenterDatabase", nsmap=TCXIO.Namespaces)
-        activities = etree.SubElement(root, "Activities")
-        act = etree.SubElement(activities, "Activity")
-
-
-        author = etree.SubElement(root, "Author")
-        author.attrib["{" + TCXIO.Namespaces["xsi"] + "}type"] = "Application_t"
-        etree.SubElement(author, "Name").text = "tapiriik"
-        build = etree.SubElement(author, "Build")
-        version = etree.SubElement(build, "Version")
-        etree.SubElement(version, "VersionMajor").text = "0"
-        etree.SubElement(version, "VersionMinor").text = "0"
-        etree.SubElement(version, "BuildMajor").text = "0"
-        etree.SubElement(version, "BuildMinor").text = "0"
-        etree.SubElement(author, "LangID").text = "en"
-        etree.SubElement(author, "PartNumber").text = "000-00000-00"
+    def Dump(activity, output=None):
+        # Written out as we go with etree.xmlfile, so there's never more than one trackpoint in memory
+        # With output (a binary file-like object) it's written there, otherwise it's returned as a string
+        if output is None:
+            output = io.BytesIO()
+            TCXIO.Dump(activity, output)
+            return output.getvalue().decode("UTF-8")
 
         dateFormat = "%Y-%m-%dT%H:%M:%S.000Z"
 
-        if activity.Name is not None:
-            etree.SubElement(act, "Notes").text = activity.Name
-
-        if activity.Type == ActivityType.Cycling:
-            act.attrib["Sport"] = "Biking"
-        elif activity.Type == ActivityType.Running:
-            act.attrib["Sport"] = "Running"
-        else:
-            act.attrib["Sport"] = "Other"
-
-        etree.SubElement(act, "Id").text = activity.StartTime.astimezone(UTC).strftime(dateFormat)
-
-        def _writeStat(parent, elName, value, wrapValue=False, naturalValue=False, default=None):
-                if value is not None or default is not None:
-                    xstat = etree.SubElement(parent, elName)
-                    if wrapValue:
-                        xstat = etree.SubElement(xstat, "Value")
-                    value = value if value is not None else default
-                    xstat.text = str(value) if not naturalValue else str(int(value))
-
-        xlaps = []
-        for lap in activity.Laps:
-            xlap = etree.SubElement(act, "Lap")
-            xlaps.append(xlap)
-
-            xlap.attrib["StartTime"] = lap.StartTime.astimezone(UTC).strftime(dateFormat)
-
-            _writeStat(xlap, "TotalTimeSeconds", lap.Stats.TimerTime.asUnits(ActivityStatisticUnit.Seconds).Value if lap.Stats.TimerTime.Value else None, default=(lap.EndTime - lap.StartTime).total_seconds())
-            _writeStat(xlap, "DistanceMeters", lap.Stats.Distance.asUnits(ActivityStatisticUnit.Meters).Value)
-            _writeStat(xlap, "MaximumSpeed", lap.Stats.Speed.asUnits(ActivityStatisticUnit.MetersPerSecond).Max)
-            _writeStat(xlap, "Calories", lap.Stats.Energy.asUnits(ActivityStatisticUnit.Kilocalories).Value, default=0, naturalValue=True)
-            _writeStat(xlap, "AverageHeartRateBpm", lap.Stats.HR.Average, naturalValue=True, wrapValue=True)
-            _writeStat(xlap, "MaximumHeartRateBpm", lap.Stats.HR.Max, naturalValue=True, wrapValue=True)
-
-            etree.SubElement(xlap, "Intensity").text = "Resting" if lap.Intensity == LapIntensity.Rest else "Active"
-
-            _writeStat(xlap, "Cadence", lap.Stats.Cadence.Average, naturalValue=True)
-
-            etree.SubElement(xlap, "TriggerMethod").text = ({
-                LapTriggerMethod.Manual: "Manual",
-                LapTriggerMethod.Distance: "Distance",
-                LapTriggerMethod.PositionMarked: "Location",
-                LapTriggerMethod.Time: "Time",
-                LapTriggerMethod.PositionStart: "Location",
-                LapTriggerMethod.PositionLap: "Location",
-                LapTriggerMethod.PositionMarked: "Location",
-                LapTriggerMethod.SessionEnd: "Manual",
-                LapTriggerMethod.FitnessEquipment: "Manual"
-                })[lap.Trigger]
-
-            if len([x for x in [lap.Stats.Cadence.Max, lap.Stats.RunCadence.Max, lap.Stats.RunCadence.Average, lap.Stats.Strides.Value, lap.Stats.Power.Max, lap.Stats.Power.Average, lap.Stats.Speed.Average] if x is not None]):
-                exts = etree.SubElement(xlap, "Extensions")
-                lapext = etree.SubElement(exts, "LX")
-                lapext.attrib["xmlns"] = "http://www.garmin.com/xmlschemas/ActivityExtension/v2"
-                _writeStat(lapext, "MaxBikeCadence", lap.Stats.Cadence.Max, naturalValue=True)
-                # This dividing-by-two stuff is getting silly
-                _writeStat(lapext, "MaxRunCadence", lap.Stats.RunCadence.Max if lap.Stats.RunCadence.Max is not None else None, naturalValue=True)
-                _writeStat(lapext, "AvgRunCadence", lap.Stats.RunCadence.Average if lap.Stats.RunCadence.Average is not None else None, naturalValue=True)
-                _writeStat(lapext, "Steps", lap.Stats.Strides.Value, naturalValue=True)
-                _writeStat(lapext, "MaxWatts", lap.Stats.Power.asUnits(ActivityStatisticUnit.Watts).Max, naturalValue=True)
-                _writeStat(lapext, "AvgWatts", lap.Stats.Power.asUnits(ActivityStatisticUnit.Watts).Average, naturalValue=True)
-                _writeStat(lapext, "AvgSpeed", lap.Stats.Speed.asUnits(ActivityStatisticUnit.MetersPerSecond).Average)
-
-        inPause = False
-        for lap in activity.Laps:
-            xlap = xlaps[activity.Laps.index(lap)]
-            track = None
-            for wp in lap.Waypoints:
-                if wp.Type == WaypointType.Pause:
-                    if inPause:
-                        continue  # this used to be an exception, but I don't think that was merited
-                    inPause = True
-                if inPause and wp.Type != WaypointType.Pause:
-                    inPause = False
-                if track is None:  # Defer creating the track until there are points
-                    track = etree.SubElement(xlap, "Track") # TODO - pauses should create new tracks instead of new laps?
-                trkpt = etree.SubElement(track, "Trackpoint")
-                if wp.Timestamp.tzinfo is None:
-                    raise ValueError("TCX export requires TZ info")
-                etree.SubElement(trkpt, "Time").text = wp.Timestamp.astimezone(UTC).strftime(dateFormat)
-                if wp.Location:
-                    if wp.Location.Latitude is not None and wp.Location.Longitude is not None:
-                        pos = etree.SubElement(trkpt, "Position")
-                        etree.SubElement(pos, "LatitudeDegrees").text = str(wp.Location.Latitude)
-                        etree.SubElement(pos, "LongitudeDegrees").text = str(wp.Location.Longitude)
-
-                    if wp.Location.Altitude is not None:
-                        etree.SubElement(trkpt, "AltitudeMeters").text = str(wp.Location.Altitude)
-
-                if wp.Distance is not None:
-                    etree.SubElement(trkpt, "DistanceMeters").text = str(wp.Distance)
-                if wp.HR is not None:
-                    xhr = etree.SubElement(trkpt, "HeartRateBpm")
-                    xhr.attrib["{" + TCXIO.Namespaces["xsi"] + "}type"] = "HeartRateInBeatsPerMinute_t"
-                    etree.SubElement(xhr, "Value").text = str(int(wp.HR))
-                if wp.Cadence is not None:
-                    etree.SubElement(trkpt, "Cadence").text = str(int(wp.Cadence))
-                if wp.Power is not None or wp.RunCadence is not None or wp.Speed is not None:
-                    exts = etree.SubElement(trkpt, "Extensions")
-                    gpxtpxexts = etree.SubElement(exts, "TPX")
-                    gpxtpxexts.attrib["xmlns"] = "http://www.garmin.com/xmlschemas/ActivityExtension/v2"
-                    if wp.Speed is not None:
-                        etree.SubElement(gpxtpxexts, "Speed").text = str(wp.Speed)
-                    if wp.RunCadence is not None:
-                        etree.SubElement(gpxtpxexts, "RunCadence").text = str(int(wp.RunCadence))
-                    if wp.Power is not None:
-                        etree.SubElement(gpxtpxexts, "Watts").text = str(int(wp.Power))
-            if track is not None:
-                exts = xlap.find("Extensions")
-                if exts is not None:
-                    track.addnext(exts)
-
-        if activity.Device and activity.Device.Identifier:
-            devId = DeviceIdentifier.FindEquivalentIdentifierOfType(DeviceIdentifierType.TCX, activity.Device.Identifier)
-            if devId:
-                xcreator = etree.SubElement(act, "Creator")
-                xcreator.attrib["{" + TCXIO.Namespaces["xsi"] + "}type"] = "Device_t"
-                etree.SubElement(xcreator, "Name").text = devId.Name
-                etree.SubElement(xcreator, "UnitId").text = str(activity.Device.Serial) if activity.Device.Serial else "0"
-                etree.SubElement(xcreator, "ProductID").text = str(devId.ProductID)
-                xver = etree.SubElement(xcreator, "Version")
-                etree.SubElement(xver, "VersionMajor").text = str(activity.Device.VersionMajor) if activity.Device.VersionMajor else "0" # Blegh.
-                etree.SubElement(xver, "VersionMinor").text = str(activity.Device.VersionMinor) if activity.Device.VersionMinor else "0"
-                etree.SubElement(xver, "BuildMajor").text = "0"
-                etree.SubElement(xver, "BuildMinor").text = "0"
-
-
-        return etree.tostring(root, pretty_print=True, xml_declaration=True, encoding="UTF-8").decode("UTF-8")
+        # xmlfile would put the namespace declarations in its own order - so they're spelled out as plain attributes, and xsi: along with them
+        rootAttrib = dict(("xmlns:" + prefix if prefix else "xmlns", ns) for prefix, ns in TCXIO.Namespaces.items())
+        xsiType = "xsi:type"
+
+        with etree.xmlfile(output, encoding="UTF-8") as xf:
+            # Indented as pretty_print would
+            depth = 0
+            indents = ["\n" + "  " * x for x in range(16)]
+            class _element:
+                def __init__(self, tag, attrib=None):
+                    self._element = xf.element(tag, attrib)
+
+                def __enter__(self):
+                    nonlocal depth
+                    if depth:
+                        xf.write(indents[depth])
+                    self._element.__enter__()
+                    depth += 1
+
+                def __exit__(self, *exc):
+                    nonlocal depth
+                    depth -= 1
+                    xf.write(indents[depth])
+                    self._element.__exit__(*exc)
+
+            def _leaf(tag, text, attrib=None):
+                xf.write(indents[depth])
+                with xf.element(tag, attrib):
+                    xf.write(text)
+
+            def _writeStat(elName, value, wrapValue=False, naturalValue=False, default=None):
+                    if value is not None or default is not None:
+                        value = value if value is not None else default
+                        value = str(value) if not naturalValue else str(int(value))
+                        if wrapValue:
+                            with _element(elName):
+                                _leaf("Value", value)
+                        else:
+                            _leaf(elName, value)
+
+            xf.write_declaration()
+            with _element("TrainingCenterDatabase", rootAttrib):
+                with _element("Activities"):
+                    if activity.Type == ActivityType.Cycling:
+                        sport = "Biking"
+                    elif activity.Type == ActivityType.Running:
+                        sport = "Running"
+                    else:
+                        sport = "Other"
+
+                    with _element("Activity", {"Sport": sport}):
+                        if activity.Name is not None:
+                            _leaf("Notes", activity.Name)
+
+                        _leaf("Id", activity.StartTime.astimezone(UTC).strftime(dateFormat))
+
+                        inPause = False
+                        for lap in activity.Laps:
+                            with _element("Lap", {"StartTime": lap.StartTime.astimezone(UTC).strftime(dateFormat)}):
+                                _writeStat("TotalTimeSeconds", lap.Stats.TimerTime.asUnits(ActivityStatisticUnit.Seconds).Value if lap.Stats.TimerTime.Value else None, default=(lap.EndTime - lap.StartTime).total_seconds())
+                                _writeStat("DistanceMeters", lap.Stats.Distance.asUnits(ActivityStatisticUnit.Meters).Value)
+                                _writeStat("MaximumSpeed", lap.Stats.Speed.asUnits(ActivityStatisticUnit.MetersPerSecond).Max)
+                                _writeStat("Calories", lap.Stats.Energy.asUnits(ActivityStatisticUnit.Kilocalories).Value, default=0, naturalValue=True)
+                                _writeStat("AverageHeartRateBpm", lap.Stats.HR.Average, naturalValue=True, wrapValue=True)
+                                _writeStat("MaximumHeartRateBpm", lap.Stats.HR.Max, naturalValue=True, wrapValue=True)
+
+                                _leaf("Intensity", "Resting" if lap.Intensity == LapIntensity.Rest else "Active")
+
+                                _writeStat("Cadence", lap.Stats.Cadence.Average, naturalValue=True)
+
+                                _leaf("TriggerMethod", ({
+                                    LapTriggerMethod.Manual: "Manual",
+                                    LapTriggerMethod.Distance: "Distance",
+                                    LapTriggerMethod.PositionMarked: "Location",
+                                    LapTriggerMethod.Time: "Time",
+                                    LapTriggerMethod.PositionStart: "Location",
+                                    LapTriggerMethod.PositionLap: "Location",
+                                    LapTriggerMethod.PositionMarked: "Location",
+                                    LapTriggerMethod.SessionEnd: "Manual",
+                                    LapTriggerMethod.FitnessEquipment: "Manual"
+                                    })[lap.Trigger])
+
+                                with ExitStack() as track:
+                                    trackOpen = False
+                                    for wp in lap.Waypoints:
+                                        if wp.Type == WaypointType.Pause:
+                                            if inPause:
+                                                continue  # this used to be an exception, but I don't think that was merited
+                                            inPause = True
+                                        if inPause and wp.Type != WaypointType.Pause:
+                                            inPause = False
+                                        if wp.Timestamp.tzinfo is None:
+                                            raise ValueError("TCX export requires TZ info")
+                                        if not trackOpen:  # Defer creating the track until there are points
+                                            track.enter_context(_element("Track")) # TODO - pauses should create new tracks instead of new laps?
+                                            trackOpen = True
+                                        with _element("Trackpoint"):
+                                            _leaf("Time", wp.Timestamp.astimezone(UTC).strftime(dateFormat))
+                                            if wp.Location:
+                                                if wp.Location.Latitude is not None and wp.Location.Longitude is not None:
+                                                    with _element("Position"):
+                                                        _leaf("LatitudeDegrees", str(wp.Location.Latitude))
+                                                        _leaf("LongitudeDegrees", str(wp.Location.Longitude))
+
+                                                if wp.Location.Altitude is not None:
+                                                    _leaf("AltitudeMeters", str(wp.Location.Altitude))
+
+                                            if wp.Distance is not None:
+                                                _leaf("DistanceMeters", str(wp.Distance))
+                                            if wp.HR is not None:
+                                                with _element("HeartRateBpm", {xsiType: "HeartRateInBeatsPerMinute_t"}):
+                                                    _leaf("Value", str(int(wp.HR)))
+                                            if wp.Cadence is not None:
+                                                _leaf("Cadence", str(int(wp.Cadence)))
+                                            if wp.Power is not None or wp.RunCadence is not None or wp.Speed is not None:
+                                                with _element("Extensions"), _element("TPX", {"xmlns": "http://www.garmin.com/xmlschemas/ActivityExtension/v2"}):
+                                                    if wp.Speed is not None:
+                                                        _leaf("Speed", str(wp.Speed))
+                                                    if wp.RunCadence is not None:
+                                                        _leaf("RunCadence", str(int(wp.RunCadence)))
+                                                    if wp.Power is not None:
+                                                        _leaf("Watts", str(int(wp.Power)))
+
+                                if len([x for x in [lap.Stats.Cadence.Max, lap.Stats.RunCadence.Max, lap.Stats.RunCadence.Average, lap.Stats.Strides.Value, lap.Stats.Power.Max, lap.Stats.Power.Average, lap.Stats.Speed.Average] if x is not None]):
+                                    with _element("Extensions"), _element("LX", {"xmlns": "http://www.garmin.com/xmlschemas/ActivityExtension/v2"}):
+                                        _writeStat("MaxBikeCadence", lap.Stats.Cadence.Max, naturalValue=True)
+                                        # This dividing-by-two stuff is getting silly
+                                        _writeStat("MaxRunCadence", lap.Stats.RunCadence.Max if lap.Stats.RunCadence.Max is not None else None, naturalValue=True)
+                                        _writeStat("AvgRunCadence", lap.Stats.RunCadence.Average if lap.Stats.RunCadence.Average is not None else None, naturalValue=True)
+                                        _writeStat("Steps", lap.Stats.Strides.Value, naturalValue=True)
+                                        _writeStat("MaxWatts", lap.Stats.Power.asUnits(ActivityStatisticUnit.Watts).Max, naturalValue=True)
+                                        _writeStat("AvgWatts", lap.Stats.Power.asUnits(ActivityStatisticUnit.Watts).Average, naturalValue=True)
+                                        _writeStat("AvgSpeed", lap.Stats.Speed.asUnits(ActivityStatisticUnit.MetersPerSecond).Average)
+
+                        if activity.Device and activity.Device.Identifier:
+                            devId = DeviceIdentifier.FindEquivalentIdentifierOfType(DeviceIdentifierType.TCX, activity.Device.Identifier)
+                            if devId:
+                                with _element("Creator", {xsiType: "Device_t"}):
+                                    _leaf("Name", devId.Name)
+                                    _leaf("UnitId", str(activity.Device.Serial) if activity.Device.Serial else "0")
+                                    _leaf("ProductID", str(devId.ProductID))
+                                    with _element("Version"):
+                                        _leaf("VersionMajor", str(activity.Device.VersionMajor) if activity.Device.VersionMajor else "0") # Blegh.
+                                        _leaf("VersionMinor", str(activity.Device.VersionMinor) if activity.Device.VersionMinor else "0")
+                                        _leaf("BuildMajor", "0")
+                                        _leaf("BuildMinor", "0")
+
+                with _element("Author", {xsiType: "Application_t"}):
+                    _leaf("Name", "tapiriik")
+                    with _element("Build"), _element("Version"):
+                        _leaf("VersionMajor", "0")
+                        _leaf("VersionMinor", "0")
+                        _leaf("BuildMajor", "0")
+                        _leaf("BuildMinor", "0")
+                    _leaf("LangID", "en")
+                    _leaf("PartNumber", "000-00000-00")
+        output.write(b"\n") # xmlfile won't write anything after the root element
@@ -235,6 +235,82 @@ EMAIL_FILE_PATH = './sent_emails'
 
 WORKER_INDEX = int(os.environ.get("TAPIRIIK_WORKER_INDEX", 0))
 
+# How many of a user's services are listed at once during a sync - 1 lists them one after another
+SYNC_LIST_CONCURRENCY = 1
+
+# How many activities are downloaded ahead of the one being uploaded - 0 waits for each upload to finish before starting the next download
+SYNC_DOWNLOAD_LOOKAHEAD = 0
+# ...and how many waypoints those downloaded-but-not-yet-uploaded activities may hold between them
+SYNC_DOWNLOAD_LOOKAHEAD_WAYPOINTS = 100000
+
+# How many destinations an activity is uploaded to at once - 1 uploads to them one after another
+SYNC_UPLOAD_CONCURRENCY = 1
+
+# Bookkeeping writes made during a sync (uploaded_activities, synchronized_activities, sync_stats) are sent in bulk once this many are waiting...
+SYNC_WRITE_BUFFER_SIZE = 100
+# ...or the oldest has been waiting this many seconds - and always before the user is unlocked
+SYNC_WRITE_BUFFER_INTERVAL = 30
+
+# How many due users a worker claims at once - they're then synchronized one after another
+SYNC_PREFETCH_USERS = 1
+
+# How many users a worker process synchronizes at once, each on its own thread - they spend most of their time waiting on remote services anyways
+SYNC_USER_CONCURRENCY = 1
+
+# How many calls (listing, downloading or uploading) to any one service may be in flight at once, across every sync in the worker process
+SYNC_SERVICE_CONCURRENCY = 4
+
+# Service ID -> minimum seconds between starting calls to that service, again across the whole worker process
+SYNC_SERVICE_CALL_INTERVAL = {}
+
+# Worker children are recycled once their resident memory grows past this many bytes (checked between syncs)
+SYNC_WORKER_MEMORY_BUDGET = 512 * 1024 * 1024
+
+# Trace allocations in sync workers with tracemalloc, keeping this many frames for each - 0 to leave it off, since it slows everything down a fair bit
+SYNC_TRACE_ALLOCATIONS = 0
+
+# Syncs whose traced memory peaks above this many bytes get their top allocation sites recorded in sync_worker_stats
+SYNC_ALLOCATION_OUTLIER_SIZE = 128 * 1024 * 1024
+
+# Heartbeats & sync progress are only written out this often (seconds) - keep it well inside the watchdog's timeouts
+SYNC_STATUS_REPORT_INTERVAL = 5
+
+# How long (seconds) a worker's lock on a user lasts without being renewed - it's renewed along with the status reports, so this needs to be a good few multiples of SYNC_STATUS_REPORT_INTERVAL
+SYNC_LOCK_LEASE = 60
+
+# How due users get to workers:
+#   None - each worker polls db.users for them
+#   "amqp" - sync_dispatcher.py hands them out via RABBITMQ_BROKER_URL, and workers wait on that
+#   "local" - the sync_worker supervisor runs a dispatcher that only feeds its own child's sync threads (for when there's no broker - one sync_worker per host, scaled with SYNC_USER_CONCURRENCY)
+SYNC_DISPATCH_QUEUE = None
+
+# Dispatched users who still haven't been synchronized after this many seconds (e.g. the message was lost) are dispatched again
+SYNC_DISPATCH_REDELIVERY = 600
+
+# Bounds (seconds) on how long paying users wait between regular syncs - the longer they've gone without a new activity (for them), the closer to the upper bound they get
+# Users with a partial sync trigger get the upper bound outright, since the trigger will wake them up sooner if there's anything to do
+SYNC_INTERVAL_MIN = 60 * 60
+SYNC_INTERVAL_MAX = 12 * 60 * 60
+
+# Users are split into this many shards, which are divided between the running workers (by host & WORKER_INDEX - give each worker on a host its own) so they aren't all after the same users
+# 0 turns it off (the default) - try 1024. Changing it is safe enough, but users are only moved to their new shard as they're synchronized
+# Only matters when workers poll db.users (SYNC_DISPATCH_QUEUE = None) - dispatched users go to whichever worker's free, shard or not
+SYNC_SHARD_COUNT = 0
+
+# Users this many seconds overdue can be picked up by any worker, whoever owns their shard
+SYNC_SHARD_STEAL_AFTER = 600
+
+# Syncs stop taking on new activities after this many seconds, and the user's rescheduled right away to carry on - so huge first-time syncs don't hog a worker (or get killed by the watchdog), losing everything
+# None for no limit
+SYNC_TIME_BUDGET = 20 * 60
+
+# Workers share themselves between the sync lanes in these proportions, when there's someone waiting in each of them
+#   interactive - the user asked for it (or just connected a service), trigger - a service reported a change, background - the regular schedule, heavy - the regular schedule for users with huge histories
+SYNC_LANE_WEIGHTS = {"interactive": 8, "trigger": 4, "background": 2, "heavy": 1}
+
+# Users with at least this many activities on record are put in the heavy lane for their regularly-scheduled syncs
+SYNC_HEAVY_USER_ACTIVITIES = 5000
+
 # Used for distributing outgoing calls across multiple interfaces
 
 HTTP_SOURCE_ADDR = "0.0.0.0"
@@ -0,0 +1,165 @@
+from tapiriik.services.interchange import ActivityType
+from datetime import timedelta
+import math
+
+class ActivityDeduplicationIndex:
+    """ Buckets listed activities by start time so _accumulateActivities only compares against plausible duplicates.
+        The buckets only narrow down the candidates - the final decision is still made by IsDuplicate, so the merges are identical to comparing against everything.
+    """
+
+    # Yep, abs() works on timedeltas
+    ActivityStartLeeway = timedelta(minutes=3)
+    ActivityStartTZOffsetLeeway = timedelta(seconds=10)
+    TimezoneErrorPeriod = timedelta(hours=38)
+
+    def __init__(self, activities=None):
+        self._ordinal = 0
+        self._order = {}
+        self._keys = {}
+        self._byUID = {}
+        self._byMinute = {}
+        self._byUTCMinute = {}
+        self._byDateMinute = {}
+        if activities:
+            for act in activities:
+                self.Add(act)
+
+    def IsDuplicate(x, act):
+        return (
+                (
+                    # Identical
+                    x.UID == act.UID
+                    or
+                    # Check to see if the activities are reasonably close together to be considered duplicate
+                    (x.StartTime is not None and
+                     act.StartTime is not None and
+                     (act.StartTime.tzinfo is not None) == (x.StartTime.tzinfo is not None) and
+                     abs(act.StartTime-x.StartTime) < ActivityDeduplicationIndex.ActivityStartLeeway
+                    )
+                    or
+                    # Try comparing the time as if it were TZ-aware and in the expected TZ (this won't actually change the value of the times being compared)
+                    (x.StartTime is not None and
+                     act.StartTime is not None and
+                     (act.StartTime.tzinfo is not None) != (x.StartTime.tzinfo is not None) and
+                     abs(act.StartTime.replace(tzinfo=None)-x.StartTime.replace(tzinfo=None)) < ActivityDeduplicationIndex.ActivityStartLeeway
+                    )
+                    or
+                    # Sometimes wacky stuff happens and we get two activities with the same mm:ss but different hh, because of a TZ issue somewhere along the line.
+                    # So, we check for any activities +/- 14, wait, 38 hours that have the same minutes and seconds values.
+                    #  (14 hours because Kiribati, and later, 38 hours because of some really terrible import code that existed on a service that shall not be named).
+                    # There's a very low chance that two activities in this period would intersect and be merged together.
+                    # But, given the fact that most users have maybe 0.05 activities per this period, it's an acceptable tradeoff.
+                    (x.StartTime is not None and
+                     act.StartTime is not None and
+                     abs(act.StartTime.replace(tzinfo=None)-x.StartTime.replace(tzinfo=None)) < ActivityDeduplicationIndex.TimezoneErrorPeriod and
+                     abs(act.StartTime.replace(tzinfo=None).replace(hour=0) - x.StartTime.replace(tzinfo=None).replace(hour=0)) < ActivityDeduplicationIndex.ActivityStartTZOffsetLeeway
+                     )
+                    or
+                    # Similarly, for half-hour time zones (there are a handful of quarter-hour ones, but I've got to draw a line somewhere, even if I revise it several times)
+                    (x.StartTime is not None and
+                     act.StartTime is not None and
+                     abs(act.StartTime.replace(tzinfo=None)-x.StartTime.replace(tzinfo=None)) < ActivityDeduplicationIndex.TimezoneErrorPeriod and
+                     abs(act.StartTime.replace(tzinfo=None).replace(hour=0) - x.StartTime.replace(tzinfo=None).replace(hour=0)) > timedelta(minutes=30) - (ActivityDeduplicationIndex.ActivityStartTZOffsetLeeway / 2) and
+                     abs(act.StartTime.replace(tzinfo=None).replace(hour=0) - x.StartTime.replace(tzinfo=None).replace(hour=0)) < timedelta(minutes=30) + (ActivityDeduplicationIndex.ActivityStartTZOffsetLeeway / 2)
+                     )
+                )
+                and
+                # Prevents closely-spaced activities of known different type from being lumped together - esp. important for manually-enetered ones
+                (x.Type == ActivityType.Other or act.Type == ActivityType.Other or x.Type == act.Type or ActivityType.AreVariants([act.Type, x.Type]))
+            )
+
+    def _truncateToMinute(dt):
+        return dt.replace(second=0, microsecond=0)
+
+    def _utcNaive(dt):
+        offset = dt.utcoffset()
+        if offset is None:
+            return None
+        return (dt - offset).replace(tzinfo=None)
+
+    def _minuteKeys(dt, leeway):
+        # Every minute bucket that could hold a time strictly within leeway of dt
+        minute = ActivityDeduplicationIndex._truncateToMinute(dt - leeway)
+        last = ActivityDeduplicationIndex._truncateToMinute(dt + leeway)
+        while minute <= last:
+            yield minute
+            minute += timedelta(minutes=1)
+
+    def _dateMinuteKeys(naive):
+        # The mm:ss checks only ever match on the same (naive) date - any other date puts them a whole day apart once the hour is zeroed.
+        offset = naive.minute * 60 + naive.second + naive.microsecond / 1000000
+        tzLeeway = ActivityDeduplicationIndex.ActivityStartTZOffsetLeeway.total_seconds()
+        halfHour = timedelta(minutes=30).total_seconds()
+        ranges = [
+            (offset - tzLeeway, offset + tzLeeway),
+            (offset - halfHour - tzLeeway / 2, offset - halfHour + tzLeeway / 2),
+            (offset + halfHour - tzLeeway / 2, offset + halfHour + tzLeeway / 2)
+        ]
+        date = naive.date()
+        minutes = set()
+        for low, high in ranges:
+            minutes.update(range(max(0, math.floor(low / 60)), min(59, math.floor(high / 60)) + 1))
+        return [(date, minute) for minute in minutes]
+
+    def _activityKeys(self, act):
+        keys = [(self._byUID, act.UID)]
+        if act.StartTime is not None:
+            naive = act.StartTime.replace(tzinfo=None)
+            keys.append((self._byMinute, ActivityDeduplicationIndex._truncateToMinute(naive)))
+            keys.append((self._byDateMinute, (naive.date(), naive.minute)))
+            if act.StartTime.tzinfo is not None:
+                utc = ActivityDeduplicationIndex._utcNaive(act.StartTime)
+                if utc is not None:
+                    keys.append((self._byUTCMinute, ActivityDeduplicationIndex._truncateToMinute(utc)))
+        return keys
+
+    def Add(self, act):
+        self._order[id(act)] = self._ordinal
+        self._ordinal += 1
+        keys = self._activityKeys(act)
+        self._keys[id(act)] = keys
+        for bucketDict, key in keys:
+            bucketDict.setdefault(key, []).append(act)
+
+    def Remove(self, act):
+        for bucketDict, key in self._keys.pop(id(act)):
+            bucket = bucketDict[key]
+            bucket.remove(act)
+            if not bucket:
+                del bucketDict[key]
+        del self._order[id(act)]
+
+    def Update(self, act):
+        """ Re-bucket an activity after its StartTime or UID changed (e.g. merging in a TZ), keeping its original precedence """
+        ordinal = self._order[id(act)]
+        self.Remove(act)
+        self.Add(act)
+        self._order[id(act)] = ordinal
+
+    def _candidates(self, act):
+        candidates = {}
+        def collect(bucketDict, key):
+            for x in bucketDict.get(key, ()):
+                candidates[id(x)] = x
+
+        collect(self._byUID, act.UID)
+        if act.StartTime is not None:
+            naive = act.StartTime.replace(tzinfo=None)
+            # Naive-to-naive, naive-to-aware, and aware-to-aware with a shared tzinfo all compare the wall-clock values
+            for minute in ActivityDeduplicationIndex._minuteKeys(naive, ActivityDeduplicationIndex.ActivityStartLeeway):
+                collect(self._byMinute, minute)
+            # ...while aware-to-aware with differing tzinfos compare in UTC
+            if act.StartTime.tzinfo is not None:
+                utc = ActivityDeduplicationIndex._utcNaive(act.StartTime)
+                if utc is not None:
+                    for minute in ActivityDeduplicationIndex._minuteKeys(utc, ActivityDeduplicationIndex.ActivityStartLeeway):
+                        collect(self._byUTCMinute, minute)
+            for key in ActivityDeduplicationIndex._dateMinuteKeys(naive):
+                collect(self._byDateMinute, key)
+        return candidates.values()
+
+    def FindDuplicates(self, act):
+        """ Returns the indexed activities which act duplicates, in the order they were added """
+        matches = [x for x in self._candidates(act) if ActivityDeduplicationIndex.IsDuplicate(x, act)]
+        matches.sort(key=lambda x: self._order[id(x)])
+        return matches
@@ -1,8 +1,13 @@
 from datetime import datetime
+from tapiriik.database import db
 from tapiriik.services.interchange import ActivityStatisticUnit
 from tapiriik.services.api import UserException
+import pytz
 
 class ActivityRecord:
+    # Keeps the $in queries well clear of the BSON document size limit
+    LoadBatchSize = 5000
+
     def __init__(self, dbRec=None):
         self.StartTime = None
         self.EndTime = None
@@ -26,6 +31,34 @@ class ActivityRecord:
     def __deepcopy__(self, x):
         return ActivityRecord(self.__dict__)
 
+    def EnsureIndexes():
+        db.activity_records.ensure_index([("UserID", 1), ("UIDs", 1)])
+        db.activity_records.ensure_index([("UserID", 1), ("StartTime", -1)])
+
+    def Count(userId):
+        return db.activity_records.find({"UserID": userId}).count()
+
+    def RecentStartTimes(userId, count):
+        # Newest first, in naive UTC like everything else around here
+        startTimes = []
+        for record in db.activity_records.find({"UserID": userId, "StartTime": {"$ne": None}}, {"StartTime": 1}).sort("StartTime", -1).limit(count):
+            startTime = record["StartTime"]
+            startTimes.append(startTime.astimezone(pytz.utc).replace(tzinfo=None) if startTime.tzinfo else startTime)
+        return startTimes
+
+    def MigrateEmbedded(userId):
+        """ Splits the user's records out of the single document with an Activities array they used to share, into a document apiece """
+        embedded = db.activity_records.find_one({"UserID": userId, "Activities": {"$exists": True}})
+        if not embedded:
+            return
+        for raw_record in embedded["Activities"]:
+            if "UIDs" not in raw_record:
+                continue # From the few days where this was rolled out without this key...
+            raw_record["UserID"] = userId
+            # Keyed on the UIDs so a migration that's interrupted and re-run doesn't duplicate anything
+            db.activity_records.update({"UserID": userId, "UIDs": raw_record["UIDs"]}, {"$set": raw_record}, upsert=True)
+        db.activity_records.remove({"_id": embedded["_id"]})
+
     def FromActivity(activity):
         record = ActivityRecord()
         record.SetActivity(activity)
@@ -80,3 +113,46 @@ class ActivityServicePrescence:
             raise ValueError("Provided UserException %s is not a UserException" % userException)
         self.UserException = userException
 
+
+
+class ActivityRecordIndex:
+    """ Finds the ActivityRecord for an activity by its UIDs, rather than by comparing against every record.
+        A record's UIDs change as activities are merged - Update() needs to be called when they do.
+    """
+
+    def __init__(self):
+        self._ordinal = 0
+        self._order = {}
+        self._keys = {}
+        self._byUID = {}
+
+    def Add(self, record):
+        self._order[id(record)] = self._ordinal
+        self._ordinal += 1
+        self._keys[id(record)] = set()
+        self.Update(record)
+
+    def Update(self, record):
+        indexedUIDs = self._keys[id(record)]
+        for uid in record.UIDs:
+            if uid not in indexedUIDs:
+                self._byUID.setdefault(uid, []).append(record)
+                indexedUIDs.add(uid)
+
+    def Remove(self, record):
+        for uid in self._keys.pop(id(record)):
+            bucket = self._byUID[uid]
+            bucket[:] = [x for x in bucket if x is not record]
+            if not bucket:
+                del self._byUID[uid]
+        del self._order[id(record)]
+
+    def Find(self, uids):
+        """ Returns the earliest-added record sharing any of the UIDs, or None """
+        match = None
+        for uid in uids:
+            for record in self._byUID.get(uid, ()):
+                # A record can lose UIDs when it's re-set from an activity, so the bucket may be out of date
+                if uid in record.UIDs and (match is None or self._order[id(record)] < self._order[id(match)]):
+                    match = record
+        return match
@@ -0,0 +1,198 @@
+from tapiriik.database import db
+from tapiriik.settings import RABBITMQ_BROKER_URL, SYNC_DISPATCH_QUEUE, SYNC_DISPATCH_REDELIVERY
+from .sync import Sync
+from .lanes import SyncLane, SyncLaneSelector
+from bson.objectid import ObjectId
+from datetime import datetime, timedelta
+import multiprocessing
+import pickle
+import socket
+import threading
+import time
+
+class SyncDispatcher:
+    """ Moves users that have come due for synchronization into a queue, so idle workers can wait on that rather than each polling db.users every second.
+        Dispatched users are stamped with SynchronizationDispatchTime - if they haven't been synchronized SYNC_DISPATCH_REDELIVERY seconds later (a message went missing, say), they're dispatched again.
+        So any user may be delivered more than once: the worker's lock, along with the check that they're still due, is what keeps them from being synchronized twice.
+        Each lane has a queue of its own, and workers choose between them with SyncLaneSelector - so a backlog in one lane doesn't hold up the others.
+    """
+
+    BatchSize = 100
+
+    def OpenQueue():
+        if SYNC_DISPATCH_QUEUE == "amqp":
+            return AMQPSyncQueue()
+        elif SYNC_DISPATCH_QUEUE == "local":
+            if not LocalSyncQueue.Current:
+                raise ValueError("The local sync dispatch queue only reaches sync_worker's children")
+            return LocalSyncQueue.Current
+        raise ValueError("Unknown sync dispatch queue %s" % SYNC_DISPATCH_QUEUE)
+
+    def DispatchDueUsers(dispatchQueue, host=None, count=None):
+        # With a host given, only users who may be synchronized there are dispatched (i.e. for a queue that only reaches that host)
+        # With a count, only that many go out, with the lanes taking turns per SyncLaneSelector - otherwise it's up to BatchSize from every lane, and the workers take turns instead
+        if count is None:
+            return sum(SyncDispatcher.DispatchDueUsersInLane(dispatchQueue, lane, host=host) for lane in SyncLane.All)
+        dispatched = 0
+        emptyLanes = set()
+        while dispatched < count and len(emptyLanes) < len(SyncLane.All):
+            for lane in SyncLaneSelector.Order():
+                if lane not in emptyLanes and SyncDispatcher.DispatchDueUsersInLane(dispatchQueue, lane, host=host, limit=1):
+                    SyncLaneSelector.Picked(lane)
+                    dispatched += 1
+                    break
+                emptyLanes.add(lane)
+                SyncLaneSelector.Empty(lane)
+        return dispatched
+
+    def DispatchDueUsersInLane(dispatchQueue, lane, host=None, limit=None):
+        now = datetime.utcnow()
+        query = {
+            "NextSynchronization": {"$lte": now},
+            "$and": [
+                Sync._claimableQuery(),
+                {"$or": [
+                    {"SynchronizationDispatchTime": {"$exists": False}},
+                    {"SynchronizationDispatchTime": {"$lt": now - timedelta(seconds=SYNC_DISPATCH_REDELIVERY)}}
+                    ]}
+                ]
+        }
+        if host:
+            query["$and"].append({"$or": [{"SynchronizationHostRestriction": {"$exists": False}}, {"SynchronizationHostRestriction": host}]})
+        query.update(SyncLane.Query(lane))
+        users = list(db.users.find(query, {"_id": 1, "SynchronizationHostRestriction": 1}).sort("NextSynchronization").limit(limit or SyncDispatcher.BatchSize))
+        if not users:
+            return 0
+        # Stamped before they're sent, so a dispatcher falling over in between just means they're sent again later
+        db.users.update({"_id": {"$in": [x["_id"] for x in users]}}, {"$set": {"SynchronizationDispatchTime": now}}, multi=True)
+        for user in users:
+            dispatchQueue.Put(user["_id"], user.get("SynchronizationHostRestriction"), lane=lane)
+        return len(users)
+
+    def Run(dispatchQueue, host=None):
+        while True:
+            if not SyncDispatcher.DispatchDueUsers(dispatchQueue, host=host):
+                time.sleep(1)
+
+    def Release(userIds):
+        # Dispatched, but they never made it to a worker
+        if userIds:
+            db.users.update({"_id": {"$in": list(userIds)}}, {"$unset": {"SynchronizationDispatchTime": None}}, multi=True)
+
+    def RunLocal(dispatchQueue, host, stop):
+        # The one dispatcher for the host - sync_worker's supervisor runs it in a process of its own alongside each child, handing users to the child's threads only as fast as they come free, until stop is set
+        while not stop.is_set():
+            demand = dispatchQueue.Demand()
+            if not demand:
+                stop.wait(0.1) # Checking on the sync threads is cheap - it's db.users that needs sparing
+            elif SyncDispatcher.DispatchDueUsers(dispatchQueue, host=host, count=demand) < demand:
+                stop.wait(1) # Nobody else is due just yet
+
+
+class LocalSyncQueue:
+    """ Stand-in for when there's no broker about - a pipe from the dispatcher process (running SyncDispatcher.RunLocal) to the sync_worker child, both forked from the supervisor, which makes a new one for each child.
+        The dispatcher only sends as many users as there are sync threads waiting for one (Demand), so if the child goes away there's next to nothing left in the pipe - and once the dispatcher's stopped too, Release sends that back to be dispatched again.
+    """
+
+    Current = None
+
+    def __init__(self):
+        context = multiprocessing.get_context("fork")
+        self._reader, self._writer = context.Pipe(duplex=False)
+        self._counts = context.Array("i", 2) # Threads waiting in Get, users sent but not yet received
+        self._receiving = threading.Lock() # Only one thread can be reading from the pipe at a time
+
+    def Put(self, userId, host=None, lane=SyncLane.Background):
+        with self._counts.get_lock():
+            self._counts[1] += 1
+            self._writer.send(userId)
+
+    def Demand(self):
+        with self._counts.get_lock():
+            return max(0, self._counts[0] - self._counts[1])
+
+    def Get(self, timeout):
+        deadline = time.time() + timeout
+        with self._counts.get_lock():
+            self._counts[0] += 1
+        try:
+            if not self._receiving.acquire(timeout=timeout):
+                return None
+            try:
+                if not self._reader.poll(max(0, deadline - time.time())):
+                    return None
+                userId = self._reader.recv()
+            finally:
+                self._receiving.release()
+            with self._counts.get_lock():
+                self._counts[1] -= 1
+            return userId, lambda: None
+        finally:
+            with self._counts.get_lock():
+                self._counts[0] -= 1
+
+    def Release(self):
+        # Once the child's gone - whatever it never got around to receiving is dispatched again right away, rather than after SYNC_DISPATCH_REDELIVERY
+        # Nobody's left to write to it - so a message the child was killed halfway through reading ends in an EOFError, rather than waiting forever for the rest
+        self._writer.close()
+        released = []
+        try:
+            while self._reader.poll(0):
+                released.append(self._reader.recv())
+        except (EOFError, OSError, pickle.UnpicklingError):
+            pass
+        self._reader.close()
+        SyncDispatcher.Release(released)
+        return released
+
+
+class AMQPSyncQueue:
+    """ Dispatches through RABBITMQ_BROKER_URL (the same broker the partial sync trigger polling uses).
+        Messages are only acknowledged once the user's been synchronized, so whatever a worker had in hand when it died goes back to the queue.
+        Users restricted to a host go out on that host's own queue, in each lane.
+        There's no waiting on several queues at once here, so when they're all empty it checks back every PollInterval seconds.
+        Not thread-safe: each thread needs its own.
+    """
+
+    QueueName = "tapiriik-sync"
+    PollInterval = 1
+
+    def __init__(self, connection=None):
+        if connection is None:
+            from kombu import Connection
+            connection = Connection(RABBITMQ_BROKER_URL)
+        self._connection = connection
+        self._queues = {}
+
+    def _queue(self, lane, host=None):
+        name = AMQPSyncQueue.QueueName + "-" + lane + ("-" + host if host else "")
+        if name not in self._queues:
+            self._queues[name] = self._connection.SimpleQueue(name)
+            self._queues[name].consumer.qos(prefetch_count=1) # Otherwise one worker would hoard everything waiting in the queue
+        return self._queues[name]
+
+    def Put(self, userId, host=None, lane=SyncLane.Background):
+        self._queue(lane, host).put({"UserID": str(userId)})
+
+    def Get(self, timeout):
+        deadline = time.time() + timeout
+        while True:
+            for lane in SyncLaneSelector.Order():
+                # This host's own queue first
+                message = self._getNowait(lane, socket.gethostname()) or self._getNowait(lane)
+                if message:
+                    SyncLaneSelector.Picked(lane)
+                    userId = message.payload["UserID"]
+                    return (ObjectId(userId) if ObjectId.is_valid(userId) else userId), message.ack
+                SyncLaneSelector.Empty(lane)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            time.sleep(min(remaining, AMQPSyncQueue.PollInterval))
+
+    def _getNowait(self, lane, host=None):
+        laneQueue = self._queue(lane, host)
+        try:
+            return laneQueue.get(block=False)
+        except laneQueue.Empty:
+            return None
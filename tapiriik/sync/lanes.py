@@ -0,0 +1,48 @@
+from tapiriik.settings import SYNC_LANE_WEIGHTS
+import threading
+
+class SyncLane:
+    """ Which line a user waits in for their next synchronization - decided when it's scheduled, and kept in SynchronizationLane """
+    Interactive = "interactive" # They asked for it (or just connected something), and are likely sitting there watching
+    PartialTrigger = "trigger" # A service told us something changed
+    Background = "background" # The regular schedule
+    Heavy = "heavy" # The regular schedule, for users with enormous histories - so a handful of them can't hold up everyone else
+
+    All = [Interactive, PartialTrigger, Background, Heavy]
+
+    def Query(lane):
+        # Users scheduled before there were lanes don't have one - they're background
+        if lane == SyncLane.Background:
+            return {"SynchronizationLane": {"$in": [None, SyncLane.Background]}}
+        return {"SynchronizationLane": lane}
+
+    def Of(user):
+        return user.get("SynchronizationLane") or SyncLane.Background
+
+
+class SyncLaneSelector:
+    """ Smooth weighted round-robin between the lanes, per SYNC_LANE_WEIGHTS - so when they're all busy each gets its share of the workers, and an idle lane's share goes to the others.
+        Each process keeps its own tally; across all the workers it comes out the same.
+    """
+
+    _lock = threading.Lock()
+    _credit = dict((lane, 0) for lane in SyncLane.All)
+
+    def Weight(lane):
+        return SYNC_LANE_WEIGHTS.get(lane, 1)
+
+    def Order():
+        # The lanes to try this time around, most deserving first - whichever one a user is taken from needs to be charged with Picked()
+        with SyncLaneSelector._lock:
+            for lane in SyncLane.All:
+                SyncLaneSelector._credit[lane] += SyncLaneSelector.Weight(lane)
+            return sorted(SyncLane.All, key=lambda lane: -SyncLaneSelector._credit[lane])
+
+    def Picked(lane):
+        with SyncLaneSelector._lock:
+            SyncLaneSelector._credit[lane] -= sum(SyncLaneSelector.Weight(x) for x in SyncLane.All)
+
+    def Empty(lane):
+        # No banking credit while there's nobody waiting - otherwise a lane that's been quiet for a while would hog the workers once it wasn't
+        with SyncLaneSelector._lock:
+            SyncLaneSelector._credit[lane] = 0
@@ -0,0 +1,58 @@
+import resource
+import threading
+import tracemalloc
+
+class MemoryUsage:
+    """ What a worker's memory is up to - so it can be recycled when it actually gets too big, rather than after every sync just in case.
+        Allocation tracing only happens if the worker started tracemalloc (SYNC_TRACE_ALLOCATIONS, or PYTHONTRACEMALLOC).
+    """
+
+    # Snapshots aren't cheap - a new one is only taken once traced memory's grown this much past the last
+    PeakSnapshotGrowth = 1.25
+
+    _peakLock = threading.Lock()
+    _peakSnapshot = None
+    _peakSnapshotSize = 0
+
+    def RSS():
+        # Sorry, operating systems without procfs - you get the peak instead
+        try:
+            with open("/proc/self/statm") as statm:
+                return int(statm.read().split()[1]) * resource.getpagesize()
+        except (IOError, IndexError, ValueError):
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def Tracing():
+        return tracemalloc.is_tracing()
+
+    def ResetTracedPeak():
+        if tracemalloc.is_tracing() and hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        with MemoryUsage._peakLock:
+            MemoryUsage._peakSnapshot = None
+            MemoryUsage._peakSnapshotSize = 0
+
+    def TracedPeak():
+        return tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+
+    def SamplePeak(threshold):
+        # Called every so often during a sync - once traced memory is past the threshold, each new high gets a snapshot, so TopAllocationSites can say what was live at the peak rather than what's left over afterwards
+        if not tracemalloc.is_tracing():
+            return
+        current = tracemalloc.get_traced_memory()[0]
+        with MemoryUsage._peakLock:
+            if current < threshold or current < MemoryUsage._peakSnapshotSize * MemoryUsage.PeakSnapshotGrowth:
+                return
+            MemoryUsage._peakSnapshotSize = current
+            MemoryUsage._peakSnapshot = None # Before the next one's taken, so there's only ever the one
+            MemoryUsage._peakSnapshot = tracemalloc.take_snapshot()
+
+    def TopAllocationSites(count):
+        # At the highest point SamplePeak caught - or, if it never got the chance, whatever's still live now
+        with MemoryUsage._peakLock:
+            snapshot = MemoryUsage._peakSnapshot
+            MemoryUsage._peakSnapshot = None # They can be big, and it's served its purpose
+        if snapshot is None:
+            snapshot = tracemalloc.take_snapshot()
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        return [{"Site": "%s:%d" % (stat.traceback[0].filename, stat.traceback[0].lineno), "Size": stat.size, "Count": stat.count} for stat in snapshot.statistics("lineno")[:count]]
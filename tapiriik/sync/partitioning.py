@@ -0,0 +1,71 @@
+from tapiriik.database import db
+from tapiriik.settings import SYNC_SHARD_COUNT, SYNC_SHARD_STEAL_AFTER, WORKER_INDEX
+from datetime import datetime, timedelta
+import bisect
+import hashlib
+import os
+import socket
+import threading
+
+class SyncPartitioning:
+    """ Splits users between the workers, so they're not all fighting over the head of the queue.
+        Each user belongs to one of SYNC_SHARD_COUNT shards (by their ID), stamped on them in SynchronizationShard, and the shards are spread over the workers in db.sync_workers with a consistent hash ring.
+        Workers are placed on the ring by host & WORKER_INDEX rather than PID, so a recycled worker picks up right where it left off - same users, warm caches.
+        When a worker comes or goes, only the shards next to it on the ring change hands.
+        Nobody's ever left stranded: users without a shard yet, and those overdue by SYNC_SHARD_STEAL_AFTER seconds (e.g. while the membership's in flux), are fair game for anyone.
+        Off unless SYNC_SHARD_COUNT is set. ClaimableQuery only narrows down what a polling worker goes looking for - with SYNC_DISPATCH_QUEUE, the dispatcher hands users out without it, so shards are ignored.
+    """
+
+    VirtualNodes = 64 # Per worker - otherwise the shards would be spread rather unevenly
+    MembershipTimeout = timedelta(minutes=2) # Workers that haven't reported a heartbeat in this long aren't counted
+    MembershipRefreshInterval = timedelta(seconds=30)
+
+    _lock = threading.Lock()
+    _ownedShards = None
+    _refreshed = None
+    _pid = None # A forked worker inherits the cache, but it might not be in the membership yet
+
+    def Enabled():
+        return SYNC_SHARD_COUNT > 0
+
+    def ShardForUser(userId):
+        return SyncPartitioning._hash(str(userId)) % SYNC_SHARD_COUNT
+
+    def Self():
+        return (socket.gethostname(), WORKER_INDEX)
+
+    def Members():
+        members = set(SyncPartitioning._memberOf(x) for x in db.sync_workers.find({"Heartbeat": {"$gt": datetime.utcnow() - SyncPartitioning.MembershipTimeout}}, {"Host": 1, "Index": 1}))
+        members.add(SyncPartitioning.Self()) # Even if it hasn't registered (yet)
+        return sorted(members)
+
+    def Assign(members):
+        # Returns shard -> the member that owns it
+        ring = sorted((SyncPartitioning._hash("%s:%s:%d" % (member[0], member[1], node)), member) for member in members for node in range(SyncPartitioning.VirtualNodes))
+        points = [point for point, member in ring]
+        return dict((shard, ring[bisect.bisect(points, SyncPartitioning._hash("shard:%d" % shard)) % len(ring)][1]) for shard in range(SYNC_SHARD_COUNT))
+
+    def OwnedShards():
+        with SyncPartitioning._lock:
+            if SyncPartitioning._pid == os.getpid() and datetime.utcnow() - SyncPartitioning._refreshed < SyncPartitioning.MembershipRefreshInterval:
+                return SyncPartitioning._ownedShards
+        me = SyncPartitioning.Self()
+        ownedShards = [shard for shard, member in SyncPartitioning.Assign(SyncPartitioning.Members()).items() if member == me]
+        with SyncPartitioning._lock:
+            SyncPartitioning._ownedShards = ownedShards
+            SyncPartitioning._refreshed = datetime.utcnow()
+            SyncPartitioning._pid = os.getpid()
+        return ownedShards
+
+    def ClaimableQuery():
+        return {"$or": [
+            {"SynchronizationShard": {"$in": SyncPartitioning.OwnedShards()}},
+            {"SynchronizationShard": None},
+            {"NextSynchronization": {"$lte": datetime.utcnow() - timedelta(seconds=SYNC_SHARD_STEAL_AFTER)}}
+            ]}
+
+    def _memberOf(worker):
+        return (worker["Host"], worker.get("Index", 0))
+
+    def _hash(key):
+        return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:8], 16)
@@ -0,0 +1,37 @@
+from tapiriik.settings import SYNC_SERVICE_CONCURRENCY, SYNC_SERVICE_CALL_INTERVAL
+from contextlib import contextmanager
+import threading
+import time
+
+class ServiceRateLimit:
+    """ Paces the calls made to each service (listing, downloading, uploading) across every sync running in this process.
+        With several users being synchronized at once, they'd otherwise all be free to pile onto the same service together.
+    """
+
+    _lock = threading.Lock()
+    _semaphores = {}
+    _nextCallTimes = {}
+
+    def _semaphore(serviceID):
+        with ServiceRateLimit._lock:
+            if serviceID not in ServiceRateLimit._semaphores:
+                ServiceRateLimit._semaphores[serviceID] = threading.BoundedSemaphore(SYNC_SERVICE_CONCURRENCY)
+            return ServiceRateLimit._semaphores[serviceID]
+
+    def _waitForTurn(serviceID):
+        interval = SYNC_SERVICE_CALL_INTERVAL.get(serviceID)
+        if not interval:
+            return
+        # Each caller books the next free slot, then sleeps (outside the lock) until it comes around
+        with ServiceRateLimit._lock:
+            now = time.time()
+            callTime = max(now, ServiceRateLimit._nextCallTimes.get(serviceID, 0))
+            ServiceRateLimit._nextCallTimes[serviceID] = callTime + interval
+        if callTime > now:
+            time.sleep(callTime - now)
+
+    @contextmanager
+    def Call(serviceID):
+        with ServiceRateLimit._semaphore(serviceID):
+            ServiceRateLimit._waitForTurn(serviceID)
+            yield
@@ -0,0 +1,38 @@
+class SynchronizationRouting:
+    """ What's known about a user's connections before any activity is looked at - which connection has which ID, their configuration, what they accept, and where activities may flow.
+        Built once per sync, so deciding where each activity goes is a matter of dictionary lookups rather than list scans, flow exception searches and configuration copies.
+    """
+
+    def __init__(self, user, serviceConnections):
+        from tapiriik.auth import User
+        self._connections = dict((conn._id, conn) for conn in serviceConnections)
+        self._connectionsByExternalID = {}
+        for conn in serviceConnections:
+            self._connectionsByExternalID.setdefault((conn.Service.ID, conn.ExternalID), conn)
+        # GetConfiguration() deep-copies the defaults every time it's called - nothing changes the configuration mid-sync, so these are only resolved once
+        self._configurations = dict((conn._id, conn.GetConfiguration()) for conn in serviceConnections)
+        self._requiresConfiguration = dict((conn._id, conn.Service.RequiresConfiguration(conn)) for conn in serviceConnections)
+        self._supportedActivities = dict((conn._id, frozenset(conn.Service.SupportedActivities or [])) for conn in serviceConnections)
+        # (source connection ID, destination connection ID) -> True if a flow exception blocks activities moving that way
+        self._flowExceptions = dict(((source._id, destination._id), User.CheckFlowException(user, source, destination)) for source in serviceConnections for destination in serviceConnections)
+
+    def Connection(self, id):
+        return self._connections[id]
+
+    def Connections(self, ids):
+        return [self._connections[id] for id in ids]
+
+    def ConnectionByExternalID(self, serviceID, externalID):
+        return self._connectionsByExternalID.get((serviceID, externalID))
+
+    def Configuration(self, serviceRecord):
+        return self._configurations[serviceRecord._id]
+
+    def RequiresConfiguration(self, serviceRecord):
+        return self._requiresConfiguration[serviceRecord._id]
+
+    def SupportsActivityType(self, serviceRecord, activityType):
+        return activityType in self._supportedActivities[serviceRecord._id]
+
+    def HasFlowException(self, sourceServiceRecord, destinationServiceRecord):
+        return self._flowExceptions[(sourceServiceRecord._id, destinationServiceRecord._id)]
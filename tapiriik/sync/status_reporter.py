@@ -0,0 +1,110 @@
+from tapiriik.settings import SYNC_STATUS_REPORT_INTERVAL
+from datetime import datetime
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class SyncStatusReporter:
+    """ Holds on to heartbeats & sync progress, and writes out only the latest of each every SYNC_STATUS_REPORT_INTERVAL seconds (from a background thread).
+        They used to be written as they happened - once or twice for every activity and upload.
+        Whatever's reported keeps its own timestamps, so a stuck sync still looks stuck to the watchdog.
+        It also keeps leases alive - pushing their expiry back with every flush, for as long as this process is around to do so.
+    """
+
+    _lock = threading.Lock()
+    _flushLock = threading.Lock() # So an older flush can't land on top of a newer one
+    _pending = {} # (collection name, query) -> (collection, query, {field: value to $set}, set(fields to $unset))
+    _leases = {} # (collection name, query) -> (collection, query, expiry field, duration)
+    _threadPID = None
+
+    def Set(collection, query, fields):
+        with SyncStatusReporter._lock:
+            _, _, sets, unsets = SyncStatusReporter._pendingFor(collection, query)
+            sets.update(fields)
+            unsets.difference_update(fields.keys())
+        SyncStatusReporter._ensureThread()
+
+    def Unset(collection, query, fields):
+        with SyncStatusReporter._lock:
+            _, _, sets, unsets = SyncStatusReporter._pendingFor(collection, query)
+            for field in fields:
+                sets.pop(field, None)
+            unsets.update(fields)
+        SyncStatusReporter._ensureThread()
+
+    def Lease(collection, query, field, duration):
+        with SyncStatusReporter._lock:
+            SyncStatusReporter._leases[SyncStatusReporter._key(collection, query)] = (collection, query, field, duration)
+        SyncStatusReporter._ensureThread()
+
+    def ReleaseLease(collection, query):
+        with SyncStatusReporter._lock:
+            SyncStatusReporter._leases.pop(SyncStatusReporter._key(collection, query), None)
+
+    def Flush():
+        # Each update is tried on its own - any that fail are put back for next time, and the first failure is raised once the rest are written
+        with SyncStatusReporter._flushLock:
+            with SyncStatusReporter._lock:
+                leaseFields = {}
+                for key, (collection, query, field, duration) in SyncStatusReporter._leases.items():
+                    SyncStatusReporter._pendingFor(collection, query)[2][field] = datetime.utcnow() + duration
+                    leaseFields[key] = field
+                pending = SyncStatusReporter._pending
+                SyncStatusReporter._pending = {}
+            failed = []
+            for key, (collection, query, sets, unsets) in pending.items():
+                update = {}
+                if sets:
+                    update["$set"] = sets
+                if unsets:
+                    update["$unset"] = dict((field, None) for field in unsets)
+                if update:
+                    try:
+                        collection.update(query, update)
+                    except Exception as e:
+                        failed.append((key, e))
+            if failed:
+                with SyncStatusReporter._lock:
+                    for key, e in failed:
+                        SyncStatusReporter._requeue(pending[key], leaseFields.get(key))
+                raise failed[0][1]
+
+    def _requeue(entry, leaseField):
+        # Anything Set/Unset since the flush started is newer, so it wins
+        # Lease expiries aren't put back - the next flush sets a fresh one, if the lease is still held by then
+        collection, query, sets, unsets = entry
+        _, _, newerSets, newerUnsets = SyncStatusReporter._pendingFor(collection, query)
+        for field, value in sets.items():
+            if field != leaseField and field not in newerSets and field not in newerUnsets:
+                newerSets[field] = value
+        for field in unsets:
+            if field not in newerSets:
+                newerUnsets.add(field)
+
+    def _key(collection, query):
+        return (collection.full_name, tuple(sorted(query.items())))
+
+    def _pendingFor(collection, query):
+        key = SyncStatusReporter._key(collection, query)
+        if key not in SyncStatusReporter._pending:
+            SyncStatusReporter._pending[key] = (collection, query, {}, set())
+        return SyncStatusReporter._pending[key]
+
+    def _ensureThread():
+        # Checked by PID, since a forked worker inherits the flag but not the thread
+        with SyncStatusReporter._lock:
+            if SyncStatusReporter._threadPID == os.getpid():
+                return
+            SyncStatusReporter._threadPID = os.getpid()
+        threading.Thread(target=SyncStatusReporter._run, name="sync-status-reporter", daemon=True).start()
+
+    def _run():
+        while True:
+            time.sleep(SYNC_STATUS_REPORT_INTERVAL)
+            try:
+                SyncStatusReporter.Flush()
+            except:
+                logger.exception("Could not report sync status")
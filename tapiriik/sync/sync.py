@@ -1,8 +1,20 @@
 from tapiriik.database import db, cachedb
 from tapiriik.services import Service, ServiceRecord, APIExcludeActivity, ServiceException, ServiceExceptionScope, ServiceWarning, UserException, UserExceptionType
-from tapiriik.settings import USER_SYNC_LOGS, DISABLED_SERVICES, WITHDRAWN_SERVICES
-from .activity_record import ActivityRecord, ActivityServicePrescence
+from tapiriik.settings import USER_SYNC_LOGS, DISABLED_SERVICES, WITHDRAWN_SERVICES, SYNC_LIST_CONCURRENCY, SYNC_DOWNLOAD_LOOKAHEAD, SYNC_DOWNLOAD_LOOKAHEAD_WAYPOINTS, SYNC_UPLOAD_CONCURRENCY, SYNC_PREFETCH_USERS, SYNC_ALLOCATION_OUTLIER_SIZE, SYNC_LOCK_LEASE, SYNC_HEAVY_USER_ACTIVITIES, SYNC_INTERVAL_MIN, SYNC_INTERVAL_MAX, SYNC_TIME_BUDGET
+from .activity_record import ActivityRecord, ActivityRecordIndex, ActivityServicePrescence
+from .activity_index import ActivityDeduplicationIndex
+from .routing import SynchronizationRouting
+from .synchronized_activities import SynchronizedActivities, SynchronizedActivityIndex
+from .write_buffer import WriteBehindBuffer
+from .rate_limit import ServiceRateLimit
+from .memory import MemoryUsage
+from .status_reporter import SyncStatusReporter
+from .lanes import SyncLane, SyncLaneSelector
+from .partitioning import SyncPartitioning
 from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 import sys
 import os
 import socket
@@ -12,6 +24,8 @@ import copy
 import random
 import logging
 import logging.handlers
+import threading
+import uuid
 import pytz
 
 # Set this up seperate from the logger used in this scope, so services logging messages are caught and logged into user's files.
@@ -25,6 +39,17 @@ _global_logger.addHandler(logging_console_handler)
 
 logger = logging.getLogger("tapiriik.sync.worker")
 
+# Which SynchronizationTask the current thread is working on behalf of - so that, with several running at once, each user's log only picks up their own sync.
+_task_context = threading.local()
+
+class _TaskLogFilter(logging.Filter):
+    def __init__(self, task):
+        super().__init__()
+        self._task = task
+
+    def filter(self, record):
+        return getattr(_task_context, "task", None) is self._task
+
 def _formatExc():
     try:
         exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -71,32 +96,168 @@ class Sync:
 
     SyncInterval = timedelta(hours=1)
     SyncIntervalJitter = timedelta(minutes=5)
+    ShortestSyncInterval = timedelta(seconds=SYNC_INTERVAL_MIN)
+    LongestSyncInterval = timedelta(seconds=SYNC_INTERVAL_MAX)
+    ActivityCadenceSampleSize = 20
+    ShortestActivityCadence = timedelta(hours=1)
     MinimumSyncInterval = timedelta(seconds=30)
     MaximumIntervalBeforeExhaustiveSync = timedelta(days=14)  # Based on the general page size of 50 activites, this would be >3/day...
+    AllocationSitesReported = 10
+    LockLease = timedelta(seconds=SYNC_LOCK_LEASE)
+    TimeBudget = timedelta(seconds=SYNC_TIME_BUDGET) if SYNC_TIME_BUDGET else None
 
     def ScheduleImmediateSync(user, exhaustive=None):
+        # Everything that calls this has a user waiting on the result, so they go in the interactive lane
         if exhaustive is None:
-            db.users.update({"_id": user["_id"]}, {"$set": {"NextSynchronization": datetime.utcnow()}})
+            db.users.update({"_id": user["_id"]}, {"$set": {"NextSynchronization": datetime.utcnow(), "SynchronizationLane": SyncLane.Interactive}})
         else:
-            db.users.update({"_id": user["_id"]}, {"$set": {"NextSynchronization": datetime.utcnow(), "NextSyncIsExhaustive": exhaustive}})
+            db.users.update({"_id": user["_id"]}, {"$set": {"NextSynchronization": datetime.utcnow(), "SynchronizationLane": SyncLane.Interactive, "NextSyncIsExhaustive": exhaustive}})
+
+    def NextSyncInterval(user):
+        # Most regular syncs turn up nothing new - so the longer a user's gone without a new activity, compared to how often they usually have one, the longer they wait for the next
+        # Right after one, they're at the shortest interval - so nobody who's actually active waits any longer than they used to
+        if Sync._onlyPartialSyncTriggers(user):
+            return Sync.LongestSyncInterval # Anything new will come with a trigger - the regular syncs are only there to catch what slips through
+        startTimes = ActivityRecord.RecentStartTimes(user["_id"], Sync.ActivityCadenceSampleSize)
+        if len(startTimes) < 2:
+            return min(max(Sync.SyncInterval, Sync.ShortestSyncInterval), Sync.LongestSyncInterval) # No idea yet
+        gaps = sorted(newer - older for newer, older in zip(startTimes, startTimes[1:]))
+        cadence = max(gaps[len(gaps) // 2], Sync.ShortestActivityCadence)
+        idle = max(datetime.utcnow() - startTimes[0], timedelta(0))
+        return min(max(Sync.SyncInterval * (idle / cadence), Sync.ShortestSyncInterval), Sync.LongestSyncInterval)
+
+    def _onlyPartialSyncTriggers(user):
+        # If any of their services has to be polled, that's what the regular syncs are for
+        triggered = []
+        for conn in user.get("ConnectedServices", []):
+            try:
+                triggered.append(Service.FromID(conn["Service"]).PartialSyncRequiresTrigger)
+            except ValueError:
+                pass # Withdrawn
+        if not triggered or not all(triggered):
+            return False
+        # ...likewise if any of the connections aren't actually subscribed to their trigger (yet) - nothing's going to come of it otherwise
+        connIds = [conn["ID"] for conn in user["ConnectedServices"] if conn["Service"] in Service._serviceMappings]
+        return db.connections.find({"_id": {"$in": connIds}, "PartialSyncTriggerSubscribed": {"$ne": True}}).count() == 0
 
     def SetNextSyncIsExhaustive(user, exhaustive=False):
         db.users.update({"_id": user["_id"]}, {"$set": {"NextSyncIsExhaustive": exhaustive}})
 
-    def PerformGlobalSync(heartbeat_callback=None, version=None):
-        from tapiriik.auth import User
-        users = db.users.find({
+    def _claimableQuery():
+        # Unlocked - or locked by a worker that's stopped renewing its lease, since it crashed or was killed or lost its host.
+        # Locks without any lease expiry (e.g. those set from the diagnostics page) don't run out.
+        return {"$or": [{"SynchronizationWorker": None}, {"SynchronizationLeaseExpiry": {"$lt": datetime.utcnow()}}]}
+
+    def _lockFields():
+        # The pid & host say who has them (for the watchdog, diagnostics, etc.) - but all the threads in a process share those, so each claim gets a token of its own to tell which are whose
+        return {"SynchronizationWorker": os.getpid(), "SynchronizationHost": socket.gethostname(), "SynchronizationClaim": uuid.uuid4().hex, "SynchronizationStartTime": datetime.utcnow(), "SynchronizationLeaseExpiry": datetime.utcnow() + Sync.LockLease}
+
+    def _unlockFields():
+        return {"SynchronizationWorker": None, "SynchronizationClaim": None, "SynchronizationLeaseExpiry": None}
+
+    def _leaseQuery(user):
+        return {"_id": user["_id"], "SynchronizationClaim": user["SynchronizationClaim"]}
+
+    def _holdLease(user):
+        # The lease is renewed in the background from here on - so it only runs out once this process is gone, or the lease is released
+        SyncStatusReporter.Lease(db.users, Sync._leaseQuery(user), "SynchronizationLeaseExpiry", Sync.LockLease)
+
+    def _releaseLease(user):
+        if "SynchronizationClaim" in user: # Otherwise they were never locked in the first place
+            SyncStatusReporter.ReleaseLease(db.users, Sync._leaseQuery(user))
+
+    def _claimUsers(count=1, userId=None):
+        # Returns the users that are due for synchronization that this worker managed to lock, most overdue first, from whichever lane's turn it is
+        # (or just the given user, if they're still due and nobody else has them)
+        query = {
                 "NextSynchronization": {"$lte": datetime.utcnow()},
-                "SynchronizationWorker": None,
-                "$or": [
-                    {"SynchronizationHostRestriction": {"$exists": False}},
-                    {"SynchronizationHostRestriction": socket.gethostname()}
+                "$and": [
+                    Sync._claimableQuery(),
+                    {"$or": [
+                        {"SynchronizationHostRestriction": {"$exists": False}},
+                        {"SynchronizationHostRestriction": socket.gethostname()}
+                        ]}
                     ]
-            }).sort("NextSynchronization").limit(1)
+            }
+        if userId is not None:
+            query["_id"] = userId
+            return Sync._claimUsersMatching(query, count)
+        if SyncPartitioning.Enabled():
+            query["$and"].append(SyncPartitioning.ClaimableQuery())
+        if not db.users.find_one(query, {"_id": 1}):
+            # Nobody's waiting in any lane - which is what an idle worker finds on every poll, so it finds out in one query rather than one per lane
+            for lane in SyncLane.All:
+                SyncLaneSelector.Empty(lane)
+            return []
+        for lane in SyncLaneSelector.Order():
+            laneQuery = dict(query)
+            laneQuery.update(SyncLane.Query(lane))
+            users = Sync._claimUsersMatching(laneQuery, count)
+            if users:
+                SyncLaneSelector.Picked(lane)
+                return users
+            SyncLaneSelector.Empty(lane)
+        return []
+
+    def _claimUsersMatching(query, count):
+        lock = Sync._lockFields()
+        if count <= 1:
+            # Finding and locking in the same operation means there's no race to lose
+            user = db.users.find_and_modify(query, {"$set": lock}, sort=[("NextSynchronization", 1)], new=True)
+            if user:
+                Sync._holdLease(user)
+            return [user] if user else []
+
+        # Otherwise, lease a batch - pick out some candidates, lock whichever are still free in one go, then see which ones we got
+        candidateIds = [x["_id"] for x in db.users.find(query, {"_id": 1}).sort("NextSynchronization").limit(count)]
+        if not candidateIds:
+            return []
+        query["_id"] = {"$in": candidateIds}
+        db.users.update(query, {"$set": lock}, multi=True)
+        users = list(db.users.find({"_id": {"$in": candidateIds}, "SynchronizationClaim": lock["SynchronizationClaim"]}).sort("NextSynchronization"))
+        for user in users:
+            Sync._holdLease(user) # Including those still waiting their turn
+        return users
+
+    def _releaseUsers(users):
+        # For users that were claimed, but never got synchronized
+        for user in users:
+            Sync._releaseLease(user)
+        # A batch shares the one claim, so this is usually a single update
+        for claim in set(x["SynchronizationClaim"] for x in users):
+            db.users.update({"_id": {"$in": [x["_id"] for x in users if x["SynchronizationClaim"] == claim]}, "SynchronizationClaim": claim}, {"$unset": Sync._unlockFields()}, multi=True)
+
+    def PerformGlobalSync(heartbeat_callback=None, version=None):
+        return Sync._performClaimedUserSyncs(Sync._claimUsers(SYNC_PREFETCH_USERS), heartbeat_callback=heartbeat_callback, version=version)
+
+    def PerformQueuedSync(dispatchQueue, heartbeat_callback=None, version=None, timeout=1):
+        # Waits (a little while) for SyncDispatcher to hand over a user, then synchronizes them just as PerformGlobalSync would
+        delivery = dispatchQueue.Get(timeout)
+        if not delivery:
+            return 0
+        userId, ack = delivery
+        # Deliveries are at-least-once, so they may well have been synchronized already, or be underway elsewhere - claiming them sorts that out
+        userCt = Sync._performClaimedUserSyncs(Sync._claimUsers(userId=userId), heartbeat_callback=heartbeat_callback, version=version)
+        # Only once it's done - if this process dies first, the queue will hand them to someone else
+        ack()
+        return userCt
+
+    def _performClaimedUserSyncs(users, heartbeat_callback=None, version=None):
+        from tapiriik.auth import User
+        if MemoryUsage.Tracing():
+            # The heartbeats come often enough to catch the peak around when it happens
+            def sampledHeartbeat(state, heartbeat_callback=heartbeat_callback):
+                MemoryUsage.SamplePeak(SYNC_ALLOCATION_OUTLIER_SIZE)
+                if heartbeat_callback:
+                    heartbeat_callback(state)
+            heartbeat_callback = sampledHeartbeat
         userCt = 0
         for user in users:
             userCt += 1
             syncStart = datetime.utcnow()
+            # With several users being synchronized in the process at once, these end up covering all of them - not much to be done about that
+            rssStart = MemoryUsage.RSS()
+            MemoryUsage.ResetTracedPeak()
 
             # Always to an exhaustive sync if there were errors
             #   Sometimes services report that uploads failed even when they succeeded.
@@ -112,20 +273,51 @@ class Sync:
                 exhaustive = True
 
             try:
-                Sync.PerformUserSync(user, exhaustive, null_next_sync_on_unlock=True, heartbeat_callback=heartbeat_callback)
+                task = Sync.PerformUserSync(user, exhaustive, null_next_sync_on_unlock=True, heartbeat_callback=heartbeat_callback, already_locked=True, time_budget=Sync.TimeBudget)
             except SynchronizationConcurrencyException:
                 pass  # another worker picked them
+            except:
+                Sync._releaseUsers(users[userCt:]) # Don't leave the rest of the batch locked until the watchdog gets around to it
+                raise
             else:
                 nextSync = None
-                if User.HasActivePayment(user):
-                    nextSync = datetime.utcnow() + Sync.SyncInterval + timedelta(seconds=random.randint(-Sync.SyncIntervalJitter.total_seconds(), Sync.SyncIntervalJitter.total_seconds()))
-                db.users.update({"_id": user["_id"]}, {"$set": {"NextSynchronization": nextSync, "LastSynchronization": datetime.utcnow(), "LastSynchronizationVersion": version}, "$unset": {"NextSyncIsExhaustive": None}})
+                nextLane = SyncLane.Background
+                update = {"$set": {}, "$unset": {"NextSyncIsExhaustive": None, "SynchronizationDispatchTime": None, "SynchronizationClaim": None}}
+                if task.OutOfTime:
+                    # They'll carry on from (more or less) where they stopped as soon as they come around again - once everyone who was already waiting has had a turn
+                    nextSync = datetime.utcnow()
+                    nextLane = SyncLane.Of(user)
+                    del update["$unset"]["NextSyncIsExhaustive"]
+                    update["$set"]["NextSyncIsExhaustive"] = exhaustive
+                elif User.HasActivePayment(user):
+                    nextSync = datetime.utcnow() + Sync.NextSyncInterval(user) + timedelta(seconds=random.randint(-Sync.SyncIntervalJitter.total_seconds(), Sync.SyncIntervalJitter.total_seconds()))
+                    if ActivityRecord.Count(user["_id"]) >= SYNC_HEAVY_USER_ACTIVITIES:
+                        nextLane = SyncLane.Heavy
+                update["$set"].update({"NextSynchronization": nextSync, "SynchronizationLane": nextLane, "SynchronizationShard": SyncPartitioning.ShardForUser(user["_id"]) if SyncPartitioning.Enabled() else None, "LastSynchronization": datetime.utcnow(), "LastSynchronizationVersion": version})
+                # If they've been claimed again already, whoever has them now gets to decide when they're next due
+                db.users.update(Sync._leaseQuery(user), update)
                 syncTime = (datetime.utcnow() - syncStart).total_seconds()
-                db.sync_worker_stats.insert({"Timestamp": datetime.utcnow(), "Worker": os.getpid(), "Host": socket.gethostname(), "TimeTaken": syncTime})
+                rss = MemoryUsage.RSS()
+                stats = {"Timestamp": datetime.utcnow(), "Worker": os.getpid(), "Host": socket.gethostname(), "TimeTaken": syncTime, "RSS": rss, "RSSGrowth": rss - rssStart, "OutOfTime": task.OutOfTime}
+                # How long they were kept waiting past when they were due, by lane - stats_cron rolls these up
+                stats["Lane"] = SyncLane.Of(user)
+                stats["QueueWait"] = (syncStart - user["NextSynchronization"]).total_seconds() if user.get("NextSynchronization") else None
+                if MemoryUsage.Tracing():
+                    stats["TracedPeak"] = MemoryUsage.TracedPeak()
+                    if stats["TracedPeak"] > SYNC_ALLOCATION_OUTLIER_SIZE:
+                        # What was taking up the room at the peak - that's where to go looking for bloat
+                        stats["TopAllocationSites"] = MemoryUsage.TopAllocationSites(Sync.AllocationSitesReported)
+                db.sync_worker_stats.insert(stats)
         return userCt
 
-    def PerformUserSync(user, exhaustive=False, null_next_sync_on_unlock=False, heartbeat_callback=None):
-        SynchronizationTask(user).Run(exhaustive=exhaustive, null_next_sync_on_unlock=null_next_sync_on_unlock, heartbeat_callback=heartbeat_callback)
+    def PerformUserSync(user, exhaustive=False, null_next_sync_on_unlock=False, heartbeat_callback=None, already_locked=False, time_budget=None):
+        task = SynchronizationTask(user)
+        try:
+            task.Run(exhaustive=exhaustive, null_next_sync_on_unlock=null_next_sync_on_unlock, heartbeat_callback=heartbeat_callback, already_locked=already_locked, time_budget=time_budget)
+        finally:
+            # If the sync fell over before unlocking them, the lease runs out shortly and someone else can pick them up
+            Sync._releaseLease(task.user)
+        return task
 
 
 class SynchronizationTask:
@@ -134,39 +326,62 @@ class SynchronizationTask:
 
     def __init__(self, user):
         self.user = user
+        self._writeBuffer = WriteBehindBuffer()
 
     def _lockUser(self):
-        db.users.update({"_id": self.user["_id"], "SynchronizationWorker": None}, {"$set": {"SynchronizationWorker": os.getpid(), "SynchronizationHost": socket.gethostname(), "SynchronizationStartTime": datetime.utcnow()}})
-        lockCheck = db.users.find_one({"_id": self.user["_id"], "SynchronizationWorker": os.getpid(), "SynchronizationHost": socket.gethostname()})
+        query = Sync._claimableQuery()
+        query["_id"] = self.user["_id"]
+        lockCheck = db.users.find_and_modify(query, {"$set": Sync._lockFields()}, new=True)
         if lockCheck is None:
             raise SynchronizationConcurrencyException  # failed to get lock
+        self.user["SynchronizationClaim"] = lockCheck["SynchronizationClaim"]
+        Sync._holdLease(self.user)
 
     def _unlockUser(self, null_next_sync_on_unlock):
-        update_values = {"$unset": {"SynchronizationWorker": None}}
+        Sync._releaseLease(self.user)
+        update_values = {"$unset": Sync._unlockFields()}
+        # The claim token stays put, so the write that reschedules them (in _performClaimedUserSyncs) can tell if someone else has claimed them since
+        del update_values["$unset"]["SynchronizationClaim"]
         if null_next_sync_on_unlock:
             # Sometimes another worker would pick this record in the timespan between this update and the one in PerformGlobalSync that sets the true next sync time.
             # Hence, an option to unset the NextSynchronization in the same operation that releases the lock on the row.
             update_values["$unset"]["NextSynchronization"] = None
-        db.users.update({"_id": self.user["_id"], "SynchronizationWorker": os.getpid(), "SynchronizationHost": socket.gethostname()}, update_values)
+        db.users.update(Sync._leaseQuery(self.user), update_values)
 
     def _loadServiceData(self):
         self._connectedServiceIds = [x["ID"] for x in self.user["ConnectedServices"]]
-        self._serviceConnections = [ServiceRecord(x) for x in db.connections.find({"_id": {"$in": self._connectedServiceIds}})]
+        SynchronizedActivities.MigrateEmbedded(self._connectedServiceIds)
+        self._serviceConnections = [ServiceRecord(x) for x in db.connections.find({"_id": {"$in": self._connectedServiceIds}}, {"SynchronizedActivities": 0})]
+        self._synchronizedActivities = SynchronizedActivityIndex([x._id for x in self._serviceConnections], writeBuffer=self._writeBuffer)
 
     def _updateSyncProgress(self, step, progress):
-        db.users.update({"_id": self.user["_id"]}, {"$set": {"SynchronizationProgress": progress, "SynchronizationStep": step}})
+        SyncStatusReporter.Set(db.users, {"_id": self.user["_id"]}, {"SynchronizationProgress": progress, "SynchronizationStep": step})
 
     def _initializeUserLogging(self):
         self._logging_file_handler = logging.handlers.RotatingFileHandler(USER_SYNC_LOGS + str(self.user["_id"]) + ".log", maxBytes=0, backupCount=10)
         self._logging_file_handler.setFormatter(logging.Formatter(self._logFormat, self._logDateFormat))
         self._logging_file_handler.doRollover()
+        self._logging_file_handler.addFilter(_TaskLogFilter(self))
+        _task_context.task = self
         _global_logger.addHandler(self._logging_file_handler)
 
     def _closeUserLogging(self):
         _global_logger.removeHandler(self._logging_file_handler)
+        _task_context.task = None
         self._logging_file_handler.flush()
         self._logging_file_handler.close()
 
+    def _inTaskContext(self, fn):
+        # For work handed off to other threads - so what it logs still ends up in this user's file
+        def run(*args, **kwargs):
+            previousTask = getattr(_task_context, "task", None)
+            _task_context.task = self
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _task_context.task = previousTask
+        return run
+
     def _loadExtendedAuthData(self):
         self._extendedAuthDetails = list(cachedb.extendedAuthDetails.find({"ID": {"$in": self._connectedServiceIds}}))
 
@@ -203,8 +418,8 @@ class SynchronizationTask:
                 }
             }
 
-            if not self._isServiceExcluded(conn):
-                # Only reset the trigger if we succesfully got through the entire sync without bailing on this particular connection
+            if not self._isServiceExcluded(conn) and not self.OutOfTime:
+                # Only reset the trigger if we succesfully got through the entire sync without bailing on this particular connection (or running out of time)
                 update_values["$unset"] = {"TriggerPartialSync": None}
 
             db.connections.update({"_id": conn._id}, update_values)
@@ -214,7 +429,7 @@ class SynchronizationTask:
 
         db.users.update({"_id": self.user["_id"]}, {"$set": {"NonblockingSyncErrorCount": nonblockingSyncErrorsCount, "BlockingSyncErrorCount": blockingSyncErrorsCount, "SyncExclusionCount": syncExclusionCount}})
 
-    def _writeBackActivityRecords(self):
+    def _composeActivityRecord(self, record):
         def _activityPrescences(prescences):
             return dict([(svcId if svcId else "",
                 {
@@ -223,45 +438,48 @@ class SynchronizationTask:
                     "Exception": _packUserException(presc.UserException)
                 }) for svcId, presc in prescences.items()])
 
-        self._activityRecords.sort(key=lambda x: x.StartTime.replace(tzinfo=None), reverse=True)
-        composed_records = [
-            {
-                "StartTime": x.StartTime,
-                "EndTime": x.EndTime,
-                "Type": x.Type,
-                "Name": x.Name,
-                "Notes": x.Notes,
-                "Private": x.Private,
-                "Stationary": x.Stationary,
-                "Distance": x.Distance,
-                "UIDs": list(x.UIDs),
-                "Prescence": _activityPrescences(x.PresentOnServices),
-                "Abscence": _activityPrescences(x.NotPresentOnServices)
-            }
-            for x in self._activityRecords
-        ]
+        return {
+            "UserID": self.user["_id"],
+            "StartTime": record.StartTime,
+            "EndTime": record.EndTime,
+            "Type": record.Type,
+            "Name": record.Name,
+            "Notes": record.Notes,
+            "Private": record.Private,
+            "Stationary": record.Stationary,
+            "Distance": record.Distance,
+            "UIDs": sorted(record.UIDs),
+            "Prescence": _activityPrescences(record.PresentOnServices),
+            "Abscence": _activityPrescences(record.NotPresentOnServices)
+        }
 
-        db.activity_records.update(
-            {"UserID": self.user["_id"]},
-            {
-                "$set": {
-                    "UserID": self.user["_id"],
-                    "Activities": composed_records
-                }
-            },
-            upsert=True
-        )
+    def _writeBackActivityRecords(self):
+        # Records that weren't touched this sync can't have changed - and of those that were, only the ones that actually did change are written.
+        for record in self._activityRecords:
+            if not record.Touched:
+                continue
+            composed_record = self._composeActivityRecord(record)
+            if self._activityRecordSnapshots.get(record._id) == composed_record:
+                continue
+            self._writeBuffer.Update(db.activity_records, {"_id": record._id}, {"$set": composed_record}, upsert=True)
+        self._writeBuffer.Flush()
 
     def _initializeActivityRecords(self):
-        raw_records = db.activity_records.find_one({"UserID": self.user["_id"]})
+        ActivityRecord.MigrateEmbedded(self.user["_id"])
         self._activityRecords = []
-        if not raw_records:
-            return
-        else:
-            raw_records = raw_records["Activities"]
-            for raw_record in raw_records:
-                if "UIDs" not in raw_record:
-                    continue # From the few days where this was rolled out without this key...
+        self._activityRecordIndex = ActivityRecordIndex()
+        # What each loaded record looked like in the database, to tell which ones need writing back
+        self._activityRecordSnapshots = {}
+        self._activityRecordsLoadedUIDs = set()
+
+    def _loadActivityRecords(self, uids):
+        # Only the records for activities that are actually being looked at are loaded - the rest are left alone in the database.
+        pendingUIDs = list(set(uids) - self._activityRecordsLoadedUIDs)
+        for idx in range(0, len(pendingUIDs), ActivityRecord.LoadBatchSize):
+            batch = pendingUIDs[idx:idx + ActivityRecord.LoadBatchSize]
+            for raw_record in db.activity_records.find({"UserID": self.user["_id"], "UIDs": {"$in": batch}}):
+                if raw_record["_id"] in self._activityRecordSnapshots:
+                    continue # Already loaded via one of its other UIDs
                 rec = ActivityRecord(raw_record)
                 rec.UIDs = set(rec.UIDs)
                 # Did I mention I should really start using an ORM-type deal any day now?
@@ -271,21 +489,33 @@ class SynchronizationTask:
                     rec.PresentOnServices[svc] = ActivityServicePrescence(present["Processed"], present["Synchronized"], _unpackUserException(present["Exception"]))
                 del rec.Prescence
                 del rec.Abscence
+                del rec.UserID
                 rec.Touched = False
                 self._activityRecords.append(rec)
+                self._activityRecordIndex.Add(rec)
+                self._activityRecordSnapshots[rec._id] = self._composeActivityRecord(rec)
+            self._activityRecordsLoadedUIDs.update(batch)
 
     def _findOrCreateActivityRecord(self, activity):
-        for record in self._activityRecords:
-            if record.UIDs & activity.UIDs:
-                record.Touched = True
-                return record
+        self._loadActivityRecords(activity.UIDs)
+        record = self._activityRecordIndex.Find(activity.UIDs)
+        if record:
+            record.Touched = True
+            return record
         record = ActivityRecord.FromActivity(activity)
+        record._id = ObjectId()
         record.Touched = True
         self._activityRecords.append(record)
+        self._activityRecordIndex.Add(record)
         return record
 
     def _dropUntouchedActivityRecords(self):
+        for record in self._activityRecords:
+            if not record.Touched:
+                self._activityRecordIndex.Remove(record)
         self._activityRecords[:] = [x for x in self._activityRecords if x.Touched]
+        # This includes the records that were never loaded in the first place - they weren't touched either.
+        db.activity_records.remove({"UserID": self.user["_id"], "_id": {"$nin": [x._id for x in self._activityRecords]}}, multi=True)
 
     def _excludeService(self, serviceRecord, userException):
         self._excludedServices[serviceRecord._id] = userException if userException else None
@@ -302,9 +532,9 @@ class SynchronizationTask:
             if conn._id in activity.ServiceDataCollection:
                 # The activity record is updated earlier for these, blegh.
                 pass
-            elif hasattr(conn, "SynchronizedActivities") and len([x for x in activity.UIDs if x in conn.SynchronizedActivities]):
+            elif self._synchronizedActivities.HasAny(conn._id, activity.UIDs):
                 pass
-            elif activity.Type not in conn.Service.SupportedActivities:
+            elif not self._routing.SupportsActivityType(conn, activity.Type):
                 logger.debug("\t...%s doesn't support type %s" % (conn.Service.ID, activity.Type))
                 activity.Record.MarkAsNotPresentOn(conn, UserException(UserExceptionType.TypeUnsupported))
             else:
@@ -331,10 +561,6 @@ class SynchronizationTask:
             return a
 
     def _accumulateActivities(self, conn, svcActivities, no_add=False):
-        # Yep, abs() works on timedeltas
-        activityStartLeeway = timedelta(minutes=3)
-        activityStartTZOffsetLeeway = timedelta(seconds=10)
-        timezoneErrorPeriod = timedelta(hours=38)
         from tapiriik.services.interchange import ActivityType
         for act in svcActivities:
             act.UIDs = set([act.UID])
@@ -346,49 +572,7 @@ class SynchronizationTask:
             if act.TZ and not hasattr(act.TZ, "localize"):
                 raise ValueError("Got activity with TZ type " + str(type(act.TZ)) + " instead of a pytz timezone")
             # Used to ensureTZ() right here - doubt it's needed any more?
-            existElsewhere = [
-                              x for x in self._activities if
-                              (
-                                  # Identical
-                                  x.UID == act.UID
-                                  or
-                                  # Check to see if the self._activities are reasonably close together to be considered duplicate
-                                  (x.StartTime is not None and
-                                   act.StartTime is not None and
-                                   (act.StartTime.tzinfo is not None) == (x.StartTime.tzinfo is not None) and
-                                   abs(act.StartTime-x.StartTime) < activityStartLeeway
-                                  )
-                                  or
-                                  # Try comparing the time as if it were TZ-aware and in the expected TZ (this won't actually change the value of the times being compared)
-                                  (x.StartTime is not None and
-                                   act.StartTime is not None and
-                                   (act.StartTime.tzinfo is not None) != (x.StartTime.tzinfo is not None) and
-                                   abs(act.StartTime.replace(tzinfo=None)-x.StartTime.replace(tzinfo=None)) < activityStartLeeway
-                                  )
-                                  or
-                                  # Sometimes wacky stuff happens and we get two activities with the same mm:ss but different hh, because of a TZ issue somewhere along the line.
-                                  # So, we check for any activities +/- 14, wait, 38 hours that have the same minutes and seconds values.
-                                  #  (14 hours because Kiribati, and later, 38 hours because of some really terrible import code that existed on a service that shall not be named).
-                                  # There's a very low chance that two activities in this period would intersect and be merged together.
-                                  # But, given the fact that most users have maybe 0.05 activities per this period, it's an acceptable tradeoff.
-                                  (x.StartTime is not None and
-                                   act.StartTime is not None and
-                                   abs(act.StartTime.replace(tzinfo=None)-x.StartTime.replace(tzinfo=None)) < timezoneErrorPeriod and
-                                   abs(act.StartTime.replace(tzinfo=None).replace(hour=0) - x.StartTime.replace(tzinfo=None).replace(hour=0)) < activityStartTZOffsetLeeway
-                                   )
-                                  or
-                                  # Similarly, for half-hour time zones (there are a handful of quarter-hour ones, but I've got to draw a line somewhere, even if I revise it several times)
-                                  (x.StartTime is not None and
-                                   act.StartTime is not None and
-                                   abs(act.StartTime.replace(tzinfo=None)-x.StartTime.replace(tzinfo=None)) < timezoneErrorPeriod and
-                                   abs(act.StartTime.replace(tzinfo=None).replace(hour=0) - x.StartTime.replace(tzinfo=None).replace(hour=0)) > timedelta(minutes=30) - (activityStartTZOffsetLeeway / 2) and
-                                   abs(act.StartTime.replace(tzinfo=None).replace(hour=0) - x.StartTime.replace(tzinfo=None).replace(hour=0)) < timedelta(minutes=30) + (activityStartTZOffsetLeeway / 2)
-                                   )
-                               )
-                                and
-                                # Prevents closely-spaced activities of known different type from being lumped together - esp. important for manually-enetered ones
-                                (x.Type == ActivityType.Other or act.Type == ActivityType.Other or x.Type == act.Type or ActivityType.AreVariants([act.Type, x.Type]))
-                              ]
+            existElsewhere = self._activityIndex.FindDuplicates(act)
             if len(existElsewhere) > 0:
                 existingActivity = existElsewhere[0]
                 # we don't merge the exclude values here, since at this stage the services have the option of just not returning those activities
@@ -419,12 +603,15 @@ class SynchronizationTask:
 
                 existingActivity.UIDs |= act.UIDs  # I think this is merited
                 act.UIDs = existingActivity.UIDs  # stop the circular inclusion, not that it matters
+                self._activityIndex.Update(existingActivity) # The StartTime and UID may have shifted with the merge
+                if hasattr(existingActivity, "Record"):
+                    self._activityRecordIndex.Update(existingActivity.Record) # ...and its record may share that set of UIDs
                 continue
             if not no_add:
                 self._activities.append(act)
+                self._activityIndex.Add(act)
 
     def _determineEligibleRecipientServices(self, activity, recipientServices):
-        from tapiriik.auth import User
         eligibleServices = []
         for destinationSvcRecord in recipientServices:
             if self._isServiceExcluded(destinationSvcRecord):
@@ -433,11 +620,11 @@ class SynchronizationTask:
                 continue  # we don't know for sure if it needs to be uploaded, hold off for now
             flowException = True
 
-            sources = [[y for y in self._serviceConnections if y._id == x][0] for x in activity.ServiceDataCollection.keys()]
+            sources = self._routing.Connections(activity.ServiceDataCollection.keys())
             for src in sources:
                 if src.Service.ID in WITHDRAWN_SERVICES:
                     continue # They can't see this service to change the configuration.
-                if not User.CheckFlowException(self.user, src, destinationSvcRecord):
+                if not self._routing.HasFlowException(src, destinationSvcRecord):
                     flowException = False
                     break
 
@@ -447,7 +634,7 @@ class SynchronizationTask:
                 continue
 
             destSvc = destinationSvcRecord.Service
-            if destSvc.RequiresConfiguration(destinationSvcRecord):
+            if self._routing.RequiresConfiguration(destinationSvcRecord):
                 logger.info("\t\t" + destSvc.ID + " not configured")
                 activity.Record.MarkAsNotPresentOn(destinationSvcRecord, UserException(UserExceptionType.NotConfigured))
                 continue  # not configured, so we won't even try
@@ -487,7 +674,21 @@ class SynchronizationTask:
                 # The connection never gets saved in full again, so we can sub these in here at no risk.
                 conn.ExtendedAuthorization = extAuthDetails[0]
 
-    def _downloadActivityList(self, conn, exhaustive, no_add=False):
+    def _prepareActivityList(self, conn, exhaustive):
+        """ Returns False if listing this service should be deferred until an activity needs to go to it """
+        self._primeExtendedAuthDetails(conn)
+
+        logger.info("Ensuring partial sync poll subscription")
+        self._ensurePartialSyncPollingSubscription(conn)
+
+        if not exhaustive and conn.Service.PartialSyncRequiresTrigger and "TriggerPartialSync" not in conn.__dict__ and not conn.Service.ShouldForcePartialSyncTrigger(conn):
+            logger.info("Service %s has not been triggered" % conn.Service.ID)
+            self._deferredServices.append(conn._id)
+            return False
+        return True
+
+    def _checkActivityListBlocked(self, conn):
+        """ Excludes the service and returns True if it shouldn't be listed this sync """
         svc = conn.Service
         # Bail out as appropriate for the entire account (_syncErrors contains only blocking errors at this point)
         if [x for x in self._syncErrors[conn._id] if x["Scope"] == ServiceExceptionScope.Account]:
@@ -497,22 +698,34 @@ class SynchronizationTask:
         if [x for x in self._syncErrors[conn._id] if x["Scope"] == ServiceExceptionScope.Service]:
             logger.info("Service %s is blocked:" % conn.Service.ID)
             self._excludeService(conn, _unpackUserException([x for x in self._syncErrors[conn._id] if x["Scope"] == ServiceExceptionScope.Service][0]))
-            return
+            return True
 
         if svc.ID in DISABLED_SERVICES or svc.ID in WITHDRAWN_SERVICES:
             logger.info("Service %s is widthdrawn" % conn.Service.ID)
             self._excludeService(conn, UserException(UserExceptionType.Other))
-            return
+            return True
 
         if svc.RequiresExtendedAuthorizationDetails:
             if not conn.ExtendedAuthorization:
                 logger.info("No extended auth details for " + svc.ID)
                 self._excludeService(conn, UserException(UserExceptionType.MissingCredentials))
-                return
+                return True
+        return False
+
+    def _retrieveActivityList(self, conn, exhaustive):
+        logger.info("\tRetrieving list from " + conn.Service.ID)
+        with ServiceRateLimit.Call(conn.Service.ID):
+            return conn.Service.DownloadActivityList(conn, exhaustive)
+
+    def _downloadActivityList(self, conn, exhaustive, no_add=False):
+        if self._checkActivityListBlocked(conn):
+            return
+        self._accumulateActivityList(conn, lambda: self._retrieveActivityList(conn, exhaustive), no_add=no_add)
 
+    def _accumulateActivityList(self, conn, retrieveList, no_add=False):
+        # retrieveList either performs the listing, or collects the result of one performed elsewhere - either way, failures are attributed here.
         try:
-            logger.info("\tRetrieving list from " + svc.ID)
-            svcActivities, svcExclusions = svc.DownloadActivityList(conn, exhaustive)
+            svcActivities, svcExclusions = retrieveList()
         except (ServiceException, ServiceWarning) as e:
             self._syncErrors[conn._id].append(_packServiceException(SyncStep.List, e))
             self._excludeService(conn, e.UserException)
@@ -525,6 +738,30 @@ class SynchronizationTask:
         self._accumulateExclusions(conn, svcExclusions)
         self._accumulateActivities(conn, svcActivities, no_add=no_add)
 
+    def _downloadActivityListsConcurrently(self, exhaustive, heartbeat_callback=None):
+        # Only the remote listing calls run in parallel - everything that decides on or records exclusions still happens here, in connection order.
+        pendingLists = []
+        with ThreadPoolExecutor(max_workers=SYNC_LIST_CONCURRENCY) as executor:
+            for conn in self._serviceConnections:
+                if len(self._serviceConnections) - len(self._excludedServices) <= 1:
+                    raise SynchronizationCompleteException()
+
+                if not self._prepareActivityList(conn, exhaustive) or self._checkActivityListBlocked(conn):
+                    continue
+
+                pendingLists.append((conn, executor.submit(self._inTaskContext(self._retrieveActivityList), conn, exhaustive)))
+
+            # Merging in connection order keeps deduplication identical to listing them one after another
+            for conn, pendingList in pendingLists:
+                if heartbeat_callback:
+                    heartbeat_callback(SyncStep.List)
+
+                self._updateSyncProgress(SyncStep.List, conn.Service.ID)
+                self._accumulateActivityList(conn, pendingList.result)
+
+        if len(self._serviceConnections) - len(self._excludedServices) <= 1:
+            raise SynchronizationCompleteException()
+
     def _estimateFallbackTZ(self, activities):
         from collections import Counter
         # With the hope that the majority of the activity records returned will have TZs, and the user's current TZ will constitute the majority.
@@ -547,7 +784,9 @@ class SynchronizationTask:
     def _processActivityOrigins(self):
         logger.info("Reading activity origins")
         origins = list(db.activity_origins.find({"ActivityUID": {"$in": [x.UID for x in self._activities]}}))
-        activitiesWithOrigins = [x["ActivityUID"] for x in origins]
+        knownOrigins = {}
+        for origin in origins:
+            knownOrigins.setdefault(origin["ActivityUID"], origin) # The first one wins, as it did when these were searched in order
 
         logger.info("Populating origins")
         # Populate origins
@@ -555,18 +794,19 @@ class SynchronizationTask:
             if len(activity.ServiceDataCollection.keys()) == 1:
                 if not len(self._excludedServices):  # otherwise it could be incorrectly recorded
                     # we can log the origin of this activity
-                    if activity.UID not in activitiesWithOrigins:  # No need to hammer the database updating these when they haven't changed
+                    if activity.UID not in knownOrigins:  # No need to hammer the database updating these when they haven't changed
                         logger.info("\t\t Updating db with origin for proceeding activity")
-                        db.activity_origins.insert({"ActivityUID": activity.UID, "Origin": {"Service": [[y for y in self._serviceConnections if y._id == x][0] for x in activity.ServiceDataCollection.keys()][0].Service.ID, "ExternalID": [[y.ExternalID for y in self._serviceConnections if y._id == x][0] for x in activity.ServiceDataCollection.keys()][0]}})
-                    activity.Origin = [[y for y in self._serviceConnections if y._id == x][0] for x in activity.ServiceDataCollection.keys()][0]
+                        originConn = self._routing.Connection(list(activity.ServiceDataCollection.keys())[0])
+                        db.activity_origins.insert({"ActivityUID": activity.UID, "Origin": {"Service": originConn.Service.ID, "ExternalID": originConn.ExternalID}})
+                    activity.Origin = self._routing.Connection(list(activity.ServiceDataCollection.keys())[0])
             else:
-                if activity.UID in activitiesWithOrigins:
-                    knownOrigin = [x for x in origins if x["ActivityUID"] == activity.UID]
-                    connectedOrigins = [x for x in self._serviceConnections if knownOrigin[0]["Origin"]["Service"] == x.Service.ID and knownOrigin[0]["Origin"]["ExternalID"] == x.ExternalID]
-                    if len(connectedOrigins) > 0:  # they might have disconnected it
-                        activity.Origin = connectedOrigins[0]
+                if activity.UID in knownOrigins:
+                    knownOrigin = knownOrigins[activity.UID]
+                    connectedOrigin = self._routing.ConnectionByExternalID(knownOrigin["Origin"]["Service"], knownOrigin["Origin"]["ExternalID"])
+                    if connectedOrigin:  # they might have disconnected it
+                        activity.Origin = connectedOrigin
                     else:
-                        activity.Origin = ServiceRecord(knownOrigin[0]["Origin"])  # I have it on good authority that this will work
+                        activity.Origin = ServiceRecord(knownOrigin["Origin"])  # I have it on good authority that this will work
 
     def _updateSynchronizedActivities(self, activity):
         # Locally mark this activity as present on the appropriate services.
@@ -574,29 +814,34 @@ class SynchronizationTask:
         #   Before, I had moved this under all the eligibility/recipient checks, but that could cause persistent duplicate self._activities when the user had already manually uploaded the same activity to multiple sites.
         updateServicesWithExistingActivity = False
         for serviceWithExistingActivityId in activity.ServiceDataCollection.keys():
-            serviceWithExistingActivity = [x for x in self._serviceConnections if x._id == serviceWithExistingActivityId][0]
-            if not hasattr(serviceWithExistingActivity, "SynchronizedActivities") or not (activity.UIDs <= set(serviceWithExistingActivity.SynchronizedActivities)):
+            serviceWithExistingActivity = self._routing.Connection(serviceWithExistingActivityId)
+            if not self._synchronizedActivities.HasAll(serviceWithExistingActivity._id, activity.UIDs):
                 updateServicesWithExistingActivity = True
                 break
 
         if updateServicesWithExistingActivity:
             logger.debug("\t\tUpdating SynchronizedActivities")
-            db.connections.update({"_id": {"$in": list(activity.ServiceDataCollection.keys())}},
-                                  {"$addToSet": {"SynchronizedActivities": {"$each": list(activity.UIDs)}}},
-                                  multi=True)
+            self._synchronizedActivities.Add(list(activity.ServiceDataCollection.keys()), activity.UIDs)
 
     def _updateActivityRecordInitialPrescence(self, activity):
         for connWithExistingActivityId in activity.ServiceDataCollection.keys():
-            connWithExistingActivity = [x for x in self._serviceConnections if x._id == connWithExistingActivityId][0]
+            connWithExistingActivity = self._routing.Connection(connWithExistingActivityId)
             activity.Record.MarkAsPresentOn(connWithExistingActivity)
         for conn in self._serviceConnections:
-            if hasattr(conn, "SynchronizedActivities") and len([x for x in activity.UIDs if x in conn.SynchronizedActivities]):
+            if self._synchronizedActivities.HasAny(conn._id, activity.UIDs):
                 activity.Record.MarkAsPresentOn(conn)
 
-    def _downloadActivity(self, activity):
+    def _downloadActivity(self, activity, deferred=None):
+        # Given a deferred list, the bookkeeping (errors, exclusions, the activity record) is left in it rather than done here - so it can be applied on the sync thread, which is busy with the same things
+        def record(action, *args):
+            if deferred is None:
+                action(*args)
+            else:
+                deferred.append((action, args))
+
         act = None
         actAvailableFromSvcIds = activity.ServiceDataCollection.keys()
-        actAvailableFromSvcs = [[x for x in self._serviceConnections if x._id == dlSvcRecId][0] for dlSvcRecId in actAvailableFromSvcIds]
+        actAvailableFromSvcs = self._routing.Connections(actAvailableFromSvcIds)
 
         servicePriorityList = Service.PreferredDownloadPriorityList()
         actAvailableFromSvcs.sort(key=lambda x: servicePriorityList.index(x.Service))
@@ -608,11 +853,11 @@ class SynchronizationTask:
             dlSvc = dlSvcRecord.Service
             logger.info("\tfrom " + dlSvc.ID)
             if activity.UID in self._syncExclusions[dlSvcRecord._id]:
-                activity.Record.MarkAsNotPresentOtherwise(_unpackUserException(self._syncExclusions[dlSvcRecord._id][activity.UID]))
+                record(activity.Record.MarkAsNotPresentOtherwise, _unpackUserException(self._syncExclusions[dlSvcRecord._id][activity.UID]))
                 logger.info("\t\t...has activity exclusion logged")
                 continue
             if self._isServiceExcluded(dlSvcRecord):
-                activity.Record.MarkAsNotPresentOtherwise(self._getServiceExclusionUserException(dlSvcRecord))
+                record(activity.Record.MarkAsNotPresentOtherwise, self._getServiceExclusionUserException(dlSvcRecord))
                 logger.info("\t\t...service became excluded after listing") # Because otherwise we'd never have been trying to download from it in the first place.
                 continue
 
@@ -620,35 +865,36 @@ class SynchronizationTask:
             # Load in the service data in the same place they left it.
             workingCopy.ServiceData = workingCopy.ServiceDataCollection[dlSvcRecord._id] if dlSvcRecord._id in workingCopy.ServiceDataCollection else None
             try:
-                workingCopy = dlSvc.DownloadActivity(dlSvcRecord, workingCopy)
+                with ServiceRateLimit.Call(dlSvc.ID):
+                    workingCopy = dlSvc.DownloadActivity(dlSvcRecord, workingCopy)
             except (ServiceException, ServiceWarning) as e:
-                self._syncErrors[dlSvcRecord._id].append(_packServiceException(SyncStep.Download, e))
+                record(self._syncErrors[dlSvcRecord._id].append, _packServiceException(SyncStep.Download, e))
                 if e.Block and e.Scope == ServiceExceptionScope.Service: # I can't imagine why the same would happen at the account level, so there's no behaviour to immediately abort the sync in that case.
-                    self._excludeService(dlSvcRecord, e.UserException)
+                    record(self._excludeService, dlSvcRecord, e.UserException)
                 if not issubclass(e.__class__, ServiceWarning):
-                    activity.Record.MarkAsNotPresentOtherwise(e.UserException)
+                    record(activity.Record.MarkAsNotPresentOtherwise, e.UserException)
                     continue
             except APIExcludeActivity as e:
                 logger.info("\t\texcluded by service: %s" % e.Message)
                 e.Activity = workingCopy
-                self._accumulateExclusions(dlSvcRecord, e)
-                activity.Record.MarkAsNotPresentOtherwise(e.UserException)
+                record(self._accumulateExclusions, dlSvcRecord, e)
+                record(activity.Record.MarkAsNotPresentOtherwise, e.UserException)
                 continue
             except Exception as e:
-                self._syncErrors[dlSvcRecord._id].append({"Step": SyncStep.Download, "Message": _formatExc()})
-                activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.DownloadError))
+                record(self._syncErrors[dlSvcRecord._id].append, {"Step": SyncStep.Download, "Message": _formatExc()})
+                record(activity.Record.MarkAsNotPresentOtherwise, UserException(UserExceptionType.DownloadError))
                 continue
 
-            if workingCopy.Private and not dlSvcRecord.GetConfiguration()["sync_private"]:
+            if workingCopy.Private and not self._routing.Configuration(dlSvcRecord)["sync_private"]:
                 logger.info("\t\t...is private and restricted from sync")  # Sync exclusion instead?
-                activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.Private))
+                record(activity.Record.MarkAsNotPresentOtherwise, UserException(UserExceptionType.Private))
                 continue
             try:
                 workingCopy.CheckSanity()
             except:
                 logger.info("\t\t...failed sanity check")
-                self._accumulateExclusions(dlSvcRecord, APIExcludeActivity("Sanity check failed " + _formatExc(), activity=workingCopy))
-                activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.SanityError))
+                record(self._accumulateExclusions, dlSvcRecord, APIExcludeActivity("Sanity check failed " + _formatExc(), activity=workingCopy))
+                record(activity.Record.MarkAsNotPresentOtherwise, UserException(UserExceptionType.SanityError))
                 continue
             else:
                 act = workingCopy
@@ -657,10 +903,16 @@ class SynchronizationTask:
         # If nothing was downloaded at this point, the activity record will show the most recent error - which is fine enough, since only one service is needed to get the activity.
         return act, dlSvc
 
-    def _uploadActivity(self, activity, destinationServiceRec):
-        destSvc = destinationServiceRec.Service
+    def _performUpload(self, activity, destinationServiceRec):
+        with ServiceRateLimit.Call(destinationServiceRec.Service.ID):
+            return destinationServiceRec.Service.UploadActivity(destinationServiceRec, activity)
+
+    def _uploadActivity(self, activity, destinationServiceRec, retrieveUpload=None):
+        # retrieveUpload, if given, collects the result of an upload performed elsewhere - either way, failures are recorded here.
         try:
-            return destSvc.UploadActivity(destinationServiceRec, activity)
+            if retrieveUpload:
+                return retrieveUpload()
+            return self._performUpload(activity, destinationServiceRec)
         except (ServiceException, ServiceWarning) as e:
             self._syncErrors[destinationServiceRec._id].append(_packServiceException(SyncStep.Upload, e))
             if e.Block and e.Scope == ServiceExceptionScope.Service: # Similarly, no behaviour to immediately abort the sync if an account-level exception is raised
@@ -673,13 +925,134 @@ class SynchronizationTask:
             activity.Record.MarkAsNotPresentOn(destinationServiceRec, UserException(UserExceptionType.UploadError))
             raise UploadException()
 
-    def Run(self, exhaustive=False, null_next_sync_on_unlock=False, heartbeat_callback=None):
+    def _uploadActivityToServices(self, activity, destinationServiceRecs, heartbeat_callback=None):
+        # Yields (destinationServiceRec, uploaded_external_id) for each successful upload, in the order the services were given.
+        # Failed uploads have already been recorded by _uploadActivity.
+        def upload(destinationServiceRec, retrieveUpload=None):
+            try:
+                uploaded_external_id = self._uploadActivity(activity, destinationServiceRec, retrieveUpload=retrieveUpload)
+            except UploadException:
+                return False, None # At this point it's already been added to the error collection, so we can just bail.
+            logger.info("\t  Uploaded to " + destinationServiceRec.Service.ID)
+            return True, uploaded_external_id
+
+        if SYNC_UPLOAD_CONCURRENCY > 1 and len(destinationServiceRecs) > 1:
+            if heartbeat_callback:
+                heartbeat_callback(SyncStep.Upload)
+            # A slow upload (e.g. one that polls until the service finishes processing it) no longer holds up the others
+            # Only the uploads themselves run on the pool - whether they worked out is recorded here, in order
+            with ThreadPoolExecutor(max_workers=min(SYNC_UPLOAD_CONCURRENCY, len(destinationServiceRecs))) as executor:
+                pendingUploads = []
+                for destinationServiceRec in destinationServiceRecs:
+                    logger.info("\t  Uploading to " + destinationServiceRec.Service.ID)
+                    pendingUploads.append((destinationServiceRec, executor.submit(self._inTaskContext(self._performUpload), activity, destinationServiceRec)))
+                for destinationServiceRec, pendingUpload in pendingUploads:
+                    uploaded, uploaded_external_id = upload(destinationServiceRec, pendingUpload.result)
+                    if heartbeat_callback:
+                        heartbeat_callback(SyncStep.Upload)
+                    if uploaded:
+                        yield destinationServiceRec, uploaded_external_id
+        else:
+            for destinationServiceRec in destinationServiceRecs:
+                if heartbeat_callback:
+                    heartbeat_callback(SyncStep.Upload)
+                logger.info("\t  Uploading to " + destinationServiceRec.Service.ID)
+                uploaded, uploaded_external_id = upload(destinationServiceRec)
+                if uploaded:
+                    yield destinationServiceRec, uploaded_external_id
+
+    def _downloadActivityAhead(self, activity):
+        # Runs on the download pool - see _collectDownload
+        deferred = []
+        return self._downloadActivity(activity, deferred=deferred), deferred
+
+    def _collectDownload(self, pendingDownload):
+        result, deferred = pendingDownload.result()
+        for action, args in deferred:
+            action(*args)
+        return result
+
+    def _countPendingWaypoints(self, pendingActivities):
+        # Downloads still underway haven't said how big they are yet, so they're counted as the biggest seen so far
+        waypointCount = 0
+        for activity, eligibleServices, pendingDownload in pendingActivities:
+            if not pendingDownload.done():
+                waypointCount += self._largestDownloadWaypoints
+            elif not pendingDownload.exception():
+                (full_activity, activitySource), deferred = pendingDownload.result()
+                if full_activity:
+                    activityWaypoints = full_activity.CountTotalWaypoints()
+                    self._largestDownloadWaypoints = max(self._largestDownloadWaypoints, activityWaypoints)
+                    waypointCount += activityWaypoints
+        return waypointCount
+
+    def _synchronizeActivity(self, activity, eligibleServices, retrieveActivity, heartbeat_callback=None):
+        # retrieveActivity either downloads the full activity, or collects a download that's already underway.
+        from tapiriik.services.interchange import ActivityStatisticUnit
+
+        full_activity, activitySource = retrieveActivity()
+
+        if full_activity is None:  # couldn't download it from anywhere, or the places that had it said it was broken
+            # The activity record gets updated in _downloadActivity
+            return
+
+        full_activity.CleanStats()
+        full_activity.CleanWaypoints()
+
+        try:
+            full_activity.EnsureTZ()
+        except:
+            logger.error("\tCould not determine TZ")
+            self._accumulateExclusions(full_activity.SourceConnection, APIExcludeActivity("Could not determine TZ", activity=full_activity, permanent=False))
+            activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.UnknownTZ))
+            return
+        else:
+            logger.debug("\tDetermined TZ %s" % full_activity.TZ)
+
+        activity.Record.SetActivity(activity) # Update with whatever more accurate information we may have.
+        self._activityRecordIndex.Update(activity.Record)
+
+        full_activity.Record = activity.Record # Some services don't return the same object, so this gets lost, which is meh, but...
+
+        uploadServices = []
+        for destinationSvcRecord in eligibleServices:
+            destSvc = destinationSvcRecord.Service
+            if self._isServiceExcluded(destinationSvcRecord):
+                # Eligibility may have been determined before an earlier activity's upload got the service excluded
+                logger.info("\t\t...%s excluded since eligibility was determined" % destSvc.ID)
+                activity.Record.MarkAsNotPresentOn(destinationSvcRecord, self._getServiceExclusionUserException(destinationSvcRecord))
+                continue
+            if not destSvc.ReceivesStationaryActivities and full_activity.Stationary:
+                logger.info("\t\t...marked as stationary during download")
+                activity.Record.MarkAsNotPresentOn(destinationSvcRecord, UserException(UserExceptionType.StationaryUnsupported))
+                continue
+            uploadServices.append(destinationSvcRecord)
+
+        for destinationSvcRecord, uploaded_external_id in self._uploadActivityToServices(full_activity, uploadServices, heartbeat_callback=heartbeat_callback):
+            destSvc = destinationSvcRecord.Service
+            activity.Record.MarkAsSynchronizedTo(destinationSvcRecord)
+
+            if uploaded_external_id:
+                # record external ID, for posterity (and later debugging)
+                self._writeBuffer.Insert(db.uploaded_activities, {"ExternalID": uploaded_external_id, "Service": destSvc.ID, "UserExternalID": destinationSvcRecord.ExternalID, "Timestamp": datetime.utcnow()})
+            # flag as successful
+            self._synchronizedActivities.Add([destinationSvcRecord._id], activity.UIDs)
+
+            self._writeBuffer.Update(db.sync_stats, {"ActivityID": activity.UID}, {"$addToSet": {"DestinationServices": destSvc.ID, "SourceServices": activitySource.ID}, "$set": {"Distance": activity.Stats.Distance.asUnits(ActivityStatisticUnit.Meters).Value, "Timestamp": datetime.utcnow()}}, upsert=True)
+
+    def Run(self, exhaustive=False, null_next_sync_on_unlock=False, heartbeat_callback=None, already_locked=False, time_budget=None):
+        # With a time_budget (timedelta), it stops taking on new activities once that's up, and sets OutOfTime - whatever's been done so far is written back as usual
+        deadline = datetime.utcnow() + time_budget if time_budget is not None else None
+        self.OutOfTime = False
+
         if len(self.user["ConnectedServices"]) <= 1:
+            if already_locked:
+                self._unlockUser(null_next_sync_on_unlock)
             return # Done and done!
-        from tapiriik.services.interchange import ActivityStatisticUnit
 
-        # Mark this user as in-progress.
-        self._lockUser()
+        # Mark this user as in-progress - unless they were claimed locked in the first place.
+        if not already_locked:
+            self._lockUser()
 
         # Reset their progress
         self._updateSyncProgress(SyncStep.List, 0)
@@ -691,9 +1064,12 @@ class SynchronizationTask:
         # Sets up serviceConnections
         self._loadServiceData()
 
+        self._routing = SynchronizationRouting(self.user, self._serviceConnections)
+
         self._loadExtendedAuthData()
 
         self._activities = []
+        self._activityIndex = ActivityDeduplicationIndex()
         self._excludedServices = {}
         self._deferredServices = []
 
@@ -703,26 +1079,22 @@ class SynchronizationTask:
 
         try:
             try:
-                for conn in self._serviceConnections:
-                    # If we're not going to be doing anything anyways, stop now
-                    if len(self._serviceConnections) - len(self._excludedServices) <= 1:
-                        raise SynchronizationCompleteException()
-
-                    self._primeExtendedAuthDetails(conn)
-
-                    logger.info("Ensuring partial sync poll subscription")
-                    self._ensurePartialSyncPollingSubscription(conn)
+                if SYNC_LIST_CONCURRENCY > 1:
+                    self._downloadActivityListsConcurrently(exhaustive, heartbeat_callback=heartbeat_callback)
+                else:
+                    for conn in self._serviceConnections:
+                        # If we're not going to be doing anything anyways, stop now
+                        if len(self._serviceConnections) - len(self._excludedServices) <= 1:
+                            raise SynchronizationCompleteException()
 
-                    if not exhaustive and conn.Service.PartialSyncRequiresTrigger and "TriggerPartialSync" not in conn.__dict__ and not conn.Service.ShouldForcePartialSyncTrigger(conn):
-                        logger.info("Service %s has not been triggered" % conn.Service.ID)
-                        self._deferredServices.append(conn._id)
-                        continue
+                        if not self._prepareActivityList(conn, exhaustive):
+                            continue
 
-                    if heartbeat_callback:
-                        heartbeat_callback(SyncStep.List)
+                        if heartbeat_callback:
+                            heartbeat_callback(SyncStep.List)
 
-                    self._updateSyncProgress(SyncStep.List, conn.Service.ID)
-                    self._downloadActivityList(conn, exhaustive)
+                        self._updateSyncProgress(SyncStep.List, conn.Service.ID)
+                        self._downloadActivityList(conn, exhaustive)
 
                 self._applyFallbackTZ()
 
@@ -730,150 +1102,136 @@ class SynchronizationTask:
 
                 # Makes reading the logs much easier.
                 self._activities = sorted(self._activities, key=lambda v: v.StartTime.replace(tzinfo=None), reverse=True)
+                # Deferred listings match against the activities in this order
+                self._activityIndex = ActivityDeduplicationIndex(self._activities)
+
+                # Pull in what's known to be synchronized, and the activity records, for everything listed in one go rather than activity-by-activity
+                listedUIDs = [uid for activity in self._activities for uid in activity.UIDs]
+                self._synchronizedActivities.Load(listedUIDs)
+                self._loadActivityRecords(listedUIDs)
 
                 totalActivities = len(self._activities)
                 processedActivities = 0
 
-                for activity in self._activities:
-                    logger.info(str(activity) + " " + str(activity.UID[:3]) + " from " + str([[y.Service.ID for y in self._serviceConnections if y._id == x][0] for x in activity.ServiceDataCollection.keys()]))
-                    logger.info(" Name: %s Notes: %s Distance: %s%s" % (activity.Name[:15] if activity.Name else "", activity.Notes[:15] if activity.Notes else "", activity.Stats.Distance.Value, activity.Stats.Distance.Units))
-                    try:
-                        activity.Record = self._findOrCreateActivityRecord(activity) # Make it a member of the activity, to avoid passing it around as a seperate parameter everywhere.
-
-                        self._updateSynchronizedActivities(activity)
-                        self._updateActivityRecordInitialPrescence(activity)
-
-                        # We don't always know if the activity is private before it's downloaded, but we can check anyways since it saves a lot of time.
-                        if activity.Private:
-                            actAvailableFromConnIds = activity.ServiceDataCollection.keys()
-                            actAvailableFromConns = [[x for x in self._serviceConnections if x._id == dlSvcRecId][0] for dlSvcRecId in actAvailableFromConnIds]
-                            override_private = False
-                            for conn in actAvailableFromConns:
-                                if conn.GetConfiguration()["sync_private"]:
-                                    override_private = True
-                                    break
-
-                            if not override_private:
-                                logger.info("\t\t...is private and restricted from sync (pre-download)")  # Sync exclusion instead?
-                                activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.Private))
-                                raise ActivityShouldNotSynchronizeException()
-
-                        recipientServices = None
-                        eligibleServices = None
-                        while True:
-                            # recipientServices are services that don't already have this activity
-                            recipientServices = self._determineRecipientServices(activity)
-                            if len(recipientServices) == 0:
-                                totalActivities -= 1  # doesn't count
-                                raise ActivityShouldNotSynchronizeException()
-
-                            # eligibleServices are services that are permitted to receive this activity - taking into account flow exceptions, excluded services, unfufilled configuration requirements, etc.
-                            eligibleServices = self._determineEligibleRecipientServices(activity=activity, recipientServices=recipientServices)
-
-                            if not len(eligibleServices):
-                                logger.info("\t\t...has no eligible destinations")
-                                totalActivities -= 1  # Again, doesn't really count.
-                                raise ActivityShouldNotSynchronizeException()
-
-                            has_deferred = False
-                            for conn in eligibleServices:
-                                if conn._id in self._deferredServices:
-                                    logger.info("Doing deferred list from %s" % conn.Service.ID)
-                                    # no_add since...
-                                    #  a) we're iterating over the list it'd be adding to, and who knows what will happen then
-                                    #  b) for the current use of deferred services, we don't care about new activities
-                                    self._downloadActivityList(conn, exhaustive, no_add=True)
-                                    self._deferredServices.remove(conn._id)
-                                    has_deferred = True
-
-                            # If we had deferred listing activities from a service, we have to repeat this loop to consider the new info
-                            # Otherwise, once was enough
-                            if not has_deferred:
-                                break
-
-
-                        # This is after the above exit points since they're the most frequent (& cheapest) cases - want to avoid DB churn
-                        if heartbeat_callback:
-                            heartbeat_callback(SyncStep.Download)
-
-                        if processedActivities == 0:
-                            syncProgress = 0
-                        elif totalActivities <= 0:
-                            syncProgress = 1
-                        else:
-                            syncProgress = max(0, min(1, processedActivities / totalActivities))
-                        self._updateSyncProgress(SyncStep.Download, syncProgress)
-
-                        # The second most important line of logging in the application...
-                        logger.info("\t\t...to " + str([x.Service.ID for x in recipientServices]))
-
-                        # Download the full activity record
-                        full_activity, activitySource = self._downloadActivity(activity)
-
-                        if full_activity is None:  # couldn't download it from anywhere, or the places that had it said it was broken
-                            # The activity record gets updated in _downloadActivity
-                            processedActivities += 1  # we tried
-                            raise ActivityShouldNotSynchronizeException()
-
-                        full_activity.CleanStats()
-                        full_activity.CleanWaypoints()
-
+                pendingActivities = deque()
+                self._largestDownloadWaypoints = 0
+                downloadExecutor = ThreadPoolExecutor(max_workers=SYNC_DOWNLOAD_LOOKAHEAD) if SYNC_DOWNLOAD_LOOKAHEAD > 0 else None
+                try:
+                    for activity in self._activities:
+                        if deadline and datetime.utcnow() > deadline:
+                            # The rest can wait their turn like everyone else - those already downloading are finished off below
+                            logger.info("Out of time, %d of %d activities processed" % (processedActivities, totalActivities))
+                            self.OutOfTime = True
+                            break
+                        logger.info(str(activity) + " " + str(activity.UID[:3]) + " from " + str([x.Service.ID for x in self._routing.Connections(activity.ServiceDataCollection.keys())]))
+                        logger.info(" Name: %s Notes: %s Distance: %s%s" % (activity.Name[:15] if activity.Name else "", activity.Notes[:15] if activity.Notes else "", activity.Stats.Distance.Value, activity.Stats.Distance.Units))
                         try:
-                            full_activity.EnsureTZ()
-                        except:
-                            logger.error("\tCould not determine TZ")
-                            self._accumulateExclusions(full_activity.SourceConnection, APIExcludeActivity("Could not determine TZ", activity=full_activity, permanent=False))
-                            activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.UnknownTZ))
-                            raise ActivityShouldNotSynchronizeException()
-                        else:
-                            logger.debug("\tDetermined TZ %s" % full_activity.TZ)
-
-                        activity.Record.SetActivity(activity) # Update with whatever more accurate information we may have.
+                            activity.Record = self._findOrCreateActivityRecord(activity) # Make it a member of the activity, to avoid passing it around as a seperate parameter everywhere.
+
+                            self._updateSynchronizedActivities(activity)
+                            self._updateActivityRecordInitialPrescence(activity)
+
+                            # We don't always know if the activity is private before it's downloaded, but we can check anyways since it saves a lot of time.
+                            if activity.Private:
+                                actAvailableFromConnIds = activity.ServiceDataCollection.keys()
+                                actAvailableFromConns = self._routing.Connections(actAvailableFromConnIds)
+                                override_private = False
+                                for conn in actAvailableFromConns:
+                                    if self._routing.Configuration(conn)["sync_private"]:
+                                        override_private = True
+                                        break
+
+                                if not override_private:
+                                    logger.info("\t\t...is private and restricted from sync (pre-download)")  # Sync exclusion instead?
+                                    activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.Private))
+                                    raise ActivityShouldNotSynchronizeException()
+
+                            recipientServices = None
+                            eligibleServices = None
+                            while True:
+                                # recipientServices are services that don't already have this activity
+                                recipientServices = self._determineRecipientServices(activity)
+                                if len(recipientServices) == 0:
+                                    totalActivities -= 1  # doesn't count
+                                    raise ActivityShouldNotSynchronizeException()
+
+                                # eligibleServices are services that are permitted to receive this activity - taking into account flow exceptions, excluded services, unfufilled configuration requirements, etc.
+                                eligibleServices = self._determineEligibleRecipientServices(activity=activity, recipientServices=recipientServices)
+
+                                if not len(eligibleServices):
+                                    logger.info("\t\t...has no eligible destinations")
+                                    totalActivities -= 1  # Again, doesn't really count.
+                                    raise ActivityShouldNotSynchronizeException()
+
+                                has_deferred = False
+                                for conn in eligibleServices:
+                                    if conn._id in self._deferredServices:
+                                        logger.info("Doing deferred list from %s" % conn.Service.ID)
+                                        # no_add since...
+                                        #  a) we're iterating over the list it'd be adding to, and who knows what will happen then
+                                        #  b) for the current use of deferred services, we don't care about new activities
+                                        self._downloadActivityList(conn, exhaustive, no_add=True)
+                                        self._deferredServices.remove(conn._id)
+                                        has_deferred = True
+
+                                # If we had deferred listing activities from a service, we have to repeat this loop to consider the new info
+                                # Otherwise, once was enough
+                                if not has_deferred:
+                                    break
 
-                        full_activity.Record = activity.Record # Some services don't return the same object, so this gets lost, which is meh, but...
 
-                        for destinationSvcRecord in eligibleServices:
+                            # This is after the above exit points since they're the most frequent (& cheapest) cases - want to avoid DB churn
                             if heartbeat_callback:
-                                heartbeat_callback(SyncStep.Upload)
-                            destSvc = destinationSvcRecord.Service
-                            if not destSvc.ReceivesStationaryActivities and full_activity.Stationary:
-                                logger.info("\t\t...marked as stationary during download")
-                                activity.Record.MarkAsNotPresentOn(destinationSvcRecord, UserException(UserExceptionType.StationaryUnsupported))
-                                continue
-
-                            uploaded_external_id = None
-                            logger.info("\t  Uploading to " + destSvc.ID)
-                            try:
-                                uploaded_external_id = self._uploadActivity(full_activity, destinationSvcRecord)
-                            except UploadException:
-                                continue # At this point it's already been added to the error collection, so we can just bail.
-                            logger.info("\t  Uploaded")
-
-                            activity.Record.MarkAsSynchronizedTo(destinationSvcRecord)
-
-                            if uploaded_external_id:
-                                # record external ID, for posterity (and later debugging)
-                                db.uploaded_activities.insert({"ExternalID": uploaded_external_id, "Service": destSvc.ID, "UserExternalID": destinationSvcRecord.ExternalID, "Timestamp": datetime.utcnow()})
-                            # flag as successful
-                            db.connections.update({"_id": destinationSvcRecord._id},
-                                                  {"$addToSet": {"SynchronizedActivities": {"$each": list(activity.UIDs)}}})
-
-                            db.sync_stats.update({"ActivityID": activity.UID}, {"$addToSet": {"DestinationServices": destSvc.ID, "SourceServices": activitySource.ID}, "$set": {"Distance": activity.Stats.Distance.asUnits(ActivityStatisticUnit.Meters).Value, "Timestamp": datetime.utcnow()}}, upsert=True)
-                        del full_activity
-                        processedActivities += 1
-                    except ActivityShouldNotSynchronizeException:
-                        continue
-                    finally:
-                        del activity
+                                heartbeat_callback(SyncStep.Download)
+
+                            if processedActivities == 0:
+                                syncProgress = 0
+                            elif totalActivities <= 0:
+                                syncProgress = 1
+                            else:
+                                syncProgress = max(0, min(1, processedActivities / totalActivities))
+                            self._updateSyncProgress(SyncStep.Download, syncProgress)
+
+                            # The second most important line of logging in the application...
+                            logger.info("\t\t...to " + str([x.Service.ID for x in recipientServices]))
+
+                            if downloadExecutor:
+                                # The download runs ahead on the pool, while activities downloaded before it are uploaded here, in order
+                                # Room is made before it starts, so what's downloading and what's waiting to be uploaded stay within the lookahead between them
+                                while pendingActivities and (len(pendingActivities) >= SYNC_DOWNLOAD_LOOKAHEAD or self._countPendingWaypoints(pendingActivities) > SYNC_DOWNLOAD_LOOKAHEAD_WAYPOINTS):
+                                    pendingActivity, pendingEligibleServices, pendingDownload = pendingActivities.popleft()
+                                    self._synchronizeActivity(pendingActivity, pendingEligibleServices, lambda: self._collectDownload(pendingDownload), heartbeat_callback=heartbeat_callback)
+                                    processedActivities += 1
+                                pendingActivities.append((activity, eligibleServices, downloadExecutor.submit(self._inTaskContext(self._downloadActivityAhead), activity)))
+                            else:
+                                self._synchronizeActivity(activity, eligibleServices, lambda: self._downloadActivity(activity), heartbeat_callback=heartbeat_callback)
+                                processedActivities += 1
+                        except ActivityShouldNotSynchronizeException:
+                            continue
+                        finally:
+                            del activity
+
+                    if downloadExecutor:
+                        while pendingActivities:
+                            pendingActivity, pendingEligibleServices, pendingDownload = pendingActivities.popleft()
+                            self._synchronizeActivity(pendingActivity, pendingEligibleServices, lambda: self._collectDownload(pendingDownload), heartbeat_callback=heartbeat_callback)
+                            processedActivities += 1
+                finally:
+                    # Whatever happened, nothing's left downloading once the user's unlocked
+                    if downloadExecutor:
+                        downloadExecutor.shutdown(wait=True)
 
             except SynchronizationCompleteException:
                 # This gets thrown when there is obviously nothing left to do - but we still need to clean things up.
                 logger.info("SynchronizationCompleteException thrown")
 
+            logger.info("Flushing buffered writes")
+            self._writeBuffer.Flush()
+
             logger.info("Writing back service data")
             self._writeBackSyncErrorsAndExclusions()
 
-            if exhaustive:
+            if exhaustive and not self.OutOfTime:
                 # Clean up potentially orphaned records, since we know everything is here.
                 logger.info("Clearing old activity records")
                 self._dropUntouchedActivityRecords()
@@ -884,7 +1242,8 @@ class SynchronizationTask:
             logger.info("Finalizing")
             # Clear non-persisted extended auth details.
             self._destroyExtendedAuthData()
-            # Unlock the user.
+            # Get the last of the progress in, then unlock the user.
+            SyncStatusReporter.Flush()
             self._unlockUser(null_next_sync_on_unlock)
 
         except SynchronizationConcurrencyException:
@@ -892,6 +1251,11 @@ class SynchronizationTask:
         except:
             # oops.
             logger.exception("Core sync exception")
+            # Whatever made it up before things went wrong should still be recorded as such
+            try:
+                self._writeBuffer.Flush()
+            except:
+                logger.exception("Could not flush buffered writes")
             raise
         else:
             logger.info("Finished sync for %s" % self.user["_id"])
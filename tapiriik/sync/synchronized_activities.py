@@ -0,0 +1,82 @@
+from tapiriik.database import db
+from pymongo.errors import BulkWriteError
+
+class SynchronizedActivities:
+    """ Which activity UIDs each connection is known to have, one (ConnectionID, UID) document apiece in db.synchronized_activities.
+        These used to be a SynchronizedActivities array embedded in the connection itself - which had to be read in full with every connection, and grew without bound.
+    """
+
+    # Keeps the $in queries well clear of the BSON document size limit
+    LoadBatchSize = 5000
+    # ...and the bulk writes a sensible size
+    WriteBatchSize = 1000
+
+    def EnsureIndexes():
+        # The unique index is what keeps the upserts from piling up duplicates - sync_worker makes sure of it at startup
+        db.synchronized_activities.ensure_index([("ConnectionID", 1), ("UID", 1)], unique=True)
+
+    def Add(connectionIds, uids, writeBuffer=None):
+        pairs = [(connectionId, uid) for connectionId in connectionIds for uid in uids]
+        if writeBuffer:
+            for connectionId, uid in pairs:
+                query = {"ConnectionID": connectionId, "UID": uid}
+                writeBuffer.Update(db.synchronized_activities, query, {"$set": query}, upsert=True)
+            return
+        for idx in range(0, len(pairs), SynchronizedActivities.WriteBatchSize):
+            # Unordered, so the whole batch goes in one round trip
+            bulk = db.synchronized_activities.initialize_unordered_bulk_op()
+            for connectionId, uid in pairs[idx:idx + SynchronizedActivities.WriteBatchSize]:
+                query = {"ConnectionID": connectionId, "UID": uid}
+                bulk.find(query).upsert().update_one({"$set": query})
+            try:
+                bulk.execute()
+            except BulkWriteError as e:
+                # Someone else (another sync, the migration script) got some of them in first - which is just as good
+                if any(x["code"] != 11000 for x in e.details["writeErrors"]) or e.details["writeConcernErrors"]:
+                    raise
+
+    def Clear(connectionId):
+        db.synchronized_activities.remove({"ConnectionID": connectionId}, multi=True)
+        db.connections.update({"_id": connectionId}, {"$unset": {"SynchronizedActivities": None}})
+
+    def Count(connectionId):
+        return db.synchronized_activities.find({"ConnectionID": connectionId}).count()
+
+    def MigrateEmbedded(connectionIds):
+        """ Moves any embedded SynchronizedActivities arrays on the given connections into the collection """
+        for conn in db.connections.find({"_id": {"$in": list(connectionIds)}, "SynchronizedActivities": {"$exists": True}}, {"SynchronizedActivities": 1}):
+            SynchronizedActivities.Add([conn["_id"]], list(set(conn["SynchronizedActivities"] or [])))
+            db.connections.update({"_id": conn["_id"]}, {"$unset": {"SynchronizedActivities": None}})
+
+
+class SynchronizedActivityIndex:
+    """ The in-memory view of SynchronizedActivities used during a sync.
+        Only the UIDs of activities that are actually being looked at are ever loaded - anything not loaded yet is fetched the first time it's asked about.
+    """
+
+    def __init__(self, connectionIds, writeBuffer=None):
+        self._connectionIds = list(connectionIds)
+        self._writeBuffer = writeBuffer
+        self._synchronized = dict((connectionId, set()) for connectionId in self._connectionIds)
+        self._loadedUIDs = set()
+
+    def Load(self, uids):
+        pendingUIDs = list(set(uids) - self._loadedUIDs)
+        for idx in range(0, len(pendingUIDs), SynchronizedActivities.LoadBatchSize):
+            batch = pendingUIDs[idx:idx + SynchronizedActivities.LoadBatchSize]
+            for record in db.synchronized_activities.find({"ConnectionID": {"$in": self._connectionIds}, "UID": {"$in": batch}}, {"ConnectionID": 1, "UID": 1}):
+                self._synchronized[record["ConnectionID"]].add(record["UID"])
+            self._loadedUIDs.update(batch)
+
+    def HasAny(self, connectionId, uids):
+        self.Load(uids)
+        return not self._synchronized[connectionId].isdisjoint(uids)
+
+    def HasAll(self, connectionId, uids):
+        self.Load(uids)
+        return self._synchronized[connectionId].issuperset(uids)
+
+    def Add(self, connectionIds, uids):
+        SynchronizedActivities.Add(connectionIds, uids, writeBuffer=self._writeBuffer)
+        for connectionId in connectionIds:
+            self._synchronized[connectionId].update(uids)
@@ -0,0 +1,53 @@
+from tapiriik.settings import SYNC_WRITE_BUFFER_SIZE, SYNC_WRITE_BUFFER_INTERVAL
+from datetime import datetime, timedelta
+from collections import OrderedDict
+
+class WriteBehindBuffer:
+    """ Holds on to the bookkeeping writes made during a sync and sends them in bulk, once enough have piled up or the oldest has waited long enough.
+        Nothing the sync reads back depends on these having been written yet. If they never make it, the worst that happens is an activity being uploaded again next time - which the services catch as a duplicate.
+    """
+
+    def __init__(self, maxOperations=None, maxAge=None):
+        self._maxOperations = SYNC_WRITE_BUFFER_SIZE if maxOperations is None else maxOperations
+        self._maxAge = timedelta(seconds=SYNC_WRITE_BUFFER_INTERVAL if maxAge is None else maxAge)
+        self._pending = OrderedDict() # collection name -> (collection, [operations])
+        self._count = 0
+        self._oldest = None
+
+    def Insert(self, collection, document):
+        self._queue(collection, ("insert", document))
+
+    def Update(self, collection, query, update, upsert=False, multi=False):
+        self._queue(collection, ("update", query, update, upsert, multi))
+
+    def _queue(self, collection, operation):
+        if collection.full_name not in self._pending:
+            self._pending[collection.full_name] = (collection, [])
+        self._pending[collection.full_name][1].append(operation)
+        self._count += 1
+        if self._oldest is None:
+            self._oldest = datetime.utcnow()
+        if self._count >= self._maxOperations or datetime.utcnow() - self._oldest >= self._maxAge:
+            self.Flush()
+
+    def Flush(self):
+        pending = self._pending
+        self._pending = OrderedDict()
+        self._count = 0
+        self._oldest = None
+        for collection, operations in pending.values():
+            # Ordered, so repeated upserts to the same document (e.g. sync_stats for each destination) can't race each other into duplicates
+            bulk = collection.initialize_ordered_bulk_op()
+            for operation in operations:
+                if operation[0] == "insert":
+                    bulk.insert(operation[1])
+                else:
+                    _, query, update, upsert, multi = operation
+                    selector = bulk.find(query)
+                    if upsert:
+                        selector = selector.upsert()
+                    if multi:
+                        selector.update(update)
+                    else:
+                        selector.update_one(update)
+            bulk.execute()
@@ -1,4 +1,6 @@
 from .sync import *
 from .interchange import *
 from .gpx import *
+from .fit import *
+from .tcx import *
 from .statistics import *
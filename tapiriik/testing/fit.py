@@ -0,0 +1,106 @@
+from tapiriik.testing.testtools import TapiriikTestCase
+from tapiriik.services.fit import FITIO, FITMessageGenerator, FITCRC
+from tapiriik.services.interchange import Activity, ActivityType, ActivityStatistic, ActivityStatisticUnit, Lap, Waypoint, WaypointType, Location
+from datetime import datetime, timedelta
+import random
+import struct
+import pytz
+
+def create_fit_activity(actType=ActivityType.Cycling, waypoints=300):
+    # TestTools.create_random_activity predates laps
+    tz = pytz.timezone("America/Toronto")
+    act = Activity(actType=actType, tz=tz)
+    act.StartTime = tz.localize(datetime(2014, 5, 3, 8, 0, 0))
+    waypointTime = act.StartTime
+    for x in range(3):
+        lap = Lap(startTime=waypointTime)
+        for y in range(waypoints // 3):
+            wp = Waypoint(waypointTime, location=Location(45 + random.random(), -75 + random.random(), random.random() * 300), hr=random.randint(90, 180), distance=y * 3.3, speed=random.random() * 5, temp=random.randint(-10, 30))
+            wp.Cadence = random.randint(70, 95)
+            if random.random() < 0.05:
+                wp.Type = WaypointType.Pause
+            elif random.random() < 0.1:
+                wp.Type = WaypointType.Resume
+            lap.Waypoints.append(wp)
+            waypointTime += timedelta(seconds=random.choice([1, 1, 1, 2, 5, 40]))
+        lap.EndTime = waypointTime
+        lap.Stats.HR = ActivityStatistic(ActivityStatisticUnit.BeatsPerMinute, avg=140, max=170)
+        act.Laps.append(lap)
+    act.EndTime = waypointTime
+    act.Stats.Distance = ActivityStatistic(ActivityStatisticUnit.Meters, value=5234.5)
+    return act
+
+def nibble_crc(bytestring, crc=0):
+    # How FITIO._calculateCRC used to do it (per the FIT SDK)
+    crc_table = [0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401, 0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400]
+    for byte in bytestring:
+        tmp = crc_table[crc & 0xF]
+        crc = (crc >> 4) & 0x0FFF
+        crc = crc ^ tmp ^ crc_table[byte & 0xF]
+
+        tmp = crc_table[crc & 0xF]
+        crc = (crc >> 4) & 0x0FFF
+        crc = crc ^ tmp ^ crc_table[(byte >> 4) & 0xF]
+    return crc
+
+
+class FITTests(TapiriikTestCase):
+    def test_round_trip(self):
+        act = create_fit_activity()
+        fit = FITIO.Dump(act)
+        act2 = FITIO.Parse(memoryview(fit))
+        self.assertEqual(FITIO.Dump(act2), fit)
+        self.assertEqual(act2.Type, act.Type)
+        self.assertEqual(act2.StartTime, act.StartTime)
+        self.assertEqual([len(lap.Waypoints) for lap in act2.Laps], [len(lap.Waypoints) for lap in act.Laps])
+        self.assertEqual(act2.Laps[0].Waypoints[1].HR, act.Laps[0].Waypoints[1].HR)
+        self.assertEqual([wp.Timestamp for lap in act2.Laps for wp in lap.Waypoints], [wp.Timestamp for lap in act.Laps for wp in lap.Waypoints])
+        self.assertAlmostEqual(act2.Laps[0].Waypoints[1].Location.Latitude, act.Laps[0].Waypoints[1].Location.Latitude, places=6)
+
+    def test_batched_messages(self):
+        records = [{"timestamp": datetime(2014, 5, 3, 12, 0, x), "heart_rate": 100 + x * 80} for x in range(4)] # The last two are out of range, so should be invalid
+        records.append({"timestamp": datetime(2014, 5, 3, 12, 1, 0), "position_lat": 45.1, "position_long": -75.2})
+        sequential = FITMessageGenerator()
+        for record in records:
+            sequential.GenerateMessage("record", **record)
+        batched = FITMessageGenerator()
+        batched.GenerateMessages("record", records)
+        self.assertEqual(batched.GetResult(), sequential.GetResult())
+        act = FITIO.Parse(FITIO._generateHeader(len(batched.GetResult())) + batched.GetResult() + b"\0\0")
+        self.assertEqual([wp.HR for wp in act.Laps[0].Waypoints], [100, 180, None, None, None])
+
+    def test_crc(self):
+        for length in [0, 1, 2, 15, 256, 4099]:
+            data = bytes(random.getrandbits(8) for x in range(length))
+            start = random.getrandbits(16)
+            self.assertEqual(FITCRC.Update(start, data), nibble_crc(data, start))
+            split = random.randint(0, length)
+            self.assertEqual(FITCRC.Update(FITCRC.Update(start, data[:split]), data[split:]), nibble_crc(data, start))
+            self.assertEqual(FITCRC.Combine(nibble_crc(data[:split], start), nibble_crc(data[split:]), length - split), nibble_crc(data, start))
+
+    def test_dump_crc(self):
+        fit = FITIO.Dump(create_fit_activity())
+        self.assertEqual(struct.unpack("<H", fit[-2:])[0], nibble_crc(fit[:-2]))
+
+    def test_compressed_timestamps(self):
+        start = datetime(2014, 5, 3, 12, 0, 0)
+        offsets = [0, 1, 2, 33, 65, 66, 100, 101] # 31s still fits, 32s doesn't
+        fmg = FITMessageGenerator()
+        fmg.GenerateMessages("record", [{"timestamp": start + timedelta(seconds=x), "heart_rate": 100 + x % 50} for x in offsets], compress_timestamp=True)
+        records = fmg.GetResult()
+        act = FITIO.Parse(FITIO._generateHeader(len(records)) + records + b"\0\0")
+        self.assertEqual([wp.Timestamp.replace(tzinfo=None) for wp in act.Laps[0].Waypoints], [start + timedelta(seconds=x) for x in offsets])
+        self.assertEqual([wp.HR for wp in act.Laps[0].Waypoints], [100 + x % 50 for x in offsets])
+        # 2 definitions, 3 full records (at the start, and after each gap > 31s), 5 compressed
+        self.assertEqual(len(records), (6 + 3 * 2) + (6 + 3) + 3 * 6 + 5 * 2)
+
+    def test_parse_compressed_timestamps(self):
+        records = struct.pack(">BBBHB", 0x40, 0, 1, 20, 2) + bytes([253, 4, 0x86, 3, 1, 0x02]) # Big-endian, timestamp & HR
+        records += struct.pack(">BIB", 0x00, 1000, 100)
+        records += struct.pack("<BBBHB", 0x41, 0, 0, 20, 1) + bytes([3, 1, 0x02]) # Just HR
+        records += bytes([0x80 | (1 << 5) | 10, 110]) # 1000 is 8 past the last multiple of 32, so this is 1002
+        records += bytes([0x80 | (1 << 5) | 5, 120]) # ...and this one rolls over to 1029
+        act = FITIO.Parse(FITIO._generateHeader(len(records)) + records + b"\0\0")
+        epoch = datetime(1989, 12, 31, tzinfo=pytz.utc)
+        self.assertEqual([(wp.Timestamp - epoch).total_seconds() for wp in act.Laps[0].Waypoints], [1000, 1002, 1029])
+        self.assertEqual([wp.HR for wp in act.Laps[0].Waypoints], [100, 110, 120])
@@ -1,15 +1,38 @@
 from tapiriik.testing.testtools import TestTools, TapiriikTestCase
 
-from tapiriik.sync import Sync
-from tapiriik.services import Service
-from tapiriik.services.api import APIExcludeActivity
-from tapiriik.services.interchange import Activity, ActivityType
+from tapiriik.sync import Sync, SynchronizationTask
+from tapiriik.sync.sync import _TaskLogFilter
+import tapiriik.sync.sync as sync_module
+from tapiriik.sync.activity_index import ActivityDeduplicationIndex
+from tapiriik.sync.routing import SynchronizationRouting
+from tapiriik.sync.synchronized_activities import SynchronizedActivities, SynchronizedActivityIndex
+from tapiriik.sync.write_buffer import WriteBehindBuffer
+from tapiriik.sync.status_reporter import SyncStatusReporter
+from tapiriik.sync.dispatch import SyncDispatcher, LocalSyncQueue, AMQPSyncQueue
+from tapiriik.sync.lanes import SyncLane, SyncLaneSelector
+from tapiriik.sync.partitioning import SyncPartitioning
+import tapiriik.sync.partitioning as partitioning_module
+from tapiriik.sync.activity_record import ActivityRecord, ActivityRecordIndex
+from tapiriik.sync.memory import MemoryUsage
+from tapiriik.database import db
+from tapiriik.services import Service, ServiceBase
+from tapiriik.services.api import APIException, APIExcludeActivity, UserException, UserExceptionType
+from tapiriik.services.interchange import Activity, ActivityType, UploadedActivity, Lap, Waypoint, Location
 from tapiriik.auth import User
+from tapiriik.settings import SYNC_DISPATCH_REDELIVERY
+from bson.objectid import ObjectId
 
 from datetime import datetime, timedelta, tzinfo
 import random
 import pytz
 import copy
+import logging
+import threading
+import tracemalloc
+import socket
+import tempfile
+import time
+from collections import deque
 
 
 class UTC(tzinfo):
@@ -25,6 +48,112 @@ class UTC(tzinfo):
         return timedelta(0)
 
 
+class FakeBroker:
+    """ Just enough of kombu's SimpleQueue, and the broker's at-least-once delivery, for AMQPSyncQueue """
+
+    class Empty(Exception):
+        pass
+
+    def __init__(self):
+        self._queues = {}
+        self.prefetch = set()
+
+    def Queued(self):
+        return [name for name, messages in self._queues.items() if messages]
+
+    def Connection(self):
+        return FakeBroker._Connection(self)
+
+    def Disconnect(self, connection):
+        # As with a closed channel, whatever it hadn't acknowledged goes back to the front of its queue
+        for name, message in reversed(connection.unacked):
+            self._queues[name].appendleft(message)
+        connection.unacked = []
+
+    class _Connection:
+        def __init__(self, broker):
+            self._broker = broker
+            self.unacked = []
+
+        def SimpleQueue(self, name):
+            return FakeBroker._Queue(self._broker, self, name)
+
+    class _Queue:
+        def __init__(self, broker, connection, name):
+            self.Empty = FakeBroker.Empty
+            self.consumer = self
+            self._broker = broker
+            self._connection = connection
+            self._name = name
+            self._messages = broker._queues.setdefault(name, deque())
+
+        def qos(self, prefetch_count):
+            self._broker.prefetch.add(prefetch_count)
+
+        def put(self, payload):
+            self._messages.append(payload)
+
+        def get(self, block=True):
+            if not self._messages:
+                raise FakeBroker.Empty()
+            payload = self._messages.popleft()
+            delivery = (self._name, payload)
+            self._connection.unacked.append(delivery)
+            class Message:
+                def ack(message):
+                    self._connection.unacked.remove(delivery)
+            message = Message()
+            message.payload = payload
+            return message
+
+
+class MemoryService(ServiceBase):
+    """ Keeps its activities in memory, so whole syncs can be run against it
+        Activities are given by start time - downloads and uploads of those in BrokenDownloads/BrokenUploads raise the exception given there
+    """
+    SupportedActivities = [ActivityType.Running]
+
+    def __init__(self, id, startTimes, brokenDownloads={}, brokenUploads={}, listException=None, downloadDelay=0):
+        self.ID = id
+        self.StartTimes = startTimes
+        self.BrokenDownloads = brokenDownloads
+        self.BrokenUploads = brokenUploads
+        self.ListException = listException
+        self.DownloadDelay = downloadDelay
+        self.Uploaded = []
+
+    def DownloadActivityList(self, serviceRecord, exhaustive=False):
+        if self.ListException:
+            raise self.ListException
+        activities = []
+        for startTime in self.StartTimes:
+            activity = UploadedActivity()
+            activity.StartTime = startTime
+            activity.EndTime = startTime + timedelta(hours=1)
+            activity.Type = ActivityType.Running
+            activity.ServiceData = {"ID": startTime.isoformat()}
+            activity.CalculateUID()
+            activities.append(activity)
+        return activities, []
+
+    def DownloadActivity(self, serviceRecord, activity):
+        time.sleep(self.DownloadDelay)
+        if activity.StartTime in self.BrokenDownloads:
+            raise self.BrokenDownloads[activity.StartTime]
+        lap = Lap(startTime=activity.StartTime, endTime=activity.EndTime)
+        lap.Waypoints = [Waypoint(activity.StartTime + timedelta(seconds=x * 10), location=Location(45 + x * 0.0001, -75, 100)) for x in range(10)]
+        activity.Laps = [lap]
+        activity.TZ = pytz.utc
+        activity.Stationary = False
+        return activity
+
+    def UploadActivity(self, serviceRecord, activity):
+        if activity.StartTime in self.BrokenUploads:
+            raise self.BrokenUploads[activity.StartTime]
+        self.Uploaded.append(activity.StartTime)
+        return "%s-%s" % (self.ID, activity.StartTime.isoformat())
+
+
 class SyncTests(TapiriikTestCase):
 
     def test_svc_level_dupe(self):
@@ -298,6 +427,25 @@ class SyncTests(TapiriikTestCase):
 
         self.assertEqual(len(activities), 2)
 
+    def test_activity_deduplicate_index(self):
+        ''' ensure that the start time index finds exactly the activities an exhaustive comparison would, in the same order '''
+        zones = [pytz.timezone("America/Iqaluit"), pytz.timezone("Asia/Kolkata"), pytz.utc]
+        types = [ActivityType.Running, ActivityType.Walking, ActivityType.Cycling, ActivityType.Other]
+        baseTime = datetime(2014, 3, 1, 12, 0, 0)
+        activities = []
+        for x in range(400):
+            act = Activity()
+            act.Type = random.choice(types)
+            act.StartTime = baseTime + timedelta(seconds=random.randint(-60 * 60 * 50, 60 * 60 * 50))
+            if random.random() < 0.5:
+                act.StartTime = random.choice(zones).localize(act.StartTime)
+            act.CalculateUID()
+            activities.append(act)
+
+        index = ActivityDeduplicationIndex(activities[:200])
+        for act in activities[200:]:
+            self.assertEqual(index.FindDuplicates(act), [x for x in activities[:200] if ActivityDeduplicationIndex.IsDuplicate(x, act)])
+
     def test_activity_coalesce(self):
         ''' ensure that activity data is getting coalesced by _accumulateActivities '''
         svcA, svcB = TestTools.create_mock_services()
@@ -360,6 +508,553 @@ class SyncTests(TapiriikTestCase):
 
 
 
+    def test_routing_matches_connections(self):
+        user = TestTools.create_mock_user()
+        svcA, svcB = TestTools.create_mock_services()
+        svcC = TestTools.create_mock_service("mockC")
+        recA = TestTools.create_mock_svc_record(svcA)
+        recB = TestTools.create_mock_svc_record(svcB)
+        recC = TestTools.create_mock_svc_record(svcC)
+        User.SetFlowException(user, recA, recC, flowToTarget=False)
+        User.SetFlowException(user, recB, recC, flowToSource=False)
+        conns = [recA, recB, recC]
+
+        routing = SynchronizationRouting(user, conns)
+        for src in conns:
+            self.assertEqual(routing.Connection(src._id), src)
+            self.assertEqual(routing.Configuration(src), src.GetConfiguration())
+            for activityType in [ActivityType.Rowing, ActivityType.Wheelchair]:
+                self.assertEqual(routing.SupportsActivityType(src, activityType), activityType in src.Service.SupportedActivities)
+            for dest in conns:
+                self.assertEqual(routing.HasFlowException(src, dest), User.CheckFlowException(user, src, dest))
+        self.assertTrue(routing.HasFlowException(recA, recC))
+        self.assertTrue(routing.HasFlowException(recC, recB))
+        self.assertFalse(routing.HasFlowException(recC, recA))
+
+    def test_synchronized_activities_migration(self):
+        svcA, svcB = TestTools.create_mock_services()
+        recA = TestTools.create_mock_svc_record(svcA)
+        recB = TestTools.create_mock_svc_record(svcB)
+        db.connections.remove({"_id": {"$in": [recA._id, recB._id]}})
+        db.synchronized_activities.remove({"ConnectionID": {"$in": [recA._id, recB._id]}})
+        db.connections.insert({"_id": recA._id, "SynchronizedActivities": ["uid1", "uid2", "uid2"]})
+        db.connections.insert({"_id": recB._id})
+        SynchronizedActivities.EnsureIndexes()
+        db.synchronized_activities.insert({"ConnectionID": recA._id, "UID": "uid1"}) # As if a sync elsewhere had beaten it to that one
+
+        SynchronizedActivities.MigrateEmbedded([recA._id, recB._id])
+        self.assertNotIn("SynchronizedActivities", db.connections.find_one({"_id": recA._id}))
+        self.assertEqual(SynchronizedActivities.Count(recA._id), 2)
+
+        index = SynchronizedActivityIndex([recA._id, recB._id])
+        self.assertTrue(index.HasAny(recA._id, set(["uid1", "uid3"])))
+        self.assertFalse(index.HasAll(recA._id, set(["uid1", "uid3"])))
+        self.assertFalse(index.HasAny(recB._id, set(["uid1"])))
+
+        index.Add([recB._id], set(["uid1"]))
+        self.assertTrue(index.HasAny(recB._id, set(["uid1"])))
+        self.assertTrue(SynchronizedActivityIndex([recB._id]).HasAll(recB._id, set(["uid1"])))
+
+    def test_write_buffer(self):
+        db.test_write_buffer.remove({})
+        buffer = WriteBehindBuffer(maxOperations=3, maxAge=3600)
+        buffer.Insert(db.test_write_buffer, {"Key": 1})
+        buffer.Update(db.test_write_buffer, {"Key": 2}, {"$addToSet": {"Values": "a"}}, upsert=True)
+        self.assertEqual(db.test_write_buffer.find().count(), 0)
+        buffer.Update(db.test_write_buffer, {"Key": 2}, {"$addToSet": {"Values": "b"}}, upsert=True) # Hits the size threshold
+        self.assertEqual(db.test_write_buffer.find().count(), 2)
+        self.assertEqual(db.test_write_buffer.find_one({"Key": 2})["Values"], ["a", "b"])
+
+        buffer.Update(db.test_write_buffer, {"Key": 1}, {"$set": {"Flushed": True}})
+        self.assertNotIn("Flushed", db.test_write_buffer.find_one({"Key": 1}))
+        buffer.Flush()
+        self.assertTrue(db.test_write_buffer.find_one({"Key": 1})["Flushed"])
+
+    def test_status_reporter(self):
+        db.test_status_reporter.remove({})
+        db.test_status_reporter.insert({"_id": 1, "Untouched": True})
+        SyncStatusReporter.Set(db.test_status_reporter, {"_id": 1}, {"Step": "list", "Progress": 0})
+        SyncStatusReporter.Set(db.test_status_reporter, {"_id": 1}, {"Progress": 0.5})
+        SyncStatusReporter.Unset(db.test_status_reporter, {"_id": 1}, ["Step"])
+        SyncStatusReporter.Flush()
+        self.assertEqual(db.test_status_reporter.find_one({"_id": 1}), {"_id": 1, "Untouched": True, "Progress": 0.5})
+
+    def test_status_reporter_failure(self):
+        db.test_status_reporter.remove({})
+        db.test_status_reporter.insert([{"_id": 1}, {"_id": 2}])
+        class FlakyCollection:
+            full_name = "test_status_reporter_flaky"
+            failing = True
+            def update(self, *args, **kwargs):
+                if FlakyCollection.failing:
+                    raise Exception("Database went away")
+                return db.test_status_reporter.update(*args, **kwargs)
+        flaky = FlakyCollection()
+        SyncStatusReporter.Set(flaky, {"_id": 1}, {"Step": "list", "Progress": 0})
+        SyncStatusReporter.Unset(flaky, {"_id": 1}, ["Error"])
+        SyncStatusReporter.Set(db.test_status_reporter, {"_id": 2}, {"Step": "upload"})
+        self.assertRaises(Exception, SyncStatusReporter.Flush)
+        # The others still get written...
+        self.assertEqual(db.test_status_reporter.find_one({"_id": 2}), {"_id": 2, "Step": "upload"})
+        # ...and the failed one's kept for next time, under whatever's come in since
+        SyncStatusReporter.Set(flaky, {"_id": 1}, {"Progress": 0.5, "Error": "Oops"})
+        FlakyCollection.failing = False
+        SyncStatusReporter.Flush()
+        self.assertEqual(db.test_status_reporter.find_one({"_id": 1}), {"_id": 1, "Step": "list", "Progress": 0.5, "Error": "Oops"})
+
+    def test_lock_lease_expiry(self):
+        now = datetime.utcnow()
+        db.users.insert({"_id": "lease-expired", "NextSynchronization": now, "SynchronizationWorker": 1234, "SynchronizationLeaseExpiry": now - timedelta(seconds=1)})
+        db.users.insert({"_id": "lease-held", "NextSynchronization": now, "SynchronizationWorker": 1234, "SynchronizationLeaseExpiry": now + timedelta(minutes=1)})
+        db.users.insert({"_id": "lease-none", "NextSynchronization": now, "SynchronizationWorker": 1}) # e.g. locked from the diagnostics page
+        claimedUsers = Sync._claimUsers(10)
+        Sync._releaseUsers(claimedUsers)
+        claimed = [x["_id"] for x in claimedUsers]
+        db.users.remove({"_id": {"$in": ["lease-expired", "lease-held", "lease-none"]}})
+        self.assertIn("lease-expired", claimed)
+        self.assertNotIn("lease-held", claimed)
+        self.assertNotIn("lease-none", claimed)
+
+    def test_concurrent_claims(self):
+        # Threads in the same process share a pid - they mustn't end up with each other's users
+        now = datetime.utcnow()
+        userIds = ["claim-%d" % x for x in range(20)]
+        for userId in userIds:
+            db.users.insert({"_id": userId, "NextSynchronization": now - timedelta(minutes=1)})
+        bothFound = threading.Barrier(2)
+        searched = threading.local()
+        writing = threading.Lock()
+        class OverlappingCandidates:
+            # Holds up each thread's first candidate search until the other has its candidates too
+            def __getattr__(self, name):
+                return getattr(db.users, name)
+            def update(self, *args, **kwargs):
+                with writing: # Mongo won't let two updates into the same document at once, mongomock needs a hand
+                    return db.users.update(*args, **kwargs)
+            def find(self, *args, **kwargs):
+                result = db.users.find(*args, **kwargs)
+                if args[1:] == ({"_id": 1},) and not hasattr(searched, "once"):
+                    searched.once = True
+                    result = list(result.sort("NextSynchronization").limit(15))
+                    bothFound.wait(5)
+                    return CandidateCursor(result)
+                return result
+        class CandidateCursor(list):
+            def sort(self, *args):
+                return self
+            def limit(self, count):
+                return self
+        class OverlappingDatabase:
+            users = OverlappingCandidates()
+            def __getattr__(self, name):
+                return getattr(db, name)
+        claims = {}
+        def claim(name):
+            claims[name] = Sync._claimUsers(15)
+        sync_module.db = OverlappingDatabase()
+        try:
+            threads = [threading.Thread(target=claim, args=(x,)) for x in ["a", "b"]]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sync_module.db = db
+        claimedA = set(x["_id"] for x in claims["a"])
+        claimedB = set(x["_id"] for x in claims["b"])
+        self.assertEqual(claimedA & claimedB, set())
+        for user in claims["a"] + claims["b"]:
+            self.assertEqual(db.users.find_one({"_id": user["_id"]})["SynchronizationClaim"], user["SynchronizationClaim"])
+        # ...nor release each other's
+        Sync._releaseUsers(claims["a"])
+        self.assertEqual(db.users.find({"_id": {"$in": list(claimedB)}, "SynchronizationWorker": None}).count(), 0)
+        Sync._releaseUsers(claims["b"])
+        self.assertEqual(db.users.find({"_id": {"$in": userIds}, "SynchronizationWorker": {"$ne": None}}).count(), 0)
+        db.users.remove({"_id": {"$in": userIds}})
+
+    def test_stale_reschedule(self):
+        # Once a user's unlocked, someone else can claim them before the worker that had them gets round to rescheduling them - that worker's write is then out of date
+        due = datetime.utcnow().replace(microsecond=0) - timedelta(minutes=1)
+        db.users.insert([{"_id": userId, "NextSynchronization": due, "ConnectedServices": []} for userId in ["reschedule-mine", "reschedule-stolen"]])
+        originalPerformUserSync = Sync.PerformUserSync
+        def performUserSync(user, *args, **kwargs):
+            task = originalPerformUserSync(user, *args, **kwargs)
+            if user["_id"] == "reschedule-stolen":
+                db.users.update({"_id": user["_id"]}, {"$set": {"SynchronizationClaim": "someone-else", "NextSynchronization": due}})
+            return task
+        Sync.PerformUserSync = performUserSync
+        try:
+            for userId in ["reschedule-mine", "reschedule-stolen"]:
+                Sync._performClaimedUserSyncs(Sync._claimUsers(userId=userId))
+        finally:
+            Sync.PerformUserSync = originalPerformUserSync
+        mine = db.users.find_one({"_id": "reschedule-mine"})
+        stolen = db.users.find_one({"_id": "reschedule-stolen"})
+        db.users.remove({"_id": {"$in": ["reschedule-mine", "reschedule-stolen"]}})
+        self.assertIn("LastSynchronization", mine)
+        self.assertIsNone(mine.get("SynchronizationClaim"))
+        self.assertNotIn("LastSynchronization", stolen)
+        self.assertEqual(stolen["SynchronizationClaim"], "someone-else")
+        self.assertEqual(stolen["NextSynchronization"], due)
+
+    def test_idle_claim(self):
+        queries = []
+        class CountingCandidates:
+            def __getattr__(self, name):
+                queries.append(name)
+                return getattr(db.users, name)
+        class CountingDatabase:
+            users = CountingCandidates()
+            def __getattr__(self, name):
+                return getattr(db, name)
+        db.users.update({"NextSynchronization": {"$lte": datetime.utcnow()}}, {"$set": {"NextSynchronization": None}}, multi=True)
+        sync_module.db = CountingDatabase()
+        try:
+            self.assertEqual(Sync._claimUsers(10), [])
+        finally:
+            sync_module.db = db
+        self.assertEqual(len(queries), 1) # Not one per lane
+
+    def test_dispatch_queue(self):
+        db.users.insert({"_id": "dispatch-due", "NextSynchronization": datetime.utcnow() - timedelta(days=1), "ConnectedServices": []})
+        dispatchQueue = LocalSyncQueue()
+        SyncDispatcher.DispatchDueUsers(dispatchQueue)
+        dispatched = []
+        while True:
+            delivery = dispatchQueue.Get(0)
+            if not delivery:
+                break
+            dispatched.append(delivery[0])
+        self.assertIn("dispatch-due", dispatched)
+        SyncDispatcher.DispatchDueUsers(dispatchQueue)
+        self.assertIsNone(dispatchQueue.Get(0)) # Not until they've had a chance to be picked up
+
+        # Delivered twice - but only synchronized once
+        dispatchQueue.Put("dispatch-due")
+        dispatchQueue.Put("dispatch-due")
+        self.assertEqual(Sync.PerformQueuedSync(dispatchQueue, timeout=0), 1)
+        self.assertEqual(Sync.PerformQueuedSync(dispatchQueue, timeout=0), 0)
+        self.assertNotIn("SynchronizationDispatchTime", db.users.find_one({"_id": "dispatch-due"}))
+        db.users.remove({"_id": "dispatch-due"})
+
+    def test_local_dispatch_queue(self):
+        db.users.update({"NextSynchronization": {"$lte": datetime.utcnow()}}, {"$set": {"NextSynchronization": None}}, multi=True)
+        for x in range(3):
+            db.users.insert({"_id": "local-dispatch-%d" % x, "NextSynchronization": datetime.utcnow() - timedelta(minutes=x + 1)})
+        dispatchQueue = LocalSyncQueue()
+        self.assertEqual(dispatchQueue.Demand(), 0)
+        received = []
+        thread = threading.Thread(target=lambda: received.append(dispatchQueue.Get(5)))
+        thread.start()
+        while not dispatchQueue.Demand():
+            time.sleep(0.01)
+        # Only as many as there are threads waiting
+        self.assertEqual(SyncDispatcher.DispatchDueUsers(dispatchQueue, count=dispatchQueue.Demand()), 1)
+        thread.join()
+        self.assertEqual(received[0][0], "local-dispatch-2")
+        self.assertEqual(dispatchQueue.Demand(), 0)
+        # Whatever the child never got to goes back to be dispatched again straight away
+        SyncDispatcher.DispatchDueUsers(dispatchQueue, count=1)
+        self.assertEqual(dispatchQueue.Release(), ["local-dispatch-1"])
+        self.assertNotIn("SynchronizationDispatchTime", db.users.find_one({"_id": "local-dispatch-1"}))
+        db.users.remove({"_id": {"$regex": "^local-dispatch-"}})
+
+    def test_amqp_dispatch_queue(self):
+        db.users.update({"NextSynchronization": {"$lte": datetime.utcnow()}}, {"$set": {"NextSynchronization": None}}, multi=True)
+        broker = FakeBroker()
+        userIds = [ObjectId() for x in range(3)]
+        db.users.insert({"_id": userIds[0], "NextSynchronization": datetime.utcnow() - timedelta(minutes=3), "SynchronizationLane": SyncLane.Interactive})
+        db.users.insert({"_id": userIds[1], "NextSynchronization": datetime.utcnow() - timedelta(minutes=2), "SynchronizationHostRestriction": socket.gethostname()})
+        db.users.insert({"_id": userIds[2], "NextSynchronization": datetime.utcnow() - timedelta(minutes=1)})
+        self.assertEqual(SyncDispatcher.DispatchDueUsers(AMQPSyncQueue(broker.Connection())), 3)
+        self.assertEqual(set(broker.Queued()), set(["tapiriik-sync-interactive", "tapiriik-sync-background", "tapiriik-sync-background-" + socket.gethostname()]))
+        # Not again, while they're (presumably) on their way
+        self.assertEqual(SyncDispatcher.DispatchDueUsers(AMQPSyncQueue(broker.Connection())), 0)
+
+        for lane in SyncLane.All:
+            SyncLaneSelector.Empty(lane)
+        workerConnection = broker.Connection()
+        worker = AMQPSyncQueue(workerConnection)
+        userId, ack = worker.Get(0)
+        self.assertEqual(userId, userIds[0]) # The interactive lane first
+        ack()
+        userId, ack = worker.Get(0)
+        self.assertEqual(userId, userIds[1]) # This host's own queue before the shared one
+        self.assertEqual(broker.prefetch, set([1]))
+        # It dies before acknowledging that one - so it goes to someone else
+        broker.Disconnect(workerConnection)
+        otherWorker = AMQPSyncQueue(broker.Connection())
+        self.assertEqual(set(otherWorker.Get(0)[0] for x in range(2)), set(userIds[1:]))
+        self.assertIsNone(otherWorker.Get(0))
+
+        # And if the message goes missing altogether, they're dispatched again once SYNC_DISPATCH_REDELIVERY's up
+        db.users.update({"_id": userIds[2]}, {"$set": {"SynchronizationDispatchTime": datetime.utcnow() - timedelta(seconds=SYNC_DISPATCH_REDELIVERY + 1)}})
+        self.assertEqual(SyncDispatcher.DispatchDueUsers(AMQPSyncQueue(broker.Connection())), 1)
+        db.users.remove({"_id": {"$in": userIds}})
+
+    def test_sync_lanes(self):
+        db.users.update({"NextSynchronization": {"$lte": datetime.utcnow()}}, {"$set": {"NextSynchronization": None}}, multi=True)
+        for lane in SyncLane.All:
+            for x in range(30):
+                db.users.insert({"_id": lane + str(x), "NextSynchronization": datetime.utcnow() - timedelta(minutes=1), "SynchronizationLane": lane})
+        for lane in SyncLane.All:
+            SyncLaneSelector.Empty(lane)
+        dispatchQueue = LocalSyncQueue()
+        def dispatchOne():
+            SyncDispatcher.DispatchDueUsers(dispatchQueue, count=1)
+            return dispatchQueue.Get(0)[0].rstrip("0123456789")
+        # With everyone busy, each lane gets its weighted share
+        picked = [dispatchOne() for x in range(15)]
+        self.assertEqual(dict((lane, picked.count(lane)) for lane in SyncLane.All), {SyncLane.Interactive: 8, SyncLane.PartialTrigger: 4, SyncLane.Background: 2, SyncLane.Heavy: 1})
+        # ...and when one runs dry, the rest take up the slack
+        picked = [dispatchOne() for x in range(60)]
+        self.assertEqual(picked.count(SyncLane.Interactive), 22)
+        self.assertEqual(len(picked), 60)
+        db.users.remove({"_id": {"$in": [lane + str(x) for lane in SyncLane.All for x in range(30)]}})
+
+    def test_peak_allocation_sites(self):
+        tracemalloc.start()
+        try:
+            MemoryUsage.ResetTracedPeak()
+            held = [bytearray(1024) for x in range(10000)]
+            MemoryUsage.SamplePeak(1024 * 1024)
+            del held
+            sites = MemoryUsage.TopAllocationSites(1)
+        finally:
+            tracemalloc.stop()
+        # Long gone by the time they're reported, but they were what the peak was made of
+        self.assertGreater(sites[0]["Size"], 10000 * 1024)
+        self.assertTrue(sites[0]["Site"].startswith(__file__ + ":"))
+
+    def _runMemorySync(self, services, overrides={}, records=[], time_budget=None):
+        # One exhaustive sync of a new user connected to each of the MemoryServices, claimed & run as a worker would, with sync.py's settings in overrides swapped in for the duration
+        # records are activity records the user had already (UIDs & the like - UserID is filled in)
+        # Returns whatever it left behind, minus the timestamps, tracebacks & IDs that'd differ from run to run
+        userId = "memory-sync-%s" % ObjectId()
+        connections = dict(("%s-%s" % (userId, svc.ID), svc) for svc in services)
+        db.connections.insert([{"_id": connId, "Service": svc.ID, "ExternalID": connId, "Authorization": {}} for connId, svc in connections.items()])
+        db.users.insert({"_id": userId, "ConnectedServices": [{"Service": svc.ID, "ID": connId} for connId, svc in connections.items()], "NextSynchronization": datetime.utcnow() - timedelta(minutes=1), "NextSyncIsExhaustive": True})
+        for record in records:
+            db.activity_records.insert(dict(record, UserID=userId))
+        overrides = dict(overrides, USER_SYNC_LOGS=tempfile.gettempdir() + "/")
+        originalSettings = dict((name, getattr(sync_module, name)) for name in overrides)
+        originalPriorityList = Service.PreferredDownloadPriorityList
+        originalTimeBudget = Sync.TimeBudget
+        for svc in services:
+            Service._serviceMappings[svc.ID] = svc
+        Service.PreferredDownloadPriorityList = lambda: services
+        Sync.TimeBudget = time_budget
+        try:
+            for name, value in overrides.items():
+                setattr(sync_module, name, value)
+            users = Sync._claimUsers(userId=userId)
+            self.assertEqual(len(users), 1)
+            Sync._performClaimedUserSyncs(users)
+        finally:
+            for name, value in originalSettings.items():
+                setattr(sync_module, name, value)
+            Service.PreferredDownloadPriorityList = originalPriorityList
+            Sync.TimeBudget = originalTimeBudget
+            for svc in services:
+                del Service._serviceMappings[svc.ID]
+
+        def exception(raw):
+            return raw["Exception"]["Type"] if raw["Exception"] else None
+        user = db.users.find_one({"_id": userId})
+        result = {"Rescheduled": user["NextSynchronization"] is not None, "NextSyncIsExhaustive": user.get("NextSyncIsExhaustive"), "Services": {}, "Records": []}
+        for conn in db.connections.find({"_id": {"$in": list(connections.keys())}}):
+            svc = connections[conn["_id"]]
+            result["Services"][svc.ID] = {
+                "Uploaded": sorted(svc.Uploaded),
+                "SyncErrors": [(x["Step"], x["Message"].split("\n")[0], x.get("UserException", {}).get("Type")) for x in conn.get("SyncErrors", [])],
+                "ExcludedActivities": sorted(conn.get("ExcludedActivities", {}).keys()),
+                "SynchronizedActivities": sorted(x["UID"] for x in db.synchronized_activities.find({"ConnectionID": conn["_id"]}))
+            }
+        for record in db.activity_records.find({"UserID": userId}):
+            result["Records"].append((record["StartTime"], sorted(record["UIDs"]), sorted(record["Prescence"].keys()), dict((svc, exception(x)) for svc, x in record["Abscence"].items())))
+        result["Records"].sort()
+        return result
+
+    def _memoryServices(self):
+        # Two services with some activities in common, and some that won't come down cleanly
+        startTimes = [pytz.utc.localize(datetime(2014, 5, 1, 8)) + timedelta(days=x) for x in range(8)]
+        svcA = MemoryService("memoryA", startTimes[:6], brokenDownloads={
+            startTimes[1]: Exception("Download blew up"),
+            startTimes[2]: APIExcludeActivity("Not a real activity", permanent=True)
+            })
+        svcB = MemoryService("memoryB", startTimes[3:], brokenDownloads={
+            startTimes[6]: APIException("Service is down", user_exception=UserException(UserExceptionType.DownloadError))
+            })
+        return startTimes, [svcA, svcB]
+
+    def test_download_lookahead(self):
+        startTimes, services = self._memoryServices()
+        serial = self._runMemorySync(services)
+        startTimes, services = self._memoryServices()
+        pipelined = self._runMemorySync(services, {"SYNC_DOWNLOAD_LOOKAHEAD": 3})
+        # Everything the downloads left to be done on the sync thread ends up the same as if they'd been done there in the first place
+        self.assertEqual(pipelined, serial)
+
+        # ...and is pinned on the activity whose download it was, not whichever was being uploaded when it turned up
+        uids = dict((activity.StartTime, activity.UID) for svc in services for activity in svc.DownloadActivityList(None)[0])
+        abscences = dict((uid, record[3]) for record in pipelined["Records"] for uid in record[1])
+        self.assertEqual(abscences[uids[startTimes[1]]], {"": UserExceptionType.DownloadError})
+        self.assertEqual(abscences[uids[startTimes[6]]], {"": UserExceptionType.DownloadError})
+        self.assertEqual(abscences[uids[startTimes[0]]], {})
+        self.assertEqual(abscences[uids[startTimes[7]]], {})
+        self.assertEqual(pipelined["Services"]["memoryB"]["Uploaded"], [startTimes[0]])
+        self.assertEqual(pipelined["Services"]["memoryA"]["Uploaded"], [startTimes[7]])
+        self.assertEqual([x[0] for x in pipelined["Services"]["memoryA"]["SyncErrors"]], ["download"])
+        self.assertEqual(pipelined["Services"]["memoryB"]["SyncErrors"], [(sync_module.SyncStep.Download, "Service is down", UserExceptionType.DownloadError)])
+        self.assertEqual(len(pipelined["Services"]["memoryA"]["ExcludedActivities"]), 1)
+
+    def test_concurrent_uploads(self):
+        def services():
+            # Everything's on A, and goes to B & C - C refuses some of them
+            startTimes = [pytz.utc.localize(datetime(2014, 6, 1, 8)) + timedelta(days=x) for x in range(4)]
+            brokenUploads = {
+                startTimes[1]: APIException("Upload refused", user_exception=UserException(UserExceptionType.UploadError)),
+                startTimes[2]: Exception("Upload blew up")
+                }
+            return startTimes, [MemoryService("memoryA", startTimes), MemoryService("memoryB", []), MemoryService("memoryC", [], brokenUploads=brokenUploads)]
+        startTimes, serialServices = services()
+        serial = self._runMemorySync(serialServices)
+        startTimes, concurrentServices = services()
+        concurrent = self._runMemorySync(concurrentServices, {"SYNC_UPLOAD_CONCURRENCY": 3})
+        self.assertEqual(concurrent, serial)
+
+        # One destination failing doesn't stop the other getting it
+        self.assertEqual(concurrent["Services"]["memoryB"]["Uploaded"], startTimes)
+        self.assertEqual(concurrent["Services"]["memoryC"]["Uploaded"], [startTimes[0], startTimes[3]])
+        self.assertEqual([x[2] for x in concurrent["Services"]["memoryC"]["SyncErrors"]], [None, UserExceptionType.UploadError]) # Newest first
+        self.assertEqual(concurrent["Services"]["memoryB"]["SyncErrors"], [])
+        self.assertEqual(len(concurrent["Services"]["memoryB"]["SynchronizedActivities"]), 4)
+        self.assertEqual(len(concurrent["Services"]["memoryC"]["SynchronizedActivities"]), 2)
+        self.assertEqual(sorted(abscence for record in concurrent["Records"] for abscence in record[3].items()), [("memoryC", UserExceptionType.UploadError)] * 2)
+
+    def test_concurrent_listing(self):
+        def services():
+            # B can't be listed - A & C have one activity in common
+            startTimes = [pytz.utc.localize(datetime(2014, 7, 1, 8)) + timedelta(days=x) for x in range(5)]
+            listException = APIException("Listing failed", user_exception=UserException(UserExceptionType.ListingError))
+            return startTimes, [MemoryService("memoryA", startTimes[:3]), MemoryService("memoryB", startTimes[3:], listException=listException), MemoryService("memoryC", startTimes[2:])]
+        startTimes, serialServices = services()
+        serial = self._runMemorySync(serialServices)
+        startTimes, concurrentServices = services()
+        concurrent = self._runMemorySync(concurrentServices, {"SYNC_LIST_CONCURRENCY": 3})
+        self.assertEqual(concurrent, serial)
+
+        self.assertEqual(concurrent["Services"]["memoryB"]["SyncErrors"], [(sync_module.SyncStep.List, "Listing failed", UserExceptionType.ListingError)])
+        self.assertEqual(concurrent["Services"]["memoryA"]["SyncErrors"], [])
+        self.assertEqual(concurrent["Services"]["memoryC"]["SyncErrors"], [])
+        # The others' activities are still merged & passed between them - B's excluded, so it gets nothing
+        self.assertEqual(concurrent["Services"]["memoryA"]["Uploaded"], startTimes[3:])
+        self.assertEqual(concurrent["Services"]["memoryC"]["Uploaded"], startTimes[:2])
+        self.assertEqual(concurrent["Services"]["memoryB"]["Uploaded"], [])
+        self.assertEqual(len(concurrent["Records"]), 5)
+
+    def test_time_budget(self):
+        def services():
+            # Each download takes long enough that the budget's up after the first
+            startTimes = [pytz.utc.localize(datetime(2014, 8, 1, 8)) + timedelta(days=x) for x in range(3)]
+            return startTimes, [MemoryService("memoryA", startTimes, downloadDelay=0.2), MemoryService("memoryB", [])]
+        # ...and there's a record for something nobody listed - an exhaustive sync that gets all the way through drops it
+        orphan = {"StartTime": datetime(2014, 1, 1), "EndTime": datetime(2014, 1, 1, 1), "UIDs": ["unlisted"], "Prescence": {}, "Abscence": {}}
+        startTimes, fullServices = services()
+        full = self._runMemorySync(fullServices, records=[orphan])
+        self.assertFalse(full["Rescheduled"])
+        self.assertEqual(full["Services"]["memoryB"]["Uploaded"], startTimes)
+        self.assertEqual(len(full["Records"]), 3)
+
+        startTimes, services = services()
+        cut = self._runMemorySync(services, records=[orphan], time_budget=timedelta(seconds=0.1))
+        self.assertEqual(cut["Services"]["memoryB"]["Uploaded"], [startTimes[2]]) # Newest first
+        # They're due again right away, and the next one's still exhaustive
+        self.assertTrue(cut["Rescheduled"])
+        self.assertTrue(cut["NextSyncIsExhaustive"])
+        # Not having been looked at doesn't mean it's gone
+        self.assertIn(["unlisted"], [record[1] for record in cut["Records"]])
+        self.assertEqual(len(cut["Records"]), 2)
+
+    def test_adaptive_sync_interval(self):
+        user = {"_id": "cadence", "ConnectedServices": []}
+        self.assertEqual(Sync.NextSyncInterval(user), Sync.SyncInterval) # Nothing to go on
+        now = datetime.utcnow()
+        for day in range(10):
+            db.activity_records.insert({"UserID": "cadence", "StartTime": now - timedelta(days=day * 2, hours=1)})
+        self.assertEqual(Sync.NextSyncInterval(user), Sync.ShortestSyncInterval) # Just had one
+        db.activity_records.remove({"UserID": "cadence"})
+        for day in range(10):
+            db.activity_records.insert({"UserID": "cadence", "StartTime": now - timedelta(days=30 + day * 2)})
+        self.assertEqual(Sync.NextSyncInterval(user), Sync.LongestSyncInterval) # Gone quiet for much longer than usual
+        db.activity_records.remove({"UserID": "cadence"})
+
+    def test_triggered_sync_interval(self):
+        svcA, svcB = TestTools.create_mock_services()
+        user = {"_id": "triggered", "ConnectedServices": [{"Service": svcA.ID, "ID": "triggered-a"}, {"Service": svcB.ID, "ID": "triggered-b"}]}
+        db.connections.insert([{"_id": "triggered-a", "Service": svcA.ID, "PartialSyncTriggerSubscribed": True}, {"_id": "triggered-b", "Service": svcB.ID}])
+        svcA.PartialSyncRequiresTrigger = True
+        try:
+            self.assertEqual(Sync.NextSyncInterval(user), Sync.SyncInterval) # B still needs polling
+            svcB.PartialSyncRequiresTrigger = True
+            self.assertEqual(Sync.NextSyncInterval(user), Sync.SyncInterval) # B could have a trigger, but hasn't subscribed to it
+            db.connections.update({"_id": "triggered-b"}, {"$set": {"PartialSyncTriggerSubscribed": True}})
+            self.assertEqual(Sync.NextSyncInterval(user), Sync.LongestSyncInterval)
+        finally:
+            svcA.PartialSyncRequiresTrigger = svcB.PartialSyncRequiresTrigger = False
+            db.connections.remove({"_id": {"$in": ["triggered-a", "triggered-b"]}})
+
+    def test_shard_partitioning(self):
+        members = [("host-a", 0), ("host-a", 1), ("host-b", 0)]
+        shardCount = partitioning_module.SYNC_SHARD_COUNT
+        partitioning_module.SYNC_SHARD_COUNT = 1024 # Off by default
+        try:
+            assignment = SyncPartitioning.Assign(members)
+            self.assertEqual(len(assignment), 1024)
+            self.assertEqual(set(assignment.values()), set(members))
+            # Only the newcomer's shards change hands
+            rebalanced = SyncPartitioning.Assign(members + [("host-c", 0)])
+        finally:
+            partitioning_module.SYNC_SHARD_COUNT = shardCount
+        moved = [shard for shard in assignment if assignment[shard] != rebalanced[shard]]
+        self.assertTrue(all(rebalanced[shard] == ("host-c", 0) for shard in moved))
+        self.assertLess(len(moved), len(assignment) / 2)
+
+    def test_task_log_routing(self):
+        tasks = [SynchronizationTask({"_id": x}) for x in ["a", "b"]]
+        filters = [_TaskLogFilter(task) for task in tasks]
+        record = logging.LogRecord("tapiriik", logging.INFO, __file__, 0, "Hello", None, None)
+        routed = []
+        thread = threading.Thread(target=tasks[1]._inTaskContext(lambda: routed.append([x.filter(record) for x in filters])))
+        thread.start()
+        thread.join()
+        self.assertEqual(routed, [[False, True]])
+        self.assertEqual([x.filter(record) for x in filters], [False, False]) # Not working on behalf of either here
+
+    def test_activity_record_index(self):
+        records = []
+        index = ActivityRecordIndex()
+        for uids in [["a"], ["b", "c"], ["c", "d"]]:
+            record = ActivityRecord()
+            record.UIDs = set(uids)
+            records.append(record)
+            index.Add(record)
+
+        self.assertIs(index.Find(set(["a"])), records[0])
+        self.assertIs(index.Find(set(["d", "c"])), records[1]) # The earliest-added record wins, as it did with a linear search
+        self.assertIsNone(index.Find(set(["e"])))
+
+        records[0].UIDs |= set(["e"]) # merged in from another activity
+        index.Update(records[0])
+        self.assertIs(index.Find(set(["e"])), records[0])
+
+        records[1].UIDs = set(["f"]) # re-set from an activity that no longer shares "c"
+        index.Update(records[1])
+        self.assertIs(index.Find(set(["c"])), records[2])
+
+        index.Remove(records[2])
+        self.assertIsNone(index.Find(set(["c", "d"])))
+
     def test_eligibility_excluded(self):
         user = TestTools.create_mock_user()
         svcA, svcB = TestTools.create_mock_services()
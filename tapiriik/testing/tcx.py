@@ -0,0 +1,27 @@
+from tapiriik.testing.testtools import TapiriikTestCase
+from tapiriik.testing.fit import create_fit_activity
+from tapiriik.services.tcx import TCXIO
+from tapiriik.services.interchange import ActivityStatistic, ActivityStatisticUnit, WaypointType
+import io
+
+
+class TCXTests(TapiriikTestCase):
+    def test_streaming_dump(self):
+        act = create_fit_activity()
+        act.Name = "Morning & <ride>"
+        for lap in act.Laps:
+            lap.Stats.Distance = ActivityStatistic(ActivityStatisticUnit.Meters, value=1000)  # Parse insists on it
+            for wp in lap.Waypoints:
+                wp.Type = WaypointType.Regular  # Otherwise repeated pauses are left out
+
+        output = io.BytesIO()
+        TCXIO.Dump(act, output)
+        tcx = TCXIO.Dump(act)
+        self.assertEqual(output.getvalue(), tcx.encode("UTF-8"))
+        self.assertTrue(tcx.startswith("<?xml version='1.0' encoding='UTF-8'?>\n<TrainingCenterDatabase xmlns=\"http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2\" xmlns:ns2="))
+        self.assertTrue(tcx.endswith("</TrainingCenterDatabase>\n"))
+        self.assertIn("<Notes>Morning &amp; &lt;ride&gt;</Notes>", tcx)
+
+        act2 = TCXIO.Parse(output.getvalue())
+        self.assertEqual(len(act2.Laps), len(act.Laps))
+        self.assertEqual([wp.HR for lap in act2.Laps for wp in lap.Waypoints], [wp.HR for lap in act.Laps for wp in lap.Waypoints])
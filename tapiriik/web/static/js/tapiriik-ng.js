@@ -35,10 +35,15 @@ function ActivitiesController($scope, $http) {
     return explanations[type].replace(/%\(service\)/g, $scope.DisplayNameByService(presc.Service));
   };
 
-  $scope.loading = true; // Will change if I ever add scroll-based pagination...
+  $scope.loading = true;
 
-  var loadActivities = function(pageStartDate) {
-    $http.get("/activities/fetch" + window.location.search)
+  // They're handed over a page at a time, newest first - each page picks up after the last activity on the one before, until there's nothing left
+  var loadActivities = function(lastActivity) {
+    var query = window.location.search;
+    if (lastActivity) {
+      query += (query ? "&" : "?") + "before=" + encodeURIComponent(lastActivity.StartTime) + "&before_id=" + encodeURIComponent(lastActivity.RecordID);
+    }
+    $http.get("/activities/fetch" + query)
     .success(function(activities) {
       $scope.loading = false;
       for (var actidx in activities){
@@ -63,7 +68,10 @@ function ActivitiesController($scope, $http) {
         activity.FullySynchronized = fully_synchronized;
         activity.Prescence = sorted_prescences;
       }
-      $scope.activities = activities;
+      $scope.activities = $scope.activities.concat(activities);
+      if (activities.length && activities[activities.length - 1].StartTime) {
+        loadActivities(activities[activities.length - 1]);
+      }
     });
   };
 
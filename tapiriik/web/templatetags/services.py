@@ -19,3 +19,9 @@ def exceptSvc(value):
 @register.filter(name="svc_populate_conns")
 def fullRecords(conns):
     return [ServiceRecord(x) for x in db.connections.find({"_id": {"$in": [x["ID"] for x in conns]}})]
+
+
+@register.filter(name="svc_synchronized_count")
+def synchronizedCount(conn):
+    from tapiriik.sync.synchronized_activities import SynchronizedActivities
+    return SynchronizedActivities.Count(conn._id)
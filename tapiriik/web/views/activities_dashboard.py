@@ -2,8 +2,21 @@ from django.shortcuts import render, redirect
 from django.http import HttpResponse
 from tapiriik.database import db
 from tapiriik.settings import WITHDRAWN_SERVICES
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
 import json
 import datetime
+import dateutil.parser
+import pytz
+
+ACTIVITIES_PAGE_SIZE = 1000
+
+def _pageKey(record, embeddedIndex=None):
+    # Where a record falls in the (newest-first) order the pages run in - StartTime, then split-out records ahead of the embedded ones (see below), then by ID/position
+    # So those that start at the same time as the last one on a page are still picked up on the next
+    if embeddedIndex is not None:
+        return (record.get("StartTime") or datetime.datetime.min, 0, embeddedIndex)
+    return (record.get("StartTime") or datetime.datetime.min, 1, record["_id"])
 
 def activities_dashboard(req):
     if not req.user:
@@ -15,20 +28,49 @@ def activities_fetch_json(req):
         return HttpResponse(status=403)
 
     retrieve_fields = [
-        "Activities.Prescence",
-        "Activities.Abscence",
-        "Activities.Type",
-        "Activities.Name",
-        "Activities.StartTime",
-        "Activities.EndTime",
-        "Activities.Private",
-        "Activities.Stationary"
+        "Prescence",
+        "Abscence",
+        "Type",
+        "Name",
+        "StartTime",
+        "EndTime",
+        "Private",
+        "Stationary"
     ]
-    activityRecords = db.activity_records.find_one({"UserID": req.user["_id"]}, dict([(x, 1) for x in retrieve_fields]))
-    if not activityRecords:
-        return HttpResponse("[]", content_type="application/json")
+    # Pages run backwards from the most recent activity - ?before=<StartTime>&before_id=<RecordID> of the last activity on the previous page gets the next one
+    query = {"UserID": req.user["_id"], "Activities": {"$exists": False}} # ...which excludes the old single-document records that haven't been migrated yet
+    try:
+        limit = max(1, min(int(req.GET.get("limit", ACTIVITIES_PAGE_SIZE)), ACTIVITIES_PAGE_SIZE))
+        pageEnd = None
+        if "before" in req.GET:
+            before = dateutil.parser.parse(req.GET["before"])
+            if before.tzinfo:
+                before = before.astimezone(pytz.utc).replace(tzinfo=None)
+            beforeId = req.GET.get("before_id")
+            if not beforeId:
+                pageEnd = (before, -1, None) # Just the StartTime - everything from before then
+            elif beforeId.startswith("embedded:"):
+                pageEnd = (before, 0, int(beforeId[len("embedded:"):]))
+            else:
+                pageEnd = (before, 1, ObjectId(beforeId))
+    except (ValueError, InvalidId):
+        return HttpResponse(status=400)
+    if pageEnd:
+        query["$or"] = [{"StartTime": {"$lt": pageEnd[0]}}]
+        if pageEnd[1] == 1:
+            query["$or"].append({"StartTime": pageEnd[0], "_id": {"$lt": pageEnd[2]}})
+    activityRecords = [(_pageKey(x), x) for x in db.activity_records.find(query, dict([(x, 1) for x in retrieve_fields])).sort([("StartTime", -1), ("_id", -1)]).limit(limit)]
+    # Those whose records haven't been split out yet (see ActivityRecord.MigrateEmbedded) get them paged in just the same
+    embedded = db.activity_records.find_one({"UserID": req.user["_id"], "Activities": {"$exists": True}}, dict([("Activities." + x, 1) for x in retrieve_fields]))
+    if embedded:
+        embeddedRecords = [(_pageKey(x, embeddedIndex=idx), x) for idx, x in enumerate(embedded["Activities"])]
+        if pageEnd:
+            embeddedRecords = [(key, x) for key, x in embeddedRecords if x.get("StartTime") and key < pageEnd]
+        activityRecords = sorted(activityRecords + embeddedRecords, key=lambda x: x[0], reverse=True)[:limit]
     cleanedRecords = []
-    for activity in activityRecords["Activities"]:
+    for key, activity in activityRecords:
+        activity.pop("_id", None)
+        activity["RecordID"] = "embedded:%d" % key[2] if key[1] == 0 else str(key[2])
         # Strip down the record since most of this info isn't displayed
         for presence in activity["Prescence"]:
             del activity["Prescence"][presence]["Exception"]
@@ -2,6 +2,7 @@ from django.shortcuts import render, redirect
 from tapiriik.settings import DIAG_AUTH_TOTP_SECRET, DIAG_AUTH_PASSWORD, SITE_VER
 from tapiriik.database import db
 from tapiriik.sync import Sync
+from tapiriik.sync.synchronized_activities import SynchronizedActivities
 from tapiriik.auth import TOTP, DiagnosticsUser
 from bson.objectid import ObjectId
 import hashlib
@@ -108,7 +109,7 @@ def diag_user(req, user):
     elif "unlock" in req.POST:
         db.users.update({"_id": ObjectId(user)}, {"$unset": {"SynchronizationWorker": None}})
     elif "lock" in req.POST:
-        db.users.update({"_id": ObjectId(user)}, {"$set": {"SynchronizationWorker": 1}})
+        db.users.update({"_id": ObjectId(user)}, {"$set": {"SynchronizationWorker": 1}, "$unset": {"SynchronizationLeaseExpiry": None}}) # Without a lease, it holds until unlocked
     elif "hostrestrict" in req.POST:
         host = req.POST["host"]
         if host:
@@ -135,13 +136,11 @@ def diag_user(req, user):
         except:
             pass
     elif "svc_marksync" in req.POST:
-        db.connections.update({"_id": ObjectId(req.POST["id"])},
-                              {"$addToSet": {"SynchronizedActivities": req.POST["uid"]}},
-                              multi=False)
+        SynchronizedActivities.Add([ObjectId(req.POST["id"])], [req.POST["uid"]])
     elif "svc_clearexc" in req.POST:
         db.connections.update({"_id": ObjectId(req.POST["id"])}, {"$unset": {"ExcludedActivities": 1}})
     elif "svc_clearacts" in req.POST:
-        db.connections.update({"_id": ObjectId(req.POST["id"])}, {"$unset": {"SynchronizedActivities": 1}})
+        SynchronizedActivities.Clear(ObjectId(req.POST["id"]))
         Sync.SetNextSyncIsExhaustive(userRec, True)
     else:
         delta = False
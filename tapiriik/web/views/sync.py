@@ -3,7 +3,7 @@ from django.http import HttpResponse
 from django.views.decorators.http import require_POST
 from django.views.decorators.csrf import csrf_exempt
 from tapiriik.auth import User
-from tapiriik.sync import Sync
+from tapiriik.sync import Sync, SyncLane
 from tapiriik.database import db
 from tapiriik.services import Service
 from datetime import datetime
@@ -39,7 +39,9 @@ def sync_status(req):
                         "Hash": syncHash}
 
     if stats and "QueueHeadTime" in stats:
-        sync_status_dict["SynchronizationWaitTime"] = (stats["QueueHeadTime"] - (datetime.utcnow() - req.user["NextSynchronization"]).total_seconds()) if "NextSynchronization" in req.user and req.user["NextSynchronization"] is not None else None
+        # Their own lane's queue is what they're waiting in
+        queueHeadTime = stats.get("QueueHeadTimeByLane", {}).get(SyncLane.Of(req.user), stats["QueueHeadTime"])
+        sync_status_dict["SynchronizationWaitTime"] = (queueHeadTime - (datetime.utcnow() - req.user["NextSynchronization"]).total_seconds()) if "NextSynchronization" in req.user and req.user["NextSynchronization"] is not None else None
 
     return HttpResponse(json.dumps(sync_status_dict), mimetype="application/json")
 
@@ -84,6 +86,7 @@ def sync_trigger_partial_sync_callback(req, service):
     svc = Service.FromID(service)
     affected_connection_ids = svc.ServiceRecordIDsForPartialSyncTrigger(req)
     db.connections.update({"_id": {"$in": affected_connection_ids}}, {"$set":{"TriggerPartialSync": True}}, multi=True)
-    db.users.update({"ConnectedServices.ID": {"$in": affected_connection_ids}}, {"$set": {"NextSynchronization": datetime.utcnow()}}, multi=True) # It would be nicer to use the Sync.Schedule... method, but I want to cleanly do this in bulk
+    # Anyone already waiting in the interactive lane stays there - they're due now either way
+    db.users.update({"ConnectedServices.ID": {"$in": affected_connection_ids}, "SynchronizationLane": {"$ne": SyncLane.Interactive}}, {"$set": {"NextSynchronization": datetime.utcnow(), "SynchronizationLane": SyncLane.PartialTrigger}}, multi=True) # It would be nicer to use the Sync.Schedule... method, but I want to cleanly do this in bulk
     return HttpResponse(status=204)
 